@@ -3,6 +3,7 @@ from opentps.core.data._dvh import *
 from opentps.core.data._patient import *
 from opentps.core.data._patientData import *
 from opentps.core.data._patientList import *
+from opentps.core.data._quantizedSparseMatrix import *
 from opentps.core.data._roiContour import *
 from opentps.core.data._rtStruct import *
 from opentps.core.data._sparseBeamlets import *
@@ -0,0 +1,293 @@
+__all__ = ['QuantizedSparseMatrix']
+
+import logging
+import unittest
+
+import numpy as np
+from scipy.sparse import csc_matrix
+
+logger = logging.getLogger(__name__)
+
+
+class QuantizedSparseMatrix:
+    """
+    Compact encoding of a non-negative CSC matrix (typically a beamlet matrix) with 16-bit values.
+    Each column j is stored as uint16 values q_ij with a float32 scale s_j such that b_ij ~= s_j * q_ij, where s_j is
+    the column maximum divided by 65535. Row indices can optionally be delta-coded within each column on 16 bits.
+
+    The dot and transposeDot kernels work directly on the encoded matrix, block of columns by block of columns, so that
+    the float32 matrix is never rebuilt in memory:
+    B.x = Q.(s * x) and B^T.y = s * (Q^T.y)
+
+    The rounding error on each entry is bounded by s_j / 2, i.e. by 1/131070 of the column maximum. The bound is
+    logged when the matrix is built.
+
+    Parameters
+    ----------
+    matrix : csc_matrix
+        The matrix to encode. All values must be non-negative.
+    deltaCodedIndices : bool (default: False)
+        If True, row indices are stored as 16-bit differences between consecutive rows of a column (differences that do
+        not fit on 16 bits are stored separately).
+    blockSize : int (default: 2**22)
+        Approximate number of non-zero values processed at once by the kernels.
+
+    Attributes
+    ----------
+    shape : tuple
+        Shape of the matrix
+    scales : np.ndarray
+        Per-column scale factors
+    maxAbsoluteError : float
+        Upper bound of the absolute rounding error on any entry
+    relativeErrorBound : float
+        Upper bound of the rounding error relative to the column maximum
+    measuredMaxError : float
+        Largest absolute rounding error actually observed during the encoding
+    """
+    MAX_VALUE = np.iinfo(np.uint16).max
+
+    def __init__(self, matrix: csc_matrix, deltaCodedIndices=False, blockSize=1 << 22):
+        matrix = csc_matrix(matrix)
+        if not matrix.has_sorted_indices:
+            matrix = matrix.sorted_indices()
+        if matrix.nnz > 0 and matrix.data.min() < 0:
+            raise ValueError('Quantized encoding requires non-negative matrix values')
+
+        self.shape = matrix.shape
+        self.deltaCodedIndices = deltaCodedIndices
+        self.nnz = matrix.nnz
+
+        nCols = self.shape[1]
+        indexDtype = np.int32 if max(self.shape[0], self.nnz) < np.iinfo(np.int32).max else np.int64
+        self.indptr = matrix.indptr.astype(indexDtype)
+        counts = np.diff(self.indptr)
+        nonEmpty = counts > 0
+
+        columnMax = np.zeros(nCols, dtype=np.float32)
+        if self.nnz > 0:
+            columnMax[nonEmpty] = np.maximum.reduceat(matrix.data, self.indptr[:-1][nonEmpty])
+        self.scales = (columnMax / self.MAX_VALUE).astype(np.float32)
+        inverseScales = np.zeros(nCols, dtype=np.float64)
+        inverseScales[self.scales > 0] = 1.0 / self.scales[self.scales > 0]
+
+        self._blockBounds = self._computeBlockBounds(blockSize)
+
+        self.data = np.empty(self.nnz, dtype=np.uint16)
+        self.measuredMaxError = 0.0
+        for colStart, colStop in self._blockBounds:
+            start, stop = self.indptr[colStart], self.indptr[colStop]
+            blockCounts = counts[colStart:colStop]
+            values = matrix.data[start:stop]
+            quantized = np.rint(values * np.repeat(inverseScales[colStart:colStop], blockCounts))
+            self.data[start:stop] = np.clip(quantized, 0, self.MAX_VALUE)
+            if stop > start:
+                error = np.abs(self.data[start:stop] * np.repeat(self.scales[colStart:colStop], blockCounts) - values)
+                self.measuredMaxError = max(self.measuredMaxError, float(error.max()))
+
+        if deltaCodedIndices:
+            self._encodeIndices(matrix.indices)
+            self.indices = None
+        else:
+            self.indices = matrix.indices.astype(indexDtype)
+
+        self.maxAbsoluteError = float(self.scales.max()) / 2 if nCols > 0 else 0.0
+        self.relativeErrorBound = 0.5 / self.MAX_VALUE
+
+        logger.info('Quantized beamlet matrix {}: {:.3f} GB instead of {:.3f} GB in float32'.format(
+            self.shape, self.nbytes / 1024 ** 3, (self.nnz * 8 + self.indptr.nbytes) / 1024 ** 3))
+        logger.info('Quantization error bound: {:.3e} relative to each beamlet maximum, {:.3e} absolute (measured max {:.3e})'.format(
+            self.relativeErrorBound, self.maxAbsoluteError, self.measuredMaxError))
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    @property
+    def nbytes(self) -> int:
+        nbytes = self.data.nbytes + self.indptr.nbytes + self.scales.nbytes
+        if self.deltaCodedIndices:
+            nbytes += self._indexDeltas.nbytes + self._overflowPositions.nbytes + self._overflowHighBits.nbytes
+        else:
+            nbytes += self.indices.nbytes
+        return nbytes
+
+    def doseErrorBound(self, weights: np.ndarray) -> float:
+        """
+        Upper bound of the absolute error on any entry of B.weights due to the quantization
+
+        Parameters
+        ----------
+        weights : np.ndarray
+            Beamlet weights
+
+        Returns
+        -------
+        float
+            The error bound
+        """
+        return float(np.sum(np.abs(weights) * self.scales) / 2)
+
+    def dot(self, x: np.ndarray) -> np.ndarray:
+        """
+        Matrix-vector product B.x
+
+        Parameters
+        ----------
+        x : np.ndarray
+            Vector of size shape[1]
+
+        Returns
+        -------
+        np.ndarray
+            Vector of size shape[0] (float32)
+        """
+        scaledX = (np.asarray(x, dtype=np.float32) * self.scales).astype(np.float32)
+        result = np.zeros(self.shape[0], dtype=np.float32)
+        for colStart, colStop in self._blockBounds:
+            result += self._block(colStart, colStop).dot(scaledX[colStart:colStop])
+        return result
+
+    def transposeDot(self, y: np.ndarray) -> np.ndarray:
+        """
+        Transposed matrix-vector product B^T.y
+
+        Parameters
+        ----------
+        y : np.ndarray
+            Vector of size shape[0]
+
+        Returns
+        -------
+        np.ndarray
+            Vector of size shape[1] (float32)
+        """
+        y = np.asarray(y, dtype=np.float32)
+        result = np.empty(self.shape[1], dtype=np.float32)
+        for colStart, colStop in self._blockBounds:
+            result[colStart:colStop] = self._block(colStart, colStop).T.dot(y)
+        result *= self.scales
+        return result
+
+    def toSparseMatrix(self) -> csc_matrix:
+        """
+        Decode the matrix to a float32 CSC matrix
+
+        Returns
+        -------
+        csc_matrix
+            The decoded matrix
+        """
+        counts = np.diff(self.indptr)
+        data = self.data * np.repeat(self.scales, counts)
+        return csc_matrix((data.astype(np.float32), self._decodeIndices(0, self.shape[1]), self.indptr.copy()),
+                          shape=self.shape)
+
+    def _computeBlockBounds(self, blockSize):
+        bounds = []
+        nCols = self.shape[1]
+        colStart = 0
+        while colStart < nCols:
+            colStop = int(np.searchsorted(self.indptr, self.indptr[colStart] + blockSize, side='right')) - 1
+            colStop = min(max(colStop, colStart + 1), nCols)
+            bounds.append((colStart, colStop))
+            colStart = colStop
+        return bounds
+
+    def _block(self, colStart, colStop) -> csc_matrix:
+        start, stop = self.indptr[colStart], self.indptr[colStop]
+        return csc_matrix((self.data[start:stop], self._decodeIndices(colStart, colStop),
+                           self.indptr[colStart:colStop + 1] - start), shape=(self.shape[0], colStop - colStart))
+
+    def _encodeIndices(self, indices):
+        counts = np.diff(self.indptr)
+        deltas = np.diff(indices.astype(np.int64), prepend=0)
+        # The first entry of each column stores its full row index
+        firstEntries = self.indptr[:-1][counts > 0]
+        deltas[firstEntries] = indices[firstEntries]
+
+        overflow = deltas > self.MAX_VALUE
+        self._overflowPositions = np.flatnonzero(overflow).astype(self.indptr.dtype)
+        self._overflowHighBits = (deltas[overflow] >> 16).astype(np.int32)
+        self._indexDeltas = (deltas & self.MAX_VALUE).astype(np.uint16)
+
+    def _decodeIndices(self, colStart, colStop) -> np.ndarray:
+        start, stop = self.indptr[colStart], self.indptr[colStop]
+        if not self.deltaCodedIndices:
+            return self.indices[start:stop]
+
+        deltas = self._indexDeltas[start:stop].astype(np.int64)
+        first, last = np.searchsorted(self._overflowPositions, [start, stop])
+        deltas[self._overflowPositions[first:last] - start] += self._overflowHighBits[first:last].astype(np.int64) << 16
+
+        # Cumulative sum restarted at the beginning of each column
+        cumulated = np.cumsum(deltas)
+        columnStarts = self.indptr[colStart:colStop] - start
+        counts = np.diff(self.indptr[colStart:colStop + 1])
+        nonEmpty = counts > 0
+        offsets = np.zeros(colStop - colStart, dtype=np.int64)
+        offsets[nonEmpty] = cumulated[columnStarts[nonEmpty]] - deltas[columnStarts[nonEmpty]]
+        return (cumulated - np.repeat(offsets, counts)).astype(self.indptr.dtype)
+
+
+class QuantizedSparseMatrixTestCase(unittest.TestCase):
+    def _randomMatrix(self, nRows, nCols, nnzPerColumn, seed=0):
+        rng = np.random.default_rng(seed)
+        rows = [np.sort(rng.choice(nRows, nnzPerColumn, replace=False)) for _ in range(nCols)]
+        indptr = np.concatenate(([0], np.cumsum([len(r) for r in rows])))
+        data = rng.random(indptr[-1]).astype(np.float32) * rng.uniform(0.1, 10, indptr[-1]).astype(np.float32)
+        return csc_matrix((data, np.concatenate(rows), indptr), shape=(nRows, nCols))
+
+    def _assertWithinErrorBound(self, matrix, quantized):
+        rng = np.random.default_rng(1)
+        x = rng.random(matrix.shape[1]).astype(np.float32)
+        y = rng.random(matrix.shape[0]).astype(np.float32)
+
+        bound = quantized.doseErrorBound(x)
+        error = np.abs(quantized.dot(x) - matrix.dot(x.astype(np.float64)))
+        self.assertLessEqual(error.max(), bound * 1.001 + 1e-6)
+
+        # |(B^T.y)_j - (Q^T.y)_j| <= s_j / 2 * sum_i |y_i| over the rows of column j
+        transposeBound = quantized.scales / 2 * (abs(matrix) != 0).T.dot(np.abs(y).astype(np.float64))
+        error = np.abs(quantized.transposeDot(y) - matrix.T.dot(y.astype(np.float64)))
+        np.testing.assert_array_less(error, transposeBound * 1.001 + 1e-5)
+
+        self.assertLessEqual(quantized.measuredMaxError, quantized.maxAbsoluteError * 1.001)
+        decoded = quantized.toSparseMatrix()
+        np.testing.assert_array_equal(decoded.indices, matrix.indices)
+        np.testing.assert_array_equal(decoded.indptr, matrix.indptr)
+
+    def testDotAndTransposeDot(self):
+        matrix = self._randomMatrix(5000, 60, 200)
+        for blockSize in (1 << 22, 1000):
+            self._assertWithinErrorBound(matrix, QuantizedSparseMatrix(matrix, blockSize=blockSize))
+
+    def testDeltaCodedIndices(self):
+        matrix = self._randomMatrix(5000, 60, 200)
+        self._assertWithinErrorBound(matrix, QuantizedSparseMatrix(matrix, deltaCodedIndices=True, blockSize=1000))
+
+    def testDeltaCodedIndexOverflow(self):
+        # Rows more than 65535 apart: the first index of each column and some differences overflow 16 bits
+        matrix = self._randomMatrix(400000, 30, 12, seed=2)
+        quantized = QuantizedSparseMatrix(matrix, deltaCodedIndices=True, blockSize=50)
+        self.assertGreater(len(quantized._overflowPositions), 0)
+        self._assertWithinErrorBound(matrix, quantized)
+
+    def testEmptyColumns(self):
+        matrix = self._randomMatrix(1000, 20, 50).tolil()
+        matrix[:, 3] = 0
+        matrix[:, 10:14] = 0
+        matrix = csc_matrix(matrix)
+        for deltaCodedIndices in (False, True):
+            quantized = QuantizedSparseMatrix(matrix, deltaCodedIndices=deltaCodedIndices, blockSize=100)
+            np.testing.assert_array_equal(quantized.scales[[3, 10, 11, 12, 13]], 0)
+            self._assertWithinErrorBound(matrix, quantized)
+
+    def testNegativeValues(self):
+        matrix = csc_matrix(np.array([[1., 0.], [0., -1.]], dtype=np.float32))
+        with self.assertRaises(ValueError):
+            QuantizedSparseMatrix(matrix)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,14 +2,19 @@ __all__ = ['SparseBeamlets']
 
 import logging
 import pickle
+import threading
+import unittest
+import weakref
+from collections import OrderedDict
 from typing import Sequence, Optional
 
 import numpy as np
 
-from opentps.core.io.serializedObjectIO import saveData
-from scipy.sparse import csc_matrix
+from opentps.core.io import sparseBeamletsIO
+from scipy.sparse import csc_matrix, csr_matrix
 
 from opentps.core.data.images._image3D import Image3D
+from opentps.core.data._quantizedSparseMatrix import QuantizedSparseMatrix
 from opentps.core.data._patientData import PatientData
 
 logger = logging.getLogger(__name__)
@@ -21,6 +26,11 @@ except:
     use_MKL = 0
 
 
+# CSR twins currently held by SparseBeamlets instances, least recently used first
+_csrTwins = OrderedDict()
+_csrTwinsLock = threading.RLock()
+
+
 class SparseBeamlets(PatientData):
     """
     Class for storing sparse beamlet data. Inherits from PatientData.
@@ -37,7 +47,21 @@ class SparseBeamlets(PatientData):
         Orientation of the dose grid
     shape : tuple
         Shape of the sparse beamlet matrix
+    voxelIndices : np.ndarray or None
+        Row to voxel index map when the matrix rows are compacted on a subset of the dose grid voxels
+        (see compactRows), None when the rows span the full dose grid
+    spotKeys : np.ndarray or None
+        One identifier per column of the spot (or beamlet) it was computed for, used to match the columns of two beamlet
+        matrices (see MCsquareDoseCalculator.computeBeamletsIncremental). None if the columns are not labelled.
+    csrMemoryBudget : int or None
+        Class attribute. Maximum number of bytes held by the CSR twins (see toCSRMatrix) of all the SparseBeamlets, None
+        for no limit (default: None). The least recently used twins are dropped to fit a new one in the budget.
+    csrMemoryUsage : int
+        Number of bytes of the CSR twin of this matrix (0 if none is cached). The twin is neither copied nor pickled with
+        the beamlets.
     """
+    csrMemoryBudget = None
+
     def __init__(self):
         super().__init__()
 
@@ -47,9 +71,33 @@ class SparseBeamlets(PatientData):
         self._spacing = (1, 1, 1)
         self._gridSize = (0, 0, 0)
         self._orientation = (1, 0, 0, 0, 1, 0, 0, 0, 1)
+        self._voxelIndices = None
+        self._spotKeys = None
+        self._quantizedBeamlets = None
+        self._csrBeamlets = None
 
         self._savedBeamletFile = None
 
+    def __deepcopy__(self, memodict={}):
+        # The CSR twin is a cache registered under the id of its instance (see toCSRMatrix): copies build their own
+        with _csrTwinsLock:
+            csrBeamlets = self._csrBeamlets
+            self._csrBeamlets = None
+            try:
+                result = super().__deepcopy__(memodict)
+            finally:
+                self._csrBeamlets = csrBeamlets
+        return result
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_csrBeamlets'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._csrBeamlets = None
+
     @property
     def doseOrigin(self):
         return self._origin
@@ -80,12 +128,36 @@ class SparseBeamlets(PatientData):
 
     @property
     def shape(self):
+        if self._sparseBeamlets is None and not (self._quantizedBeamlets is None):
+            return self._quantizedBeamlets.shape
         return self._sparseBeamlets.shape
 
     @doseOrientation.setter
     def doseOrientation(self, orientation):
         self._orientation = orientation
 
+    @property
+    def voxelIndices(self) -> Optional[np.ndarray]:
+        return self._voxelIndices
+
+    @property
+    def spotKeys(self) -> Optional[np.ndarray]:
+        return self._spotKeys
+
+    @spotKeys.setter
+    def spotKeys(self, keys: Optional[np.ndarray]):
+        if not (keys is None) and len(keys) != self.shape[1]:
+            raise ValueError('Expected {} spot keys but got {}'.format(self.shape[1], len(keys)))
+        self._spotKeys = keys
+
+    @property
+    def hasCompactRows(self) -> bool:
+        return not (self._voxelIndices is None)
+
+    @property
+    def numberOfVoxels(self) -> int:
+        return int(np.prod(self._gridSize))
+
     def setSpatialReferencingFromImage(self, image: Image3D):
         """
         Sets the spatial referencing of the sparse beamlet matrix from an image
@@ -106,38 +178,269 @@ class SparseBeamlets(PatientData):
         Parameters
         ---------
         beamlets : csc_matrix
-            Sparse beamlets matrix
+            Sparse beamlets matrix. If the rows are compacted, the row to voxel map is kept as long as the number of
+            rows is unchanged. Likewise, spot keys are kept as long as the number of columns is unchanged.
         """
         self._sparseBeamlets = beamlets
+        self._quantizedBeamlets = None
+        self.dropCSRMatrix()
+        if self.hasCompactRows and not (beamlets is None) and beamlets.shape[0] != len(self._voxelIndices):
+            self._voxelIndices = None
+        if not (self._spotKeys is None) and not (beamlets is None) and beamlets.shape[1] != len(self._spotKeys):
+            self._spotKeys = None
+
+    def compactRows(self, voxelMask: np.ndarray, nonZeroMask: Optional[np.ndarray] = None):
+        """
+        Restricts the rows of the sparse beamlets matrix to the voxels of voxelMask and keeps a row to voxel index map.
+        Dose vectors computed with the compacted matrix only span these voxels; use rowsToVoxels to scatter them back
+        on the full dose grid.
+        This can be called again on already compacted beamlets: voxels of the new mask that were not part of the
+        previous row space get empty rows.
+
+        Parameters
+        ----------
+        voxelMask : np.ndarray
+            Boolean vector over the full dose grid (flattened in the beamlet voxel order) of the voxels to keep as rows
+        nonZeroMask : np.ndarray, optional
+            Boolean vector over the full dose grid. Entries of voxels outside nonZeroMask are dropped while their rows
+            are kept. Defaults to voxelMask. Used to share one row space between matrices cropped on different ROIs.
+        """
+        beamlets = self.toSparseMatrix()
+        if not isinstance(beamlets, csc_matrix):
+            beamlets = csc_matrix(beamlets)
+
+        voxelMask = np.asarray(voxelMask, dtype=bool).ravel()
+        keepMask = voxelMask if nonZeroMask is None else np.logical_and(voxelMask, np.asarray(nonZeroMask, dtype=bool).ravel())
+
+        newVoxelIndices = np.flatnonzero(voxelMask)
+        indexDtype = np.int32 if max(len(newVoxelIndices), beamlets.nnz) < np.iinfo(np.int32).max else np.int64
+        newRowOfVoxel = np.full(len(voxelMask), -1, dtype=indexDtype)
+        newRowOfVoxel[newVoxelIndices] = np.arange(len(newVoxelIndices), dtype=indexDtype)
+
+        entryVoxels = beamlets.indices if self._voxelIndices is None else self._voxelIndices[beamlets.indices]
+        keptEntries = keepMask[entryVoxels]
+
+        keptCount = np.zeros(beamlets.nnz + 1, dtype=np.int64)
+        np.cumsum(keptEntries, out=keptCount[1:])
+        indptr = keptCount[beamlets.indptr].astype(indexDtype)
+        indices = newRowOfVoxel[entryVoxels[keptEntries]]
+        data = beamlets.data[keptEntries]
+
+        self._sparseBeamlets = csc_matrix((data, indices, indptr), shape=(len(newVoxelIndices), beamlets.shape[1]))
+        self._voxelIndices = newVoxelIndices.astype(indexDtype)
+        self._quantizedBeamlets = None
+        self.dropCSRMatrix()
+
+    def voxelsToRows(self, voxelVector: np.ndarray) -> np.ndarray:
+        """
+        Restricts a vector defined over the full dose grid to the row space of the beamlet matrix
+
+        Parameters
+        ----------
+        voxelVector : np.ndarray
+            Vector over the full dose grid (flattened in the beamlet voxel order)
+
+        Returns
+        -------
+        np.ndarray
+            Vector over the matrix rows (voxelVector itself if the rows are not compacted)
+        """
+        if self._voxelIndices is None:
+            return voxelVector
+        return voxelVector[self._voxelIndices]
+
+    def rowsToVoxels(self, rowVector: np.ndarray) -> np.ndarray:
+        """
+        Scatters a vector defined over the rows of the beamlet matrix on the full dose grid. Voxels outside the row
+        space are set to 0.
+
+        Parameters
+        ----------
+        rowVector : np.ndarray
+            Vector over the matrix rows, e.g. a dose vector
+
+        Returns
+        -------
+        np.ndarray
+            Vector over the full dose grid (rowVector itself if the rows are not compacted)
+        """
+        if self._voxelIndices is None:
+            return rowVector
+        voxelVector = np.zeros(self.numberOfVoxels, dtype=rowVector.dtype)
+        voxelVector[self._voxelIndices] = rowVector
+        return voxelVector
+
+    def scaleColumns(self, factors: Sequence[float]):
+        """
+        Scales each column (beamlet) of the sparse beamlets matrix in place.
+        This is equivalent to multiplying the matrix on the right by diag(factors) but works directly on the CSC data
+        array, without allocating the diagonal matrix nor running a sparse matrix product.
+
+        Parameters
+        ----------
+        factors : Sequence[float]
+            One scaling factor per column
+        """
+        beamlets = self.toSparseMatrix()
+        if not isinstance(beamlets, csc_matrix):
+            beamlets = csc_matrix(beamlets)
+            self._sparseBeamlets = beamlets
+
+        factors = np.asarray(factors, dtype=beamlets.dtype)
+        if factors.shape != (beamlets.shape[1],):
+            raise ValueError('Expected {} scaling factors but got {}'.format(beamlets.shape[1], factors.shape))
+        self.dropCSRMatrix()
+
+        # Process blocks of columns to bound the size of the temporary expanded factors
+        indptr = beamlets.indptr
+        nCols = beamlets.shape[1]
+        blockNnz = 1 << 24
+        start = 0
+        while start < nCols:
+            stop = int(np.searchsorted(indptr, indptr[start] + blockNnz, side='right')) - 1
+            stop = min(max(stop, start + 1), nCols)
+            beamlets.data[indptr[start]:indptr[stop]] *= np.repeat(factors[start:stop], np.diff(indptr[start:stop + 1]))
+            start = stop
 
     def toSparseMatrix(self) -> csc_matrix:
         """
-        Convert the sparse beamlets matrix (attribute) to a csc_matrix type
+        Convert the sparse beamlets matrix (attribute) to a csc_matrix type.
+        If only the quantized encoding is kept in memory, a decoded copy is returned.
 
         Returns
         -------
         csc_matrix
             The sparse beamlets matrix
         """
+        if self._sparseBeamlets is None and not (self._quantizedBeamlets is None):
+            return self._quantizedBeamlets.toSparseMatrix()
         if self._sparseBeamlets is None and not(self._savedBeamletFile is None):
             self.reloadFromFS()
         return self._sparseBeamlets
+
+    def quantize(self, deltaCodedIndices=False) -> QuantizedSparseMatrix:
+        """
+        Encodes the sparse beamlets matrix with 16-bit values and a per-beamlet scale (see QuantizedSparseMatrix) and
+        releases the float32 matrix. The quantization error bound is logged.
+
+        Parameters
+        ----------
+        deltaCodedIndices : bool (default: False)
+            If True, row indices are also delta-coded on 16 bits
+
+        Returns
+        -------
+        QuantizedSparseMatrix
+            The quantized beamlets
+        """
+        self._quantizedBeamlets = QuantizedSparseMatrix(self.toSparseMatrix(), deltaCodedIndices=deltaCodedIndices)
+        self._sparseBeamlets = None
+        self.dropCSRMatrix()
+        return self._quantizedBeamlets
+
+    def toCSRMatrix(self) -> Optional[csr_matrix]:
+        """
+        Returns a CSR copy (twin) of the sparse beamlets matrix, built on first call and cached until the matrix changes
+        or the twin is dropped. The rows of the CSR twin are contiguous, so that the dose B.w is a dot product per voxel,
+        shared without conflict among threads (see NativeSparseOperator). It is reused by all the optimizations run on
+        these beamlets.
+        The memory of all the twins is bounded by SparseBeamlets.csrMemoryBudget: the least recently used twins of
+        other matrices are dropped to fit this one.
+
+        Returns
+        -------
+        csr_matrix or None
+            The CSR twin, None if the matrix is quantized or if the twin alone exceeds the memory budget
+        """
+        with _csrTwinsLock:
+            if not (self._csrBeamlets is None):
+                _csrTwins.move_to_end(id(self))
+                return self._csrBeamlets
+
+            if not (self._quantizedBeamlets is None):
+                return None
+            beamlets = self.toSparseMatrix()
+            if beamlets is None:
+                return None
+
+            indexBytes = np.dtype(np.int32 if max(beamlets.nnz, beamlets.shape[1]) < np.iinfo(np.int32).max else np.int64).itemsize
+            memoryNeed = beamlets.nnz * (beamlets.dtype.itemsize + indexBytes) + (beamlets.shape[0] + 1) * indexBytes
+            budget = SparseBeamlets.csrMemoryBudget
+            if not (budget is None):
+                if memoryNeed > budget:
+                    logger.info('CSR twin of {} bytes exceeds the memory budget of {} bytes: not built'.format(memoryNeed, budget))
+                    return None
+                _releaseCSRTwins(budget - memoryNeed)
+
+            self._csrBeamlets = csr_matrix(beamlets)
+            _csrTwins[id(self)] = weakref.ref(self)
+            logger.info('CSR twin of the beamlet matrix built ({} MB)'.format(self.csrMemoryUsage // 2**20))
+            return self._csrBeamlets
+
+    @property
+    def csrMemoryUsage(self) -> int:
+        if self._csrBeamlets is None:
+            return 0
+        return self._csrBeamlets.data.nbytes + self._csrBeamlets.indices.nbytes + self._csrBeamlets.indptr.nbytes
+
+    def dropCSRMatrix(self):
+        """
+        Releases the CSR twin of the sparse beamlets matrix (see toCSRMatrix)
+        """
+        with _csrTwinsLock:
+            self._csrBeamlets = None
+            _csrTwins.pop(id(self), None)
+
+    @staticmethod
+    def totalCSRMemoryUsage() -> int:
+        """
+        Number of bytes held by the CSR twins of all the SparseBeamlets
+        """
+        with _csrTwinsLock:
+            return sum(beamlets.csrMemoryUsage for beamlets in (ref() for ref in _csrTwins.values()) if not (beamlets is None))
+
+    @property
+    def isQuantized(self) -> bool:
+        return not (self._quantizedBeamlets is None)
+
+    def toBeamletOperator(self):
+        """
+        Returns the operator to use for dose and gradient products: the quantized beamlets if the matrix has been
+        quantized, the csc_matrix otherwise
+
+        Returns
+        -------
+        Union[QuantizedSparseMatrix, csc_matrix]
+            The beamlet operator
+        """
+        if not (self._quantizedBeamlets is None):
+            return self._quantizedBeamlets
+        return self.toSparseMatrix()
     
-    def toDoseImage(self):
+    def toDoseImage(self, nThreads=None):
         """
-        Converts the sparse beamlets matrix to a dose image
+        Converts the sparse beamlets matrix to a dose image. The product is computed with the multithreaded native
+        library libSparseDot if it is built (Linux only), with scipy otherwise.
+
+        Parameters
+        ----------
+        nThreads : int (default: None)
+            Number of threads of the native product. All the CPUs if None.
 
         Returns
         -------
         DoseImage
             The dose image
         """
+        from opentps.core.processing.C_libraries.libSparseDot_wrapper import sparseDot
+
         weights = np.array(self._weights, dtype=np.float32)
         if use_MKL == 1:
-            totalDose = sparse_dot_mkl.dot_product_mkl(self._sparseBeamlets, weights)
+            totalDose = sparse_dot_mkl.dot_product_mkl(self.toSparseMatrix(), weights)
         else:
-            totalDose = csc_matrix.dot(self._sparseBeamlets, weights)
+            totalDose = sparseDot(self.toSparseMatrix(), weights, nThreads=nThreads)
 
+        totalDose = self.rowsToVoxels(totalDose)
         totalDose = np.reshape(totalDose, self._gridSize, order='F')
         totalDose = np.flip(totalDose, 0)
         totalDose = np.flip(totalDose, 1)
@@ -152,22 +455,174 @@ class SparseBeamlets(PatientData):
 
     def reloadFromFS(self):
         """
-        Reloads the sparse beamlets matrix from the file system
+        Reloads the sparse beamlets matrix from the file system.
+        Files in the native format (see opentps.core.io.sparseBeamletsIO) are memory-mapped without any parse step.
+        Legacy pickled files are unpickled.
         """
-        with open(self._savedBeamletFile, 'rb') as fid:
-            tmp = pickle.load(fid)
-        self.__dict__.update(tmp)
+        if sparseBeamletsIO.isSparseBeamletsFile(self._savedBeamletFile):
+            header = sparseBeamletsIO.readSparseBeamletsHeader(self._savedBeamletFile)
+            self._setMetadataFromHeader(header)
+            self._sparseBeamlets = sparseBeamletsIO.memmapSparseMatrix(self._savedBeamletFile, header)
+            self._voxelIndices = sparseBeamletsIO.memmapVoxelIndices(self._savedBeamletFile, header)
+            self._spotKeys = sparseBeamletsIO.memmapSpotKeys(self._savedBeamletFile, header)
+        else:
+            with open(self._savedBeamletFile, 'rb') as fid:
+                tmp = pickle.load(fid)
+            tmp.pop('_csrBeamlets', None)
+            self._voxelIndices = None
+            self._spotKeys = None
+            self.__dict__.update(tmp)
 
     def storeOnFS(self, filePath):
         """
-        Stores the sparse beamlets matrix on the file system
+        Stores the sparse beamlets matrix on the file system in the native memory-mappable format
         """
+        sparseBeamletsIO.writeSparseBeamlets(self, filePath)
         self._savedBeamletFile = filePath
-        saveData(self, self._savedBeamletFile)
         self.unload()
 
+    def _setMetadataFromHeader(self, header:dict):
+        self._origin = tuple(header['doseOrigin'])
+        self._spacing = tuple(header['doseSpacing'])
+        self._gridSize = tuple(header['doseGridSize'])
+        self._orientation = tuple(header['doseOrientation'])
+        if header.get('weights') is not None:
+            self._weights = np.array(header['weights'], dtype=np.float32)
+        if header.get('name'):
+            self._name = header['name']
+        if header.get('seriesInstanceUID'):
+            self.seriesInstanceUID = header['seriesInstanceUID']
+
     def unload(self):
         """
-        Unloads the sparse beamlets matrix from memory
+        Unloads the sparse beamlets matrix (and its quantized encoding and CSR twin) from memory
         """
         self._sparseBeamlets = None
+        self._quantizedBeamlets = None
+        self.dropCSRMatrix()
+
+
+def _releaseCSRTwins(memoryLimit:int):
+    # Drops the least recently used CSR twins until the remaining ones fit in memoryLimit bytes
+    with _csrTwinsLock:
+        for key in list(_csrTwins.keys()):
+            beamlets = _csrTwins[key]()
+            if beamlets is None:
+                del _csrTwins[key]
+        while len(_csrTwins) and SparseBeamlets.totalCSRMemoryUsage() > memoryLimit:
+            key, ref = _csrTwins.popitem(last=False)
+            beamlets = ref()
+            if not (beamlets is None):
+                logger.info('Drop the CSR twin of a beamlet matrix ({} MB) to fit the memory budget'.format(beamlets.csrMemoryUsage // 2**20))
+                beamlets._csrBeamlets = None
+
+
+class SparseBeamletsTestCase(unittest.TestCase):
+    def _createBeamlets(self, nVoxels=120, nSpots=10):
+        import scipy.sparse as sp
+
+        beamlets = SparseBeamlets()
+        beamlets.doseGridSize = (nVoxels, 1, 1)
+        beamlets.setUnitaryBeamlets(sp.random(nVoxels, nSpots, density=0.3, format='csc', dtype=np.float32, random_state=0))
+        return beamlets
+
+    def testCompactRowsRoundTrip(self):
+        beamlets = self._createBeamlets()
+        matrix = beamlets.toSparseMatrix().toarray()
+        rng = np.random.default_rng(0)
+        voxelMask = rng.random(120) < 0.4
+        weights = rng.random(10).astype(np.float32)
+
+        beamlets.compactRows(voxelMask)
+        self.assertTrue(beamlets.hasCompactRows)
+        np.testing.assert_array_equal(beamlets.voxelIndices, np.flatnonzero(voxelMask))
+        np.testing.assert_array_equal(beamlets.toSparseMatrix().toarray(), matrix[voxelMask])
+
+        voxelVector = rng.random(120)
+        rowVector = beamlets.voxelsToRows(voxelVector)
+        np.testing.assert_array_equal(rowVector, voxelVector[voxelMask])
+        np.testing.assert_array_equal(beamlets.voxelsToRows(beamlets.rowsToVoxels(rowVector)), rowVector)
+        np.testing.assert_allclose(beamlets.rowsToVoxels(beamlets.toSparseMatrix().dot(weights)),
+                                   matrix.dot(weights) * voxelMask, rtol=1e-6)
+
+    def testCompactRowsWithNonZeroMask(self):
+        beamlets = self._createBeamlets()
+        matrix = beamlets.toSparseMatrix().toarray()
+        voxelMask = np.zeros(120, dtype=bool)
+        voxelMask[20:90] = True
+        nonZeroMask = np.zeros(120, dtype=bool)
+        nonZeroMask[50:100] = True
+
+        beamlets.compactRows(voxelMask, nonZeroMask=nonZeroMask)
+        self.assertEqual(beamlets.shape, (70, 10))
+        np.testing.assert_array_equal(beamlets.toSparseMatrix().toarray(), matrix[voxelMask] * nonZeroMask[voxelMask, np.newaxis])
+
+    def testCompactRowsTwice(self):
+        beamlets = self._createBeamlets()
+        matrix = beamlets.toSparseMatrix().toarray()
+        firstMask = np.zeros(120, dtype=bool)
+        firstMask[10:60] = True
+        secondMask = np.zeros(120, dtype=bool)
+        secondMask[40:80] = True
+
+        beamlets.compactRows(firstMask)
+        beamlets.compactRows(secondMask)
+        # Voxels of the second mask outside the first one get empty rows
+        expected = matrix[secondMask] * firstMask[secondMask, np.newaxis]
+        np.testing.assert_array_equal(beamlets.voxelIndices, np.flatnonzero(secondMask))
+        np.testing.assert_array_equal(beamlets.toSparseMatrix().toarray(), expected)
+
+    def testCSRTwinMemoryBudget(self):
+        budget = SparseBeamlets.csrMemoryBudget
+        beamletsList = [self._createBeamlets() for _ in range(3)]
+        try:
+            SparseBeamlets.csrMemoryBudget = None
+            beamletsList[0].toCSRMatrix()
+            twinSize = beamletsList[0].csrMemoryUsage
+            SparseBeamlets.csrMemoryBudget = 2 * twinSize
+            first, second, third = beamletsList
+
+            second.toCSRMatrix()
+            np.testing.assert_array_equal(first.toCSRMatrix().toarray(), first.toSparseMatrix().toarray())
+            # first was used last: the least recently used twin (second) is dropped to fit the third one
+            third.toCSRMatrix()
+            self.assertEqual([beamlets.csrMemoryUsage for beamlets in beamletsList], [twinSize, 0, twinSize])
+            self.assertLessEqual(SparseBeamlets.totalCSRMemoryUsage(), SparseBeamlets.csrMemoryBudget)
+
+            second.toCSRMatrix()
+            self.assertEqual([beamlets.csrMemoryUsage for beamlets in beamletsList], [0, twinSize, twinSize])
+
+            # A twin larger than the budget is not built
+            SparseBeamlets.csrMemoryBudget = twinSize - 1
+            first.dropCSRMatrix()
+            self.assertIsNone(first.toCSRMatrix())
+        finally:
+            SparseBeamlets.csrMemoryBudget = budget
+            for beamlets in beamletsList:
+                beamlets.dropCSRMatrix()
+
+    def testCSRTwinIsNotCopied(self):
+        import copy
+        import pickle
+
+        beamlets = self._createBeamlets()
+        beamlets.seriesInstanceUID = '1.2.3'
+        beamlets.toCSRMatrix()
+        totalUsage = SparseBeamlets.totalCSRMemoryUsage()
+        for duplicate in (copy.deepcopy(beamlets), copy.copy(beamlets), pickle.loads(pickle.dumps(beamlets))):
+            self.assertEqual(duplicate.csrMemoryUsage, 0)
+            np.testing.assert_array_equal(duplicate.toSparseMatrix().toarray(), beamlets.toSparseMatrix().toarray())
+        self.assertGreater(beamlets.csrMemoryUsage, 0)
+        self.assertEqual(SparseBeamlets.totalCSRMemoryUsage(), totalUsage)
+        beamlets.dropCSRMatrix()
+
+    def testFullRows(self):
+        beamlets = self._createBeamlets()
+        vector = np.arange(120.)
+        self.assertFalse(beamlets.hasCompactRows)
+        self.assertIs(beamlets.voxelsToRows(vector), vector)
+        self.assertIs(beamlets.rowsToVoxels(vector), vector)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,6 @@
 import os
-import struct
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import scipy.sparse as sp
@@ -166,30 +166,112 @@ def formatToOpenTPSformat(arr,size):
     return convertTo1DcoordFortran([size[0]-(arr[0]+1), size[1]-(arr[1]+1), arr[2]],size) ### Flip axis 0 and 1
 
 def changeOfCoordinates(beamIndexes, size): ### The indexes exported in CCC have coordinates [size[2],size[0],size[1]]. This function change the index for size[0],size[1],size[2] in OpenTPS order
-    i, j, k = convertTo3Dcoord(np.array(beamIndexes), [size[2], size[0], size[1]])
+    size = np.asarray(size, dtype=np.int64)
+    i, j, k = convertTo3Dcoord(np.asarray(beamIndexes, dtype=np.int64), [size[2], size[0], size[1]])
     return formatToOpenTPSformat([j, k, i], size) ### This transpose the axis j = 0, k = 1, i = 2 and order the indexes following the indexation used in OpenTPS 
-        
-
-def read_sparse_data(matrixBeamlets_path, header, BeamletMatrix = None):
-    with open(matrixBeamlets_path, mode='rb') as file: # b is important -> binary
-        fileContent = file.read()
-    Nbeamlets = struct.unpack("i", fileContent[:4])[0]
-    numberOfReadItems = 4 ### The first 4 are for the number of beamlets
-    if BeamletMatrix is None:
-        BeamletMatrix = []
-    for i in range(Nbeamlets):
-        BeamProp = struct.unpack("iiiii", fileContent[numberOfReadItems:numberOfReadItems+20])
-        numberOfReadItems+=20
-        beamIndexes = struct.unpack("i"*BeamProp[-1], fileContent[numberOfReadItems:numberOfReadItems+BeamProp[-1] * 4])
-        numberOfReadItems += BeamProp[-1] * 4
-        beamValues = struct.unpack("f"*BeamProp[-1], fileContent[numberOfReadItems:numberOfReadItems+BeamProp[-1] * 4])
-        numberOfReadItems += BeamProp[-1] * 4
-        beamIndexes = changeOfCoordinates(beamIndexes, header['Size'])
-        d_beamletMatrix = sp.csc_matrix(
-                        (beamValues, (beamIndexes, np.zeros(len(beamIndexes)))), shape=(header['NbrVoxels'], 1),
-                        dtype=np.float32) 
-        BeamletMatrix.append(d_beamletMatrix)
-    return BeamletMatrix, Nbeamlets
+
+
+def read_sparse_data(matrixBeamlets_path, header, roiVector:Optional[np.ndarray]=None):
+    """
+    Read a CCC sparse beamlet batch file
+
+    The file holds the number of beamlets followed, for each beamlet, by 5 int32 properties (the last one being the
+    number of non-zero voxels n), n int32 voxel indexes and n float32 values. The file is loaded in a single read and
+    only the beamlet properties are walked in Python: indexes and values are gathered with vectorized NumPy operations.
+
+    Parameters
+    ----------
+    matrixBeamlets_path : str
+        Path of the batch file
+    header : dict
+        CT header (see read_header)
+    roiVector : np.ndarray, optional
+        Boolean vector of size header['NbrVoxels'] in OpenTPS order. Voxels outside of it are dropped.
+
+    Returns
+    -------
+    beamletCounts : np.ndarray
+        Number of non-zero voxels kept for each beamlet of the batch
+    indices : np.ndarray
+        Voxel indexes in OpenTPS order
+    values : np.ndarray
+        Dose values (float32)
+    """
+    fileContent = np.fromfile(matrixBeamlets_path, dtype=np.int32)
+    nBeamlets = int(fileContent[0]) if fileContent.size > 0 else 0
+
+    # Beamlet properties: the position of each beamlet depends on the size of the previous ones
+    words = memoryview(fileContent).cast('B').cast('i')
+    counts = np.zeros(nBeamlets, dtype=np.int64)
+    starts = np.zeros(nBeamlets, dtype=np.int64)
+    position = 1
+    for beamlet in range(nBeamlets):
+        n = words[position + 4]
+        counts[beamlet] = n
+        starts[beamlet] = position + 5
+        position += 5 + 2 * n
+
+    # Positions of the indexes of every beamlet in the file, values follow the indexes of their beamlet
+    nTotal = int(counts.sum())
+    beamletOfEntry = np.repeat(np.arange(nBeamlets), counts)
+    firstEntry = np.cumsum(counts) - counts
+    indexPositions = np.arange(nTotal, dtype=np.int64) + np.repeat(starts - firstEntry, counts)
+
+    indices = changeOfCoordinates(fileContent[indexPositions], header['Size'])
+    values = fileContent.view(np.float32)[indexPositions + np.repeat(counts, counts)]
+
+    if not (roiVector is None):
+        keep = roiVector[indices]
+        indices = indices[keep]
+        values = values[keep]
+        counts = np.bincount(beamletOfEntry[keep], minlength=nBeamlets)
+
+    return counts, indices, values
+
+
+def sparseBatchesToMatrix(header, batches) -> csc_matrix:
+    """
+    Assemble the CCC batches read by read_sparse_data into a single beamlet matrix
+
+    Parameters
+    ----------
+    header : dict
+        CT header (see read_header)
+    batches : Sequence[Tuple[np.ndarray, np.ndarray, np.ndarray]]
+        Outputs of read_sparse_data, in beamlet order
+
+    Returns
+    -------
+    csc_matrix
+        Beamlet matrix with one column per beamlet
+    """
+    counts = np.concatenate([batch[0] for batch in batches]) if len(batches) > 0 else np.zeros(0, dtype=np.int64)
+    indices = np.concatenate([batch[1] for batch in batches]) if len(batches) > 0 else np.zeros(0, dtype=np.int64)
+    values = np.concatenate([batch[2] for batch in batches]) if len(batches) > 0 else np.zeros(0, dtype=np.float32)
+
+    nVoxels = int(header['NbrVoxels'])
+    indexDtype = np.int32 if max(nVoxels, len(indices)) < np.iinfo(np.int32).max else np.int64
+    indptr = np.zeros(len(counts) + 1, dtype=indexDtype)
+    np.cumsum(counts, out=indptr[1:])
+
+    matrix = csc_matrix((values.astype(np.float32, copy=False), indices.astype(indexDtype), indptr),
+                        shape=(nVoxels, len(counts)))
+    matrix.sum_duplicates()
+    return matrix
+
+
+def batchFilePath(outputDir, batch) -> str:
+    return os.path.join(outputDir, 'sparseBeamletMatrix_batch{}.bin'.format(batch))
+
+
+def roiToVector(roi: Optional[Sequence[Union[ROIContour, ROIMask]]]) -> Optional[np.ndarray]:
+    """
+    Union of the ROI masks as a boolean vector in the CCC voxel order, None if there is no ROI
+    """
+    if roi is None or (isinstance(roi, list) and len(roi) == 0):
+        return None
+    return mergeContours(roi)
+
 
 def mergeContours(roi, flatAndFlip = True):
     if isinstance(roi, ROIMask):
@@ -208,7 +290,29 @@ def mergeContours(roi, flatAndFlip = True):
             roiUnion = np.logical_or(roiUnion, roiData)
     return roiUnion
 
-def readBeamlets(CTheaderfile_path, outputDir, batchSize, roi: Optional[Sequence[Union[ROIContour, ROIMask]]] = None): 
+def readBeamlets(CTheaderfile_path, outputDir, batchSize, roi: Optional[Sequence[Union[ROIContour, ROIMask]]] = None, batches=None):
+    """
+    Read the CCC sparse beamlet batch files into a SparseBeamlets object
+
+    Parameters
+    ----------
+    CTheaderfile_path : str
+        Path to CT_HeaderFile.txt
+    outputDir : str
+        Directory containing the sparseBeamletMatrix_batch{N}.bin files
+    batchSize : int
+        Number of batches
+    roi : Optional[Sequence[Union[ROIContour, ROIMask]]], optional
+        ROI masks on which the beamlets are cropped, by default None
+    batches : Sequence, optional
+        Batches already read with read_sparse_data (e.g. while the dose engine was still running). The batch files are
+        read concurrently if None.
+
+    Returns
+    -------
+    SparseBeamlets
+        The beamlets
+    """
     if (not CTheaderfile_path.endswith('.txt')):
         raise NameError('File ', CTheaderfile_path, ' is not a valid sparse matrix header')
 
@@ -216,23 +320,19 @@ def readBeamlets(CTheaderfile_path, outputDir, batchSize, roi: Optional[Sequence
     logger.info('Reading header from: {}'.format(CTheaderfile_path))
     header = read_header(CTheaderfile_path)
 
-    sparseBeamletsDose = None
-    numberOfBeamlets = 0
-    # Read sparse beamlets binary file
-    for batch in range(batchSize):
-        matrixBeamlets_path = os.path.join(outputDir,'sparseBeamletMatrix_batch{}.bin'.format(batch))
-        logger.info('Read binary file: {}'.format(matrixBeamlets_path))
-        sparseBeamletsDose, numberOfBeamletsInBatch = read_sparse_data(matrixBeamlets_path, header, sparseBeamletsDose)
-        numberOfBeamlets+=numberOfBeamletsInBatch
-    
-    sparseBeamletsDose = sp.hstack(sparseBeamletsDose)
-    header["NbrBeamlets"] = numberOfBeamlets
-
-    if not(roi is None) or (roi is list and not(len(roi)==0)):
-        roiUnion = mergeContours(roi)
-        sparseBeamletsDose = sp.csc_matrix.dot(sp.diags(roiUnion.astype(np.int32), format='csc'),
-                                              sparseBeamletsDose)
-        
+    # Read sparse beamlets binary files
+    if batches is None:
+        roiVector = roiToVector(roi)
+        with ThreadPoolExecutor(max_workers=max(1, min(batchSize, os.cpu_count() or 1))) as executor:
+            futures = []
+            for batch in range(batchSize):
+                logger.info('Read binary file: {}'.format(batchFilePath(outputDir, batch)))
+                futures.append(executor.submit(read_sparse_data, batchFilePath(outputDir, batch), header, roiVector))
+            batches = [future.result() for future in futures]
+
+    sparseBeamletsDose = sparseBatchesToMatrix(header, batches)
+    header["NbrBeamlets"] = sparseBeamletsDose.shape[1]
+
     beamletDose = SparseBeamlets()
     beamletDose.setUnitaryBeamlets(sparseBeamletsDose)
     # beamletDose.beamletWeights = np.ones(header["NbrBeamlets"])
@@ -257,13 +357,12 @@ def readDose(CTheaderfile_path, outputDir, batchSize, Mu):
     numberOfBeamlets = 0
     # Read sparse beamlets binary file
     for batch in range(batchSize):
-        matrixBeamlets_path = os.path.join(outputDir,'sparseBeamletMatrix_batch{}.bin'.format(batch))
+        matrixBeamlets_path = batchFilePath(outputDir, batch)
         logger.info('Read binary file: {}'.format(matrixBeamlets_path))
-        sparseBeamletsDose, numberOfBeamletsInBatch = read_sparse_data(matrixBeamlets_path, header)
-        if numberOfBeamletsInBatch == 0 or len(sparseBeamletsDose) == 0:
-            numberOfBeamlets += numberOfBeamletsInBatch
+        sparseBeamletsDose = sparseBatchesToMatrix(header, [read_sparse_data(matrixBeamlets_path, header)])
+        numberOfBeamletsInBatch = sparseBeamletsDose.shape[1]
+        if numberOfBeamletsInBatch == 0:
             continue
-        sparseBeamletsDose = sp.hstack(sparseBeamletsDose)
         if totalDose is None:
             totalDose = csc_matrix.dot(sparseBeamletsDose, Mu[numberOfBeamlets:numberOfBeamlets+numberOfBeamletsInBatch])
         else:
@@ -1,7 +1,6 @@
 import os
 import platform
 import shutil
-import struct
 import time
 import logging
 import unittest
@@ -70,7 +69,8 @@ def readBeamlets(file_path, beamletRescaling:Sequence[float], origin, roi: Optio
     sparseBeamlets = _read_sparse_data(header["Binary_file"], header["NbrVoxels"], header["NbrSpots"], roi)
 
     beamletDose = SparseBeamlets()
-    beamletDose.setUnitaryBeamlets(csc_matrix.dot(sparseBeamlets, csc_matrix(np.diag(beamletRescaling), dtype=np.float32)))
+    beamletDose.setUnitaryBeamlets(sparseBeamlets)
+    beamletDose.scaleColumns(beamletRescaling)
     beamletDose.doseOrigin = origin
     beamletDose.doseSpacing = header["VoxelSpacing"]
     beamletDose.doseGridSize = header["ImageSize"]
@@ -78,6 +78,26 @@ def readBeamlets(file_path, beamletRescaling:Sequence[float], origin, roi: Optio
     return beamletDose
 
 
+def estimateBeamletsImportMemory(file_path) -> int:
+    """
+    Estimate the peak memory needed by readBeamlets to import a sparse beamlets file
+
+    Parameters
+    ----------
+    file_path : str
+        The path to the sparse beamlets header file
+
+    Returns
+    -------
+    int
+        Estimated number of bytes
+    """
+    header = _read_sparse_header(file_path)
+    binarySize = os.path.getsize(header["Binary_file"])
+    # Raw file content, expanded float32 values and int64 row indices, and the final CSC arrays
+    return 6 * binarySize
+
+
 def _read_sparse_header(file_path):
     """
     Read sparse beamlets header file
@@ -128,6 +148,10 @@ def _read_sparse_data(Binary_file, NbrVoxels, NbrSpots, roi:Optional[ROIMask]=No
     """
     Read sparse beamlets matrix from a sparse beamlets binary file
 
+    The binary file is loaded in a single read. Only the spot and run headers are walked in Python; the voxel values and
+    row indices are gathered with vectorized NumPy operations and the CSC arrays (indptr, indices, data) are assembled
+    in one pass.
+
     Parameters
     ----------
     Binary_file : str
@@ -145,109 +169,104 @@ def _read_sparse_data(Binary_file, NbrVoxels, NbrSpots, roi:Optional[ROIMask]=No
         The sparse beamlets matrix
 
     """
-    BeamletMatrix = None
-
-    fid = open(Binary_file, 'rb')
-
-    buffer_size = 5 * NbrVoxels
-    col_index = np.zeros((buffer_size), dtype=np.uint32)
-    row_index = np.zeros((buffer_size), dtype=np.uint32)
-    beamlet_data = np.zeros((buffer_size), dtype=np.float32)
-    data_id = 0
-    last_stacked_col = -1
-    num_unstacked_col = 0
-
-    if not(roi is None) or (roi is list and not(len(roi)==0)):
-        if isinstance(roi, ROIMask):
-            roi = [roi]
-        logger.info("Beamlets are computed on {}".format([contour.name for contour in roi]))
-        roiUnion = None
-        for contour in roi:
-            roiData = np.flip(contour.imageArray,(0,1))
-            roiData = np.ndarray.flatten(roiData,'F').astype('bool')
-            if roiUnion is None:
-                roiUnion = roiData
-            else:
-                roiUnion = np.logical_or(roiUnion, roiData)
-    else:
-        roiUnion = np.ones((NbrVoxels, 1)).astype(bool)
+    roiUnion = _roiUnionVector(roi)
 
     time_start = time.time()
 
+    rawData = np.fromfile(Binary_file, dtype=np.uint8)
+    rawData = rawData[:rawData.size - rawData.size % 4]
+    floatValues = rawData.view('<f4')
+    words = memoryview(rawData).cast('I')
+
+    # Walk spot and run headers. Each spot header is 5 words (NonZeroVoxels, BeamID, LayerID, x, y), each run header is
+    # 2 words (NbrContinuousValues, FirstIndex) followed by NbrContinuousValues float32 values.
+    runSpot = []
+    runLength = []
+    runFirstIndex = []
+    runDataStart = []
+    pos = 0
     for spot in range(NbrSpots):
-        [NonZeroVoxels] = struct.unpack('I', fid.read(4))
-        [BeamID] = struct.unpack('I', fid.read(4))
-        [LayerID] = struct.unpack('I', fid.read(4))
-        [xcoord] = struct.unpack('<f', fid.read(4))
-        [ycoord] = struct.unpack('<f', fid.read(4))
-
-        logger.info("Spot {} : BeamID={} LayerID={} Position=({};{}) NonZeroVoxels={}".format(spot, BeamID, LayerID, xcoord, ycoord, NonZeroVoxels))
-
-        if (NonZeroVoxels == 0):
-            num_unstacked_col += 1
-            continue
+        NonZeroVoxels = words[pos]
+        pos += 5
 
         ReadVoxels = 0
-        while (1):
-            [NbrContinuousValues] = struct.unpack('I', fid.read(4))
+        while ReadVoxels < NonZeroVoxels:
+            NbrContinuousValues = words[pos]
+            runSpot.append(spot)
+            runLength.append(NbrContinuousValues)
+            runFirstIndex.append(words[pos + 1])
+            runDataStart.append(pos + 2)
+            pos += 2 + NbrContinuousValues
             ReadVoxels += NbrContinuousValues
 
-            [FirstIndex] = struct.unpack('I', fid.read(4))
-
-            for j in range(NbrContinuousValues):
-                [temp] = struct.unpack('<f', fid.read(4))
-
-                rowIndexVal = FirstIndex + j
-                if roiUnion[rowIndexVal]:
-                    beamlet_data[data_id] = temp
-                    row_index[data_id] = rowIndexVal
-                    col_index[data_id] = spot - last_stacked_col - 1
-                    data_id += 1
-
-            if (ReadVoxels >= NonZeroVoxels):
-                if spot == 0:
-                    BeamletMatrix = sp.csc_matrix(
-                        (beamlet_data[:data_id], (row_index[:data_id], col_index[:data_id])), shape=(NbrVoxels, 1),
-                        dtype=np.float32)
-                    data_id = 0
-                    last_stacked_col = spot
-                    num_unstacked_col = 0
-
-                    beamlet_data = 0 * beamlet_data
-                    row_index = 0 * row_index
-                    col_index = 0 * col_index
-                elif (data_id > buffer_size - NbrVoxels):
-                    A = sp.csc_matrix((beamlet_data[:data_id], (row_index[:data_id], col_index[:data_id])),
-                                      shape=(NbrVoxels, num_unstacked_col + 1), dtype=np.float32)
-                    data_id = 0
-                    BeamletMatrix = sp.hstack([BeamletMatrix, A])
-                    last_stacked_col = spot
-                    num_unstacked_col = 0
-
-                    beamlet_data = 0 * beamlet_data
-                    row_index = 0 * row_index
-                    col_index = 0 * col_index
-                else:
-                    num_unstacked_col += 1
+    runSpot = np.array(runSpot, dtype=np.int64)
+    runLength = np.array(runLength, dtype=np.int64)
+    runFirstIndex = np.array(runFirstIndex, dtype=np.int64)
+    runDataStart = np.array(runDataStart, dtype=np.int64)
 
-                break
+    # Expand runs into per-value offsets
+    nValues = int(runLength.sum())
+    runOffsets = np.cumsum(runLength) - runLength
+    offsetInRun = np.arange(nValues, dtype=np.int64) - np.repeat(runOffsets, runLength)
 
-    # stack last cols
-    A = sp.csc_matrix((beamlet_data[:data_id], (row_index[:data_id], col_index[:data_id])),
-                      shape=(NbrVoxels, num_unstacked_col), dtype=np.float32)
-    if BeamletMatrix is None:
-        BeamletMatrix = A
-    else:
-        BeamletMatrix = sp.hstack([BeamletMatrix, A])
+    row_index = np.repeat(runFirstIndex, runLength) + offsetInRun
+    beamlet_data = floatValues[np.repeat(runDataStart, runLength) + offsetInRun]
+    col_index = np.repeat(runSpot, runLength)
+
+    if not (roiUnion is None):
+        inROI = roiUnion[row_index]
+        row_index = row_index[inROI]
+        beamlet_data = beamlet_data[inROI]
+        col_index = col_index[inROI]
+
+    indptr = np.zeros(NbrSpots + 1, dtype=np.int64)
+    np.cumsum(np.bincount(col_index, minlength=NbrSpots), out=indptr[1:])
+    indexDtype = np.int32 if max(NbrVoxels, indptr[-1]) < np.iinfo(np.int32).max else np.int64
+
+    BeamletMatrix = sp.csc_matrix((beamlet_data.astype(np.float32, copy=False), row_index.astype(indexDtype),
+                                   indptr.astype(indexDtype)), shape=(NbrVoxels, NbrSpots))
+    BeamletMatrix.sum_duplicates()
 
     logger.info('Beamlets imported in {} sec'.format(time.time() - time_start))
 
     _print_memory_usage(BeamletMatrix)
 
-    fid.close()
     return BeamletMatrix
 
 
+def _roiUnionVector(roi) -> Optional[np.ndarray]:
+    """
+    Flatten the union of ROI masks in the MCsquare voxel ordering used by the sparse beamlet files
+
+    Parameters
+    ----------
+    roi : Optional[Union[ROIMask, Sequence[ROIMask]]]
+        The ROI mask(s)
+
+    Returns
+    -------
+    roiUnion : Optional[np.ndarray]
+        Boolean vector of size NbrVoxels, or None if no ROI is given
+    """
+    if roi is None:
+        return None
+    if isinstance(roi, ROIMask):
+        roi = [roi]
+    if len(roi) == 0:
+        return None
+
+    logger.info("Beamlets are computed on {}".format([contour.name for contour in roi]))
+    roiUnion = None
+    for contour in roi:
+        roiData = np.flip(contour.imageArray, (0, 1))
+        roiData = np.ndarray.flatten(roiData, 'F').astype('bool')
+        if roiUnion is None:
+            roiUnion = roiData
+        else:
+            roiUnion = np.logical_or(roiUnion, roiData)
+    return roiUnion
+
+
 def _print_memory_usage(BeamletMatrix):
     """
     Print memory usage of the sparse beamlets matrix
@@ -1095,3 +1114,42 @@ class MCsquareIOTestCase(unittest.TestCase):
         plan.appendBeam(beam)
 
         writePlan(plan, 'plan_test.txt', CTImage(), bdl)
+
+    def testReadSparseData(self):
+        """
+        Test the sparse beamlet reader against a value-by-value decoding of a synthetic binary file.
+        """
+        import struct
+        import tempfile
+
+        gridSize = (4, 5, 3)
+        nbrVoxels = int(np.prod(gridSize))
+        # Runs (FirstIndex, values) of each spot. The second spot has no voxel, the runs of the last one are not sorted.
+        rng = np.random.default_rng(0)
+        spots = [[(0, rng.random(3)), (10, rng.random(5))],
+                 [],
+                 [(nbrVoxels - 4, rng.random(4))],
+                 [(20, rng.random(6)), (2, rng.random(2)), (40, rng.random(1))]]
+
+        expected = np.zeros((nbrVoxels, len(spots)), dtype=np.float32)
+        with tempfile.TemporaryDirectory() as folder:
+            binaryFile = os.path.join(folder, 'Sparse_Dose.bin')
+            with open(binaryFile, 'wb') as fid:
+                for spot, runs in enumerate(spots):
+                    fid.write(struct.pack('<IIIff', sum(len(values) for _, values in runs), 0, spot, 1.5 * spot, -2.))
+                    for firstIndex, values in runs:
+                        fid.write(struct.pack('<II', len(values), firstIndex))
+                        for j, value in enumerate(values):
+                            fid.write(struct.pack('<f', value))
+                            expected[firstIndex + j, spot] = np.float32(value)
+
+            beamlets = _read_sparse_data(binaryFile, nbrVoxels, len(spots))
+            self.assertEqual(beamlets.shape, (nbrVoxels, len(spots)))
+            np.testing.assert_array_equal(beamlets.toarray(), expected)
+
+            roiArray = np.zeros(gridSize, dtype=bool)
+            roiArray[1:3, 2:5, :] = True
+            roi = ROIMask(imageArray=roiArray)
+            roiVector = np.ndarray.flatten(np.flip(roiArray, (0, 1)), 'F')
+            beamlets = _read_sparse_data(binaryFile, nbrVoxels, len(spots), roi)
+            np.testing.assert_array_equal(beamlets.toarray(), expected * roiVector[:, np.newaxis])
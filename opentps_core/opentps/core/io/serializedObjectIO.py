@@ -233,6 +233,12 @@ def loadBeamlets(file_path):
         The beamlets object loaded from the file
     """
     from opentps.core.data._sparseBeamlets import SparseBeamlets
+    from opentps.core.io import sparseBeamletsIO
+    if sparseBeamletsIO.isSparseBeamletsFile(file_path):
+        beamlets = SparseBeamlets()
+        beamlets._savedBeamletFile = file_path
+        beamlets.reloadFromFS()
+        return beamlets
     return loadData(file_path, SparseBeamlets)
 
 def saveData(data, file_path):
@@ -0,0 +1,372 @@
+"""
+Native on-disk format for sparse beamlet matrices.
+
+A stored beamlet matrix consists of a small JSON header file and three raw binary files holding the CSC arrays
+(header path + '.data', '.indices' and '.indptr'), plus a '.voxelIndices' file when the matrix rows are compacted on a
+subset of the dose grid and a '.spotKeys' file when the columns are labelled with spot identifiers. The raw arrays are opened with np.memmap so that reloading a matrix requires no parsing and
+several processes can share the OS page cache.
+"""
+import json
+import logging
+import os
+import unittest
+from typing import Optional
+
+import numpy as np
+from scipy.sparse import csc_matrix
+
+logger = logging.getLogger(__name__)
+
+FORMAT_NAME = 'OpenTPS-SparseBeamlets'
+FORMAT_VERSION = 1
+
+_ARRAY_NAMES = ('data', 'indices', 'indptr')
+_VECTOR_NAMES = ('voxelIndices', 'spotKeys')
+
+
+def isSparseBeamletsFile(filePath) -> bool:
+    """
+    Check whether a file is a native sparse beamlets header (as opposed to a legacy pickled SparseBeamlets)
+
+    Parameters
+    ----------
+    filePath : str
+        Path of the header file
+
+    Returns
+    -------
+    bool
+        True if the file is a native sparse beamlets header
+    """
+    if not os.path.isfile(filePath):
+        return False
+    with open(filePath, 'rb') as fid:
+        firstByte = fid.read(1)
+    if firstByte != b'{':
+        return False
+    try:
+        header = readSparseBeamletsHeader(filePath)
+    except (ValueError, UnicodeDecodeError):
+        return False
+    return header.get('format') == FORMAT_NAME
+
+
+def arrayFilePath(filePath, arrayName) -> str:
+    """
+    Path of the raw binary file holding one of the CSC arrays
+
+    Parameters
+    ----------
+    filePath : str
+        Path of the header file
+    arrayName : str
+        'data', 'indices' or 'indptr'
+    """
+    return filePath + '.' + arrayName
+
+
+def writeSparseBeamlets(beamlets, filePath):
+    """
+    Write a SparseBeamlets object in the native format
+
+    Parameters
+    ----------
+    beamlets : SparseBeamlets
+        The beamlets to store. The sparse matrix must be loaded.
+    filePath : str
+        Path of the header file. The raw arrays are written next to it.
+    """
+    matrix = beamlets.toSparseMatrix()
+    if matrix is None:
+        raise ValueError('Beamlet matrix is not loaded and cannot be written to ' + str(filePath))
+    metadata = {
+        'doseOrigin': _toList(beamlets.doseOrigin),
+        'doseSpacing': _toList(beamlets.doseSpacing),
+        'doseGridSize': _toList(beamlets.doseGridSize),
+        'doseOrientation': _toList(beamlets.doseOrientation),
+        'weights': None if beamlets._weights is None else _toList(beamlets._weights),
+        'name': beamlets.name,
+        'seriesInstanceUID': str(beamlets.seriesInstanceUID),
+    }
+    for vectorName, vector in (('voxelIndices', beamlets.voxelIndices), ('spotKeys', beamlets.spotKeys)):
+        metadata[vectorName] = None
+        if not (vector is None):
+            vector = np.ascontiguousarray(vector)
+            vector.tofile(arrayFilePath(filePath, vectorName))
+            metadata[vectorName] = {'dtype': vector.dtype.str, 'length': int(len(vector))}
+    writeSparseMatrix(matrix, filePath, metadata=metadata)
+
+
+def writeSparseMatrix(matrix, filePath, metadata:Optional[dict]=None):
+    """
+    Write a CSC matrix in the native format
+
+    The raw arrays are written first and the header last, so an interrupted write never leaves a valid header pointing
+    to incomplete arrays.
+
+    Parameters
+    ----------
+    matrix : csc_matrix
+        The sparse matrix
+    filePath : str
+        Path of the header file
+    metadata : dict, optional
+        Additional JSON-serializable entries stored in the header
+    """
+    matrix = csc_matrix(matrix)
+    indexDtype = np.int32 if max(matrix.shape[0], matrix.nnz) < np.iinfo(np.int32).max else np.int64
+    arrays = {
+        'data': np.ascontiguousarray(matrix.data, dtype=np.float32),
+        'indices': np.ascontiguousarray(matrix.indices, dtype=indexDtype),
+        'indptr': np.ascontiguousarray(matrix.indptr, dtype=indexDtype),
+    }
+
+    folder = os.path.dirname(filePath)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    for arrayName in _ARRAY_NAMES:
+        arrays[arrayName].tofile(arrayFilePath(filePath, arrayName))
+
+    header = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'shape': [int(matrix.shape[0]), int(matrix.shape[1])],
+        'nnz': int(matrix.nnz),
+        'sortedIndices': bool(matrix.has_sorted_indices),
+        'dtypes': {arrayName: arrays[arrayName].dtype.str for arrayName in _ARRAY_NAMES},
+    }
+    if metadata is not None:
+        header.update(metadata)
+
+    tmpPath = filePath + '.tmp'
+    with open(tmpPath, 'w') as fid:
+        json.dump(header, fid)
+    os.replace(tmpPath, filePath)
+
+
+def readSparseBeamletsHeader(filePath) -> dict:
+    """
+    Read the JSON header of a native sparse beamlets file
+
+    Parameters
+    ----------
+    filePath : str
+        Path of the header file
+
+    Returns
+    -------
+    header : dict
+        The header content
+    """
+    with open(filePath, 'r') as fid:
+        return json.load(fid)
+
+
+def memmapSparseMatrix(filePath, header:Optional[dict]=None) -> csc_matrix:
+    """
+    Open a native sparse beamlets file as a CSC matrix backed by memory-mapped arrays
+
+    The arrays are mapped copy-on-write: in-place modifications stay private to the process and never touch the file.
+
+    Parameters
+    ----------
+    filePath : str
+        Path of the header file
+    header : dict, optional
+        Already parsed header, read from filePath if None
+
+    Returns
+    -------
+    csc_matrix
+        The sparse matrix
+    """
+    if header is None:
+        header = readSparseBeamletsHeader(filePath)
+
+    nRows, nCols = header['shape']
+    lengths = {'data': header['nnz'], 'indices': header['nnz'], 'indptr': nCols + 1}
+    arrays = {}
+    for arrayName in _ARRAY_NAMES:
+        dtype = np.dtype(header['dtypes'][arrayName])
+        if lengths[arrayName] == 0:
+            arrays[arrayName] = np.zeros(0, dtype=dtype)
+        else:
+            arrays[arrayName] = np.memmap(arrayFilePath(filePath, arrayName), dtype=dtype, mode='c',
+                                          shape=(lengths[arrayName],))
+
+    matrix = csc_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=(nRows, nCols), copy=False)
+    if header.get('sortedIndices', False):
+        matrix.has_sorted_indices = True
+    return matrix
+
+
+def memmapVoxelIndices(filePath, header:Optional[dict]=None) -> Optional[np.ndarray]:
+    """
+    Open the row to voxel index map of a native sparse beamlets file whose rows are compacted
+
+    Parameters
+    ----------
+    filePath : str
+        Path of the header file
+    header : dict, optional
+        Already parsed header, read from filePath if None
+
+    Returns
+    -------
+    np.ndarray or None
+        The row to voxel index map, None if the rows span the full dose grid
+    """
+    return _memmapVector(filePath, 'voxelIndices', header)
+
+
+def memmapSpotKeys(filePath, header:Optional[dict]=None) -> Optional[np.ndarray]:
+    """
+    Open the spot identifiers of the columns of a native sparse beamlets file
+
+    Parameters
+    ----------
+    filePath : str
+        Path of the header file
+    header : dict, optional
+        Already parsed header, read from filePath if None
+
+    Returns
+    -------
+    np.ndarray or None
+        One identifier per column, None if the columns are not labelled
+    """
+    return _memmapVector(filePath, 'spotKeys', header)
+
+
+def _memmapVector(filePath, vectorName, header:Optional[dict]=None) -> Optional[np.ndarray]:
+    if header is None:
+        header = readSparseBeamletsHeader(filePath)
+    vector = header.get(vectorName)
+    if vector is None:
+        return None
+    if vector['length'] == 0:
+        return np.zeros(0, dtype=np.dtype(vector['dtype']))
+    return np.memmap(arrayFilePath(filePath, vectorName), dtype=np.dtype(vector['dtype']), mode='r',
+                     shape=(vector['length'],))
+
+
+def sparseBeamletsFilePaths(filePath) -> list:
+    """
+    Paths of all the files (header, raw arrays and optional vectors) that may belong to a native sparse beamlets file
+
+    Parameters
+    ----------
+    filePath : str
+        Path of the header file
+    """
+    return [filePath] + [arrayFilePath(filePath, arrayName) for arrayName in _ARRAY_NAMES + _VECTOR_NAMES]
+
+
+def removeSparseBeamletsFiles(filePath):
+    """
+    Remove the header and raw array files of a native sparse beamlets file
+
+    Parameters
+    ----------
+    filePath : str
+        Path of the header file
+    """
+    for path in sparseBeamletsFilePaths(filePath):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _toList(value):
+    if value is None:
+        return None
+    return np.asarray(value).tolist()
+
+
+class SparseBeamletsIOTestCase(unittest.TestCase):
+    def _createBeamlets(self):
+        from opentps.core.data._sparseBeamlets import SparseBeamlets
+        import scipy.sparse as sp
+
+        beamlets = SparseBeamlets()
+        beamlets.setUnitaryBeamlets(sp.random(60, 8, density=0.2, format='csc', dtype=np.float32, random_state=0))
+        beamlets.doseOrigin = (1., 2., 3.)
+        beamlets.doseSpacing = (2., 2., 2.5)
+        beamlets.doseGridSize = (3, 4, 5)
+        beamlets._weights = np.arange(8, dtype=np.float32)
+        beamlets.spotKeys = np.arange(100, 108, dtype=np.int64)
+        beamlets.seriesInstanceUID = '1.2.3'
+        return beamlets
+
+    def _assertBeamletsEqual(self, beamlets, reference, referenceMatrix):
+        np.testing.assert_array_equal(beamlets.toSparseMatrix().toarray(), referenceMatrix.toarray())
+        self.assertEqual(tuple(beamlets.doseOrigin), tuple(reference.doseOrigin))
+        self.assertEqual(tuple(beamlets.doseSpacing), tuple(reference.doseSpacing))
+        self.assertEqual(tuple(beamlets.doseGridSize), tuple(reference.doseGridSize))
+        np.testing.assert_array_equal(beamlets._weights, reference._weights)
+        np.testing.assert_array_equal(beamlets.spotKeys, reference.spotKeys)
+        self.assertEqual(beamlets.seriesInstanceUID, reference.seriesInstanceUID)
+
+    @staticmethod
+    def _isMemoryMapped(array) -> bool:
+        # scipy wraps the memory-mapped arrays in ndarray views
+        import mmap
+        while not (array is None):
+            if isinstance(array, (np.memmap, mmap.mmap)):
+                return True
+            array = getattr(array, 'base', None)
+        return False
+
+    def testWriteAndMemmapReload(self):
+        import tempfile
+        from opentps.core.io.serializedObjectIO import loadBeamlets
+
+        beamlets = self._createBeamlets()
+        voxelMask = np.zeros(60, dtype=bool)
+        voxelMask[5:40] = True
+        beamlets.compactRows(voxelMask)
+        matrix = beamlets.toSparseMatrix().copy()
+        voxelIndices = np.array(beamlets.voxelIndices)
+
+        with tempfile.TemporaryDirectory() as folder:
+            filePath = os.path.join(folder, 'beamlets')
+            beamlets.storeOnFS(filePath)
+            self.assertTrue(isSparseBeamletsFile(filePath))
+            self.assertIsNone(beamlets._sparseBeamlets)
+
+            loaded = loadBeamlets(filePath)
+            for array in (loaded.toSparseMatrix().data, loaded.toSparseMatrix().indices):
+                self.assertTrue(self._isMemoryMapped(array))
+            self._assertBeamletsEqual(loaded, beamlets, matrix)
+            np.testing.assert_array_equal(loaded.voxelIndices, voxelIndices)
+
+            # The arrays are mapped copy-on-write: in-place changes do not reach the file
+            loaded.scaleColumns(np.full(8, 2., dtype=np.float32))
+            np.testing.assert_allclose(loaded.toSparseMatrix().toarray(), 2 * matrix.toarray())
+            self._assertBeamletsEqual(loadBeamlets(filePath), beamlets, matrix)
+
+    def testLegacyPickle(self):
+        import pickle
+        import tempfile
+        from opentps.core.data._sparseBeamlets import SparseBeamlets
+        from opentps.core.io.serializedObjectIO import loadBeamlets
+
+        beamlets = self._createBeamlets()
+        matrix = beamlets.toSparseMatrix().copy()
+
+        with tempfile.TemporaryDirectory() as folder:
+            filePath = os.path.join(folder, 'beamlets.blm')
+            # Format of the files written by the previous versions of SparseBeamlets.storeOnFS
+            with open(filePath, 'wb') as fid:
+                pickle.dump(beamlets.__dict__, fid, protocol=4)
+            self.assertFalse(isSparseBeamletsFile(filePath))
+
+            self._assertBeamletsEqual(loadBeamlets(filePath), beamlets, matrix)
+
+            unloaded = SparseBeamlets()
+            unloaded._savedBeamletFile = filePath
+            self._assertBeamletsEqual(unloaded, beamlets, matrix)
+
+
+if __name__ == '__main__':
+    unittest.main()
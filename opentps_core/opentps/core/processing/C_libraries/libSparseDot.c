@@ -0,0 +1,72 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <omp.h>
+
+#if defined(_MSC_VER)
+  #define DLLEXPORT_TAG __declspec(dllexport)
+#else
+  #define DLLEXPORT_TAG
+#endif
+
+// Products of a compressed sparse matrix (CSC or CSR) with a vector, with float32 values, int32 minor indices and int64
+// pointers. For a CSC matrix, the major axis is the column axis: Compressed_Gather computes B^T.y and
+// Compressed_Scatter computes B.w. For a CSR matrix, the roles are swapped.
+
+// function declarations
+DLLEXPORT_TAG void Compressed_Gather(int NumMajor, long long *Indptr, int *Indices, float *Data, float *Vector, float *Result, int NumThreads);
+DLLEXPORT_TAG void Compressed_Scatter(int NumMajor, long long *Indptr, int *Indices, float *Data, float *Vector, float *Result, int *MinorBounds, int NumParts, int NumThreads);
+
+
+// function definitions
+
+// Result[j] = sum_k Data[k] * Vector[Indices[k]] for k in [Indptr[j], Indptr[j+1])
+// Each major vector is an independent dot product: the major axis is shared among the threads.
+DLLEXPORT_TAG void Compressed_Gather(int NumMajor, long long *Indptr, int *Indices, float *Data, float *Vector, float *Result, int NumThreads){
+
+  #pragma omp parallel for num_threads(NumThreads) schedule(dynamic, 64)
+  for(int j=0; j<NumMajor; j++){
+    double sum = 0.0;
+    for(long long k=Indptr[j]; k<Indptr[j+1]; k++){
+      sum += (double)Data[k] * Vector[Indices[k]];
+    }
+    Result[j] = (float)sum;
+  }
+}
+
+
+// Result[Indices[k]] += Data[k] * Vector[j] for k in [Indptr[j], Indptr[j+1])
+// The minor axis is split in NumParts ranges [MinorBounds[p], MinorBounds[p+1]), each written by a single thread, so that
+// no atomic operation nor private copy of Result is needed. The minor indices must be sorted within each major vector:
+// each thread finds the start of its range by bisection.
+DLLEXPORT_TAG void Compressed_Scatter(int NumMajor, long long *Indptr, int *Indices, float *Data, float *Vector, float *Result, int *MinorBounds, int NumParts, int NumThreads){
+
+  #pragma omp parallel for num_threads(NumThreads) schedule(dynamic, 1)
+  for(int p=0; p<NumParts; p++){
+
+    int first = MinorBounds[p];
+    int last = MinorBounds[p+1];
+    if(first >= last) continue;
+
+    for(int i=first; i<last; i++) Result[i] = 0.0f;
+
+    for(int j=0; j<NumMajor; j++){
+      float v = Vector[j];
+      if(v == 0.0f) continue;
+
+      long long lo = Indptr[j];
+      long long hi = Indptr[j+1];
+      if(lo == hi || Indices[lo] >= last || Indices[hi-1] < first) continue;
+
+      // first entry with index >= first
+      while(lo < hi){
+        long long mid = lo + (hi - lo) / 2;
+        if(Indices[mid] < first) lo = mid + 1;
+        else hi = mid;
+      }
+
+      for(long long k=lo; k<Indptr[j+1] && Indices[k]<last; k++){
+        Result[Indices[k]] += Data[k] * v;
+      }
+    }
+  }
+}
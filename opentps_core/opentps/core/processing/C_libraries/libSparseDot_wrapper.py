@@ -0,0 +1,250 @@
+import os
+import unittest
+import numpy as np
+import ctypes
+import platform
+import logging
+import scipy.sparse as sp
+
+logger = logging.getLogger(__name__)
+
+_libSparseDot = None
+_libSparseDotLoaded = False
+
+
+def _loadLibrary():
+  global _libSparseDot, _libSparseDotLoaded
+  if _libSparseDotLoaded:
+    return _libSparseDot
+  _libSparseDotLoaded = True
+
+  # No prebuilt library is shipped: it is built from libSparseDot.c by the Makefile, on Linux only
+  if platform.system() != "Linux":
+    logger.info('Native sparse products are only available on Linux (' + platform.system() + ' system): scipy is used instead.')
+    return None
+
+  try:
+    # import C library
+    lib = ctypes.cdll.LoadLibrary(os.path.join(os.path.dirname(__file__), "libSparseDot.so"))
+
+    float_array = np.ctypeslib.ndpointer(dtype=np.float32, flags='C_CONTIGUOUS')
+    int_array = np.ctypeslib.ndpointer(dtype=np.int32, flags='C_CONTIGUOUS')
+    int64_array = np.ctypeslib.ndpointer(dtype=np.int64, flags='C_CONTIGUOUS')
+    lib.Compressed_Gather.argtypes = [ctypes.c_int, int64_array, int_array, float_array, float_array, float_array, ctypes.c_int]
+    lib.Compressed_Gather.restype = ctypes.c_void_p
+    lib.Compressed_Scatter.argtypes = [ctypes.c_int, int64_array, int_array, float_array, float_array, float_array,
+                                       int_array, ctypes.c_int, ctypes.c_int]
+    lib.Compressed_Scatter.restype = ctypes.c_void_p
+    _libSparseDot = lib
+  except:
+    logger.info('Native sparse products not enabled (libSparseDot could not be loaded). Run make in ' + os.path.dirname(__file__) + ' to build it.')
+    _libSparseDot = None
+
+  return _libSparseDot
+
+
+def isAvailable() -> bool:
+  """
+    Returns True if the native sparse product library can be loaded. Always False on Windows and macOS, for which the
+    library is not built.
+  """
+  return not (_loadLibrary() is None)
+
+
+class NativeSparseOperator:
+  """
+    Multithreaded products of a CSC or CSR matrix with a vector, computed by the native library libSparseDot (OpenMP).
+
+    For a CSC matrix B, the transposed product B^T.y is a dot product per column, shared among the threads. The product
+    B.w scatters the columns into the result: the rows are split in ranges holding the same number of non-zero values,
+    each range being written by a single thread. The roles are swapped for a CSR matrix.
+
+    The arrays of the matrix are used without copy when they are already float32 (values), int32 (indices) and sorted.
+    Otherwise the operator keeps a sorted copy: the matrix of the caller is never modified. The indices pointer is
+    converted to int64 once.
+
+    The library is only available on Linux, where it is built with make in opentps/core/processing/C_libraries (see
+    isAvailable).
+
+    Parameters
+    ----------
+    matrix : csc_matrix or csr_matrix
+        Sparse matrix
+    nThreads : int, optional
+        Number of threads. The default is the number of CPUs.
+  """
+  def __init__(self, matrix, nThreads=None):
+    lib = _loadLibrary()
+    if lib is None:
+      raise RuntimeError('libSparseDot is not available')
+    self._lib = lib
+
+    if not (sp.isspmatrix_csc(matrix) or sp.isspmatrix_csr(matrix)):
+      matrix = sp.csc_matrix(matrix)
+    if not matrix.has_sorted_indices:
+      # Sorting in place would write to the arrays of the caller (e.g. copy-on-write memory-mapped beamlets)
+      matrix = matrix.sorted_indices()
+    if matrix.shape[0] >= np.iinfo(np.int32).max or matrix.shape[1] >= np.iinfo(np.int32).max:
+      raise ValueError('Matrix dimensions must fit 32-bit indices')
+
+    self.shape = matrix.shape
+    self.isCSC = sp.isspmatrix_csc(matrix)
+    self.nThreads = nThreads if not (nThreads is None) else (os.cpu_count() or 1)
+
+    self._data = np.ascontiguousarray(matrix.data, dtype=np.float32)
+    self._indices = np.ascontiguousarray(matrix.indices, dtype=np.int32)
+    self._indptr = np.ascontiguousarray(matrix.indptr, dtype=np.int64)
+    self._nMajor = len(self._indptr) - 1
+    self._nMinor = self.shape[0] if self.isCSC else self.shape[1]
+    self._minorBounds = None
+
+  @property
+  def nbytes(self) -> int:
+    return self._data.nbytes + self._indices.nbytes + self._indptr.nbytes
+
+  def _getMinorBounds(self):
+    if self._minorBounds is None:
+      # Minor ranges holding the same number of non-zero values
+      nParts = max(1, min(self.nThreads, self._nMinor))
+      counts = np.cumsum(np.bincount(self._indices, minlength=self._nMinor))
+      targets = np.arange(1, nParts) * (len(self._indices) / nParts)
+      bounds = np.searchsorted(counts, targets, side='left') + 1 if len(counts) else np.zeros(nParts - 1, dtype=np.int64)
+      self._minorBounds = np.ascontiguousarray(np.concatenate(([0], np.minimum(bounds, self._nMinor), [self._nMinor])), dtype=np.int32)
+    return self._minorBounds
+
+  def _gather(self, vector):
+    vector = np.ascontiguousarray(vector, dtype=np.float32)
+    result = np.empty(self._nMajor, dtype=np.float32)
+    self._lib.Compressed_Gather(self._nMajor, self._indptr, self._indices, self._data, vector, result, self.nThreads)
+    return result
+
+  def _scatter(self, vector):
+    vector = np.ascontiguousarray(vector, dtype=np.float32)
+    bounds = self._getMinorBounds()
+    result = np.empty(self._nMinor, dtype=np.float32)
+    self._lib.Compressed_Scatter(self._nMajor, self._indptr, self._indices, self._data, vector, result, bounds,
+                                 len(bounds) - 1, self.nThreads)
+    return result
+
+  def dot(self, vector) -> np.ndarray:
+    """
+      Product of the matrix with a vector
+
+      Parameters
+      ----------
+      vector : numpy.ndarray
+          Vector of length shape[1]
+
+      Returns
+      -------
+      numpy.ndarray
+          float32 vector of length shape[0]
+    """
+    if len(vector) != self.shape[1]:
+      raise ValueError('Dimension mismatch')
+    return self._scatter(vector) if self.isCSC else self._gather(vector)
+
+  def transposeDot(self, vector) -> np.ndarray:
+    """
+      Product of the transposed matrix with a vector
+
+      Parameters
+      ----------
+      vector : numpy.ndarray
+          Vector of length shape[0]
+
+      Returns
+      -------
+      numpy.ndarray
+          float32 vector of length shape[1]
+    """
+    if len(vector) != self.shape[0]:
+      raise ValueError('Dimension mismatch')
+    return self._gather(vector) if self.isCSC else self._scatter(vector)
+
+
+def sparseDot(matrix, vector, nThreads=None) -> np.ndarray:
+  """
+    Product of a sparse matrix with a vector, computed by the native library if available and by scipy otherwise
+
+    Parameters
+    ----------
+    matrix : scipy sparse matrix
+        Sparse matrix
+    vector : numpy.ndarray
+        Vector
+    nThreads : int, optional
+        Number of threads. The default is the number of CPUs.
+
+    Returns
+    -------
+    numpy.ndarray
+        Product of the matrix and the vector
+  """
+  if isAvailable():
+    try:
+      return NativeSparseOperator(matrix, nThreads=nThreads).dot(vector)
+    except ValueError as e:
+      logger.info('Native sparse product not used: ' + str(e))
+  return matrix.dot(vector)
+
+
+class NativeSparseOperatorTestCase(unittest.TestCase):
+  def _assertProductsEqual(self, matrix, nThreads=2):
+    rng = np.random.default_rng(0)
+    w = rng.random(matrix.shape[1]).astype(np.float32)
+    y = rng.random(matrix.shape[0]).astype(np.float32)
+    operator = NativeSparseOperator(matrix, nThreads=nThreads)
+    np.testing.assert_allclose(operator.dot(w), matrix.toarray() @ w, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(operator.transposeDot(y), matrix.toarray().T @ y, rtol=1e-5, atol=1e-5)
+
+  def _randomMatrix(self, shape, density=0.1, seed=1):
+    return sp.random(shape[0], shape[1], density=density, format='csc', dtype=np.float32, random_state=seed)
+
+  @unittest.skipUnless(isAvailable(), 'libSparseDot is not built')
+  def testCSCAndCSR(self):
+    matrix = self._randomMatrix((300, 40))
+    for nThreads in (1, 3, 8):
+      self._assertProductsEqual(matrix.tocsc(), nThreads)
+      self._assertProductsEqual(matrix.tocsr(), nThreads)
+
+  @unittest.skipUnless(isAvailable(), 'libSparseDot is not built')
+  def testUnsortedIndices(self):
+    matrix = self._randomMatrix((200, 30), density=0.2)
+    for unsorted in (matrix.tocsc(), matrix.tocsr()):
+      # Reverse the minor indices of each major vector
+      for j in range(len(unsorted.indptr) - 1):
+        start, stop = unsorted.indptr[j], unsorted.indptr[j + 1]
+        unsorted.indices[start:stop] = unsorted.indices[start:stop][::-1].copy()
+        unsorted.data[start:stop] = unsorted.data[start:stop][::-1].copy()
+      unsorted.has_sorted_indices = False
+      indices = unsorted.indices.copy()
+      self._assertProductsEqual(unsorted, 4)
+      # The matrix of the caller is left as is
+      np.testing.assert_array_equal(unsorted.indices, indices)
+
+  @unittest.skipUnless(isAvailable(), 'libSparseDot is not built')
+  def testEmptyRowsAndColumns(self):
+    matrix = self._randomMatrix((100, 20), density=0.3).tolil()
+    matrix[10:40, :] = 0
+    matrix[:, 5:9] = 0
+    matrix[:, 19] = 0
+    for nThreads in (1, 4):
+      self._assertProductsEqual(matrix.tocsc(), nThreads)
+      self._assertProductsEqual(matrix.tocsr(), nThreads)
+
+  @unittest.skipUnless(isAvailable(), 'libSparseDot is not built')
+  def testEmptyMatrix(self):
+    matrix = sp.csc_matrix((50, 10), dtype=np.float32)
+    self._assertProductsEqual(matrix, 4)
+    self._assertProductsEqual(matrix.tocsr(), 4)
+
+  @unittest.skipUnless(isAvailable(), 'libSparseDot is not built')
+  def testMoreThreadsThanRows(self):
+    matrix = self._randomMatrix((3, 50), density=0.5)
+    self._assertProductsEqual(matrix.tocsc(), 16)
+    self._assertProductsEqual(matrix.tocsr(), 16)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,189 @@
+import hashlib
+import logging
+import os
+from enum import Enum
+from typing import Optional
+
+import numpy as np
+
+from opentps.core.data import SparseBeamlets
+from opentps.core.io import sparseBeamletsIO
+from opentps.core.utils.programSettings import ProgramSettings
+
+logger = logging.getLogger(__name__)
+
+
+class BeamletCache:
+    """
+    Persistent, content-addressed cache of beamlet matrices.
+
+    Beamlets are stored in the native sparse beamlets format under a key hashing all the inputs of the dose engine (CT,
+    calibration, beam model, spots, scoring grid, number of primaries, ROI, ...). Cache hits are returned as memory-mapped
+    SparseBeamlets. The least recently used entries are removed when the cache exceeds its maximum size.
+
+    Attributes
+    ----------
+    folder : str
+        Folder containing the cached beamlets (default: ProgramSettings().beamletCacheFolder)
+    maxSize : int
+        Maximum size of the cache in bytes (default: 20 GB)
+    """
+    FILE_EXTENSION = '.blm'
+
+    def __init__(self, folder:Optional[str]=None, maxSize:int=20 * 1024 ** 3):
+        self.folder = ProgramSettings().beamletCacheFolder if folder is None else folder
+        self.maxSize = maxSize
+        os.makedirs(self.folder, exist_ok=True)
+
+    @staticmethod
+    def computeKey(*inputs) -> str:
+        """
+        Hash the inputs of a beamlet computation
+
+        Parameters
+        ----------
+        inputs
+            Any combination of numbers, strings, arrays, sequences, dicts, images, ROI contours and plain objects
+            (hashed through their attributes)
+
+        Returns
+        -------
+        str
+            The key (hexadecimal SHA-256 digest)
+        """
+        hasher = hashlib.sha256()
+        _updateHash(hasher, inputs, set(), 0)
+        return hasher.hexdigest()
+
+    def filePath(self, key:str) -> str:
+        return os.path.join(self.folder, key + self.FILE_EXTENSION)
+
+    def get(self, key:str) -> Optional[SparseBeamlets]:
+        """
+        Get the beamlets stored under a key
+
+        Parameters
+        ----------
+        key : str
+            Key returned by computeKey
+
+        Returns
+        -------
+        SparseBeamlets or None
+            Memory-mapped beamlets, None if the key is not in the cache
+        """
+        filePath = self.filePath(key)
+        if not sparseBeamletsIO.isSparseBeamletsFile(filePath):
+            return None
+
+        # The modification time of the header records the last use of the entry
+        os.utime(filePath)
+        beamlets = SparseBeamlets()
+        beamlets._savedBeamletFile = filePath
+        beamlets.reloadFromFS()
+        logger.info('Beamlets loaded from cache: {}'.format(filePath))
+        return beamlets
+
+    def put(self, key:str, beamlets:SparseBeamlets):
+        """
+        Store beamlets under a key and evict the least recently used entries if the cache exceeds maxSize
+
+        Parameters
+        ----------
+        key : str
+            Key returned by computeKey
+        beamlets : SparseBeamlets
+            The beamlets to store. They are left loaded in memory.
+        """
+        filePath = self.filePath(key)
+        sparseBeamletsIO.writeSparseBeamlets(beamlets, filePath)
+        logger.info('Beamlets stored in cache: {}'.format(filePath))
+        self._evict(keep=filePath)
+
+    def clear(self):
+        """
+        Remove all the entries of the cache
+        """
+        for filePath, _, _ in self._entries():
+            sparseBeamletsIO.removeSparseBeamletsFiles(filePath)
+
+    @property
+    def size(self) -> int:
+        """
+        Total size of the cache in bytes
+        """
+        return sum(entrySize for _, entrySize, _ in self._entries())
+
+    def _entries(self):
+        entries = []
+        for fileName in os.listdir(self.folder):
+            if not fileName.endswith(self.FILE_EXTENSION):
+                continue
+            filePath = os.path.join(self.folder, fileName)
+            try:
+                lastUse = os.path.getmtime(filePath)
+                entrySize = sum(os.path.getsize(path) for path in sparseBeamletsIO.sparseBeamletsFilePaths(filePath)
+                                if os.path.isfile(path))
+            except OSError:
+                # Removed concurrently
+                continue
+            entries.append((filePath, entrySize, lastUse))
+        return entries
+
+    def _evict(self, keep:Optional[str]=None):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        totalSize = sum(entrySize for _, entrySize, _ in entries)
+        for filePath, entrySize, _ in entries:
+            if totalSize <= self.maxSize:
+                break
+            if filePath == keep:
+                continue
+            logger.info('Evict beamlets from cache: {}'.format(filePath))
+            sparseBeamletsIO.removeSparseBeamletsFiles(filePath)
+            totalSize -= entrySize
+
+
+def _updateHash(hasher, value, visited, depth):
+    if depth > 16:
+        raise ValueError('Beamlet cache key inputs are nested too deeply')
+
+    if value is None:
+        hasher.update(b'None;')
+    elif isinstance(value, (bool, int, float, str, np.generic)):
+        hasher.update('{}:{!r};'.format(type(value).__name__, value).encode())
+    elif isinstance(value, Enum):
+        hasher.update('Enum:{};'.format(value).encode())
+    elif isinstance(value, bytes):
+        hasher.update(b'bytes:' + value + b';')
+    elif isinstance(value, np.ndarray):
+        hasher.update('ndarray:{}:{};'.format(value.dtype.str, value.shape).encode())
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (list, tuple)):
+        hasher.update('seq:{};'.format(len(value)).encode())
+        for item in value:
+            _updateHash(hasher, item, visited, depth + 1)
+    elif isinstance(value, dict):
+        hasher.update('dict:{};'.format(len(value)).encode())
+        for itemKey in sorted(value.keys(), key=str):
+            _updateHash(hasher, str(itemKey), visited, depth + 1)
+            _updateHash(hasher, value[itemKey], visited, depth + 1)
+    elif hasattr(value, 'imageArray'):
+        # Images (CT, masks): content and geometry only
+        hasher.update('image:{};'.format(value.__class__.__name__).encode())
+        for item in (value.imageArray, value.origin, value.spacing, getattr(value, 'angles', None)):
+            _updateHash(hasher, None if item is None else np.asarray(item), visited, depth + 1)
+    elif hasattr(value, 'polygonMesh'):
+        # ROI contours
+        hasher.update(b'contour;')
+        _updateHash(hasher, [np.asarray(polygon) for polygon in value.polygonMesh], visited, depth + 1)
+    elif hasattr(value, '__dict__'):
+        if id(value) in visited:
+            hasher.update(b'visited;')
+            return
+        visited.add(id(value))
+        hasher.update('object:{};'.format(value.__class__.__name__).encode())
+        attributes = {name: attribute for name, attribute in vars(value).items()
+                      if name != 'patient' and not callable(attribute) and not name.endswith('Signal')}
+        _updateHash(hasher, attributes, visited, depth + 1)
+    else:
+        hasher.update('{}:{!r};'.format(type(value).__name__, value).encode())
@@ -179,11 +179,40 @@ def shiftBeamlets(sparseBeamlets, gridSize,  scenarioShift_voxel, beamletAngles_
     return shiftBeamlets_cpp(sparseBeamlets, gridSize,  scenarioShift_voxel, beamletAngles_rad)
 
 
+def _loadShiftBeamletsLibrary():
+    """
+    Load the compiled shiftBeamlets library, None if it is not available on this machine
+    """
+    if platform.system() == "Linux":
+        libPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shiftBeamlets.so")
+    elif platform.system() == "Windows":
+        libPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shiftBeamlets.dll")
+    else:
+        return None
+    try:
+        return ctypes.cdll.LoadLibrary(libPath)
+    except OSError as e:
+        logger.warning('Could not load {}: {}'.format(libPath, e))
+        return None
+
+
+def _canonicalBeamlets(sparseBeamlets):
+    """
+    CSC copy of the beamlets without explicit zeros and with sorted row indices, as expected by the shift kernels
+    """
+    beamlets = csc_matrix(sparseBeamlets, dtype=np.float32, copy=True)
+    beamlets.sum_duplicates()
+    beamlets.eliminate_zeros()
+    return beamlets
+
+
 def shiftBeamlets_cpp(sparseBeamlets, gridSize,  scenarioShift_voxel, beamletAngles_rad):
     """
     Shift the beamlets in the dose influence matrix for a given setup error.
     This would be equivalent to recalculating the dose distribution for a given setup error.
     This function is executed in c++ to gain speed and parallelize the process over different threads.
+    The shifted matrix is assembled directly from the output buffers of the c++ kernel. If the compiled library cannot
+    be loaded, shiftBeamlets_numpy is used instead.
     ----------
     sparseBeamlets : sp.csc_matrix
         Sparse matrix of the beamlets
@@ -198,11 +227,11 @@ def shiftBeamlets_cpp(sparseBeamlets, gridSize,  scenarioShift_voxel, beamletAng
     sp.csc_matrix
         Sparse matrix of the shifted beamlets
     """   
-    if platform.system() == "Linux":
-        lib = ctypes.cdll.LoadLibrary(os.path.join(os.path.dirname(os.path.abspath(__file__)), "shiftBeamlets.so"))
-    elif platform.system() == "Windows":
-        lib = ctypes.cdll.LoadLibrary(os.path.join(os.path.dirname(os.path.abspath(__file__)), "shiftBeamlets.dll"))
-    
+    lib = _loadShiftBeamletsLibrary()
+    if lib is None:
+        logger.warning('Compiled shiftBeamlets library not available, using the NumPy implementation')
+        return shiftBeamlets_numpy(sparseBeamlets, gridSize, scenarioShift_voxel, beamletAngles_rad)
+
     # Define the argument types and return types for the C++ function
     lib.shiftBeamlets.argtypes = [
         np.ctypeslib.ndpointer(dtype=np.float32, ndim=1, flags='C_CONTIGUOUS'),
@@ -220,41 +249,162 @@ def shiftBeamlets_cpp(sparseBeamlets, gridSize,  scenarioShift_voxel, beamletAng
     scenarioShift_voxel[2]*=-1 ### To have the setup error in LPS. Check because some signs problem
     scenarioShift_voxel[1]*=-1 ### To have the setup error in LPS. Check because some signs problem
     gridSize = np.array(gridSize, dtype=np.int32)
-    BeamletMatrix = []
-    
-    length = sparseBeamlets.shape[0]
-    nonZeroIndexes = sparseBeamlets.nonzero()
-    nonZeroValues = np.array(sparseBeamlets[nonZeroIndexes], dtype= np.float32)[0]
-    nonZeroIndexes_beamlet = np.array(nonZeroIndexes[0], dtype= np.int32)
-    indexes_beamlet = np.array(nonZeroIndexes[1], dtype= np.int32)
-    arg = np.argsort(indexes_beamlet)
-    
-    indexes_beamlet = indexes_beamlet[arg]
-    nonZeroIndexes_beamlet = nonZeroIndexes_beamlet[arg]
-    nonZeroValues = nonZeroValues[arg]
-    indexesChangeBeamlet = [0] + find_change_indices(indexes_beamlet) + [len(indexes_beamlet)]
-    NumberOfElements = len(nonZeroValues)
-    nonZeroValues = np.array(nonZeroValues, dtype=np.float32)
-    nonZeroIndexes_beamlet = np.array(nonZeroIndexes_beamlet, dtype=np.int32)
-    indexesChangeBeamlet = np.array(indexesChangeBeamlet, dtype=np.int32)
+
+    # The CSC arrays are the kernel inputs: values and row indexes of each beamlet are contiguous and indptr gives the
+    # beamlet boundaries
+    beamlets = _canonicalBeamlets(sparseBeamlets)
+    nonZeroValues = np.ascontiguousarray(beamlets.data, dtype=np.float32)
+    nonZeroIndexes_beamlet = np.ascontiguousarray(beamlets.indices, dtype=np.int32)
+    indexesChangeBeamlet = np.ascontiguousarray(beamlets.indptr, dtype=np.int32)
     scenarioShift_voxel = np.array(scenarioShift_voxel, dtype=np.float32)
-    
-    nonZeroValuesShifted = np.zeros(NumberOfElements * 2 * 3).astype(np.float32)
-    nonZeroIndexesShifted = np.zeros(NumberOfElements * 2 * 3).astype(np.int32)
+
+    # The kernel writes the shifted entries of a beamlet starting at 6 times the position of its first entry
+    NumberOfElements = len(nonZeroValues)
+    nonZeroValuesShifted = np.zeros(NumberOfElements * 2 * 3, dtype=np.float32)
+    nonZeroIndexesShifted = np.zeros(NumberOfElements * 2 * 3, dtype=np.int32)
     beamletAngles_rad = np.array(beamletAngles_rad, dtype=np.float32)
     nOfBeamlets = len(beamletAngles_rad)
     lib.shiftBeamlets(nonZeroValues, nonZeroValuesShifted, nonZeroIndexes_beamlet, nonZeroIndexesShifted, indexesChangeBeamlet, scenarioShift_voxel, gridSize, beamletAngles_rad, nOfBeamlets, numThreads)
-    
-    for i in range(nOfBeamlets):
-        start = indexesChangeBeamlet[i]
-        end = indexesChangeBeamlet[i+1]
-        indexes = nonZeroIndexesShifted[start*2*3:end*2*3]
-        values = nonZeroValuesShifted[start*2*3:end*2*3]
-        indexes = indexes[indexes.nonzero()]
-        values = values[values.nonzero()]
-        BeamletMatrix.append(sp.csc_matrix((values, (indexes, np.zeros(len(indexes)))), shape=(length,1), dtype=np.float32))
-        
-    return sp.hstack(BeamletMatrix, format='csc')
+
+    return _shiftedSlotsToMatrix(nonZeroIndexesShifted, nonZeroValuesShifted, beamlets.indptr, beamlets.shape, 2 * 3)
+
+
+def _shiftedSlotsToMatrix(indexes, values, indptr, shape, slotsPerEntry):
+    """
+    Build the CSC matrix of the shifted beamlets from fixed-size output slots: beamlet i owns the slots
+    [slotsPerEntry * indptr[i], slotsPerEntry * indptr[i+1]) and unused slots hold a zero value.
+    Entries shifted outside of the grid are dropped.
+    """
+    keep = (values != 0) & (indexes >= 0) & (indexes < shape[0])
+    keptBefore = np.zeros(len(keep) + 1, dtype=np.int64)
+    np.cumsum(keep, out=keptBefore[1:])
+    newIndptr = keptBefore[np.asarray(indptr, dtype=np.int64) * slotsPerEntry]
+
+    matrix = csc_matrix((values[keep], indexes[keep], newIndptr), shape=shape)
+    matrix.sum_duplicates()
+    return matrix
+
+
+def shiftBeamlets_numpy(sparseBeamlets, gridSize,  scenarioShift_voxel, beamletAngles_rad):
+    """
+    Shift the beamlets in the dose influence matrix for a given setup error.
+    Pure NumPy implementation of shiftBeamlets_cpp, vectorized over all the non-zero entries of the matrix, for machines
+    where the compiled library cannot be loaded.
+    ----------
+    sparseBeamlets : sp.csc_matrix
+        Sparse matrix of the beamlets
+    gridSize : np.array
+        Size of the grid
+    scenarioShift_voxel : np.array
+        Setup error in voxels
+    beamletAngles_rad : np.array
+        Angles of the beamlets in radians
+    Returns
+    -------
+    sp.csc_matrix
+        Sparse matrix of the shifted beamlets
+    """
+    scenarioShift_voxel[2]*=-1 ### To have the setup error in LPS. Check because some signs problem
+    scenarioShift_voxel[1]*=-1 ### To have the setup error in LPS. Check because some signs problem
+    gridSize = np.array(gridSize, dtype=np.int64)
+    strides = np.array([1, gridSize[0], gridSize[0] * gridSize[1]], dtype=np.int64)
+
+    beamlets = _canonicalBeamlets(sparseBeamlets)
+    nVoxels, nBeamlets = beamlets.shape
+    counts = np.diff(beamlets.indptr)
+    columns = np.repeat(np.arange(nBeamlets, dtype=np.int64), counts)
+    rows = beamlets.indices.astype(np.int64)
+    values = beamlets.data
+    # Entries are sorted by beamlet then by voxel: keys allow to look up the neighbours of an entry in its beamlet
+    keys = columns * nVoxels + rows
+
+    # Setup error projected for each beamlet, rounded to the third digit (half away from zero) and split into integer
+    # and fractional parts
+    setup = np.array(scenarioShift_voxel, dtype=np.float32).astype(np.float64)
+    angles = np.array(beamletAngles_rad, dtype=np.float32).astype(np.float64)
+    projected = setup[0] * np.cos(angles) - setup[1] * np.sin(angles)
+    correctedShift = np.stack([projected * np.cos(angles), projected * np.sin(angles), np.full(len(angles), setup[2])], axis=1)
+    correctedShift = np.sign(correctedShift) * np.floor(np.abs(correctedShift) * 1000.0 + 0.5) / 1000.0
+    truncatedShift = np.trunc(correctedShift)
+    fractionalShift = correctedShift - truncatedShift
+    shiftTruncated = truncatedShift.astype(np.int64) @ strides
+    fractionalSum = np.abs(fractionalShift).sum(axis=1)
+
+    entryShift = shiftTruncated[columns]
+    interpolated = (fractionalSum != 0)[columns]
+
+    # Beamlets shifted by a whole number of voxels
+    outRows = [rows[~interpolated] + entryShift[~interpolated]]
+    outColumns = [columns[~interpolated]]
+    outValues = [values[~interpolated]]
+
+    # Other beamlets: linear interpolation along each axis with a fractional shift, weighted by its magnitude
+    interpolatedRows = []
+    interpolatedColumns = []
+    interpolatedValues = []
+    for axis in range(3):
+        axisShift = fractionalShift[:, axis]
+        selected = interpolated & (axisShift != 0)[columns]
+        if not np.any(selected):
+            continue
+        c = columns[selected]
+        r = rows[selected]
+        v1 = values[selected]
+        f = axisShift[c]
+        weight = (np.abs(f) / fractionalSum[c]).astype(np.float32)
+        shiftValue = np.mod(f, 1).astype(np.float32)
+        direction = np.sign(f).astype(np.int64) * strides[axis]
+
+        v0 = _lookUpBeamletValues(keys, values, c, r - direction, nVoxels)
+        v2 = _lookUpBeamletValues(keys, values, c, r + direction, nVoxels)
+
+        value0 = ((v1 - v0) * (1 - shiftValue) + v0) * weight
+        value0[v0 != 0] /= 2
+        value1 = ((v2 - v1) * (1 - shiftValue) + v1) * weight
+        value1[v2 != 0] /= 2
+
+        shiftedRows = r + entryShift[selected]
+        interpolatedRows += [shiftedRows, shiftedRows + direction]
+        interpolatedColumns += [c, c]
+        interpolatedValues += [value0, value1]
+
+    if len(interpolatedRows) > 0:
+        interpolatedRows = np.concatenate(interpolatedRows)
+        interpolatedColumns = np.concatenate(interpolatedColumns)
+        interpolatedValues = np.concatenate(interpolatedValues)
+        inGrid = (interpolatedRows >= 0) & (interpolatedRows < nVoxels)
+        accumulated = csc_matrix((interpolatedValues[inGrid], (interpolatedRows[inGrid], interpolatedColumns[inGrid])),
+                                 shape=(nVoxels, nBeamlets), dtype=np.float32)
+        accumulated.sum_duplicates()
+        # Same threshold as the accumulated image of the c++ kernel
+        accumulated.data[accumulated.data <= 1e-7] = 0
+        accumulated.eliminate_zeros()
+        accumulated = accumulated.tocoo()
+        outRows.append(accumulated.row.astype(np.int64))
+        outColumns.append(accumulated.col.astype(np.int64))
+        outValues.append(accumulated.data)
+
+    outRows = np.concatenate(outRows)
+    outColumns = np.concatenate(outColumns)
+    outValues = np.concatenate(outValues)
+    keep = (outValues != 0) & (outRows >= 0) & (outRows < nVoxels)
+    return csc_matrix((outValues[keep], (outRows[keep], outColumns[keep])), shape=(nVoxels, nBeamlets), dtype=np.float32)
+
+
+def _lookUpBeamletValues(keys, values, columns, rows, nVoxels):
+    """
+    Values of the entries (columns, rows) in a canonical CSC matrix given by its sorted keys (column * nVoxels + row),
+    0 for entries that are not stored
+    """
+    result = np.zeros(len(rows), dtype=np.float32)
+    valid = (rows >= 0) & (rows < nVoxels)
+    targets = columns[valid] * nVoxels + rows[valid]
+    positions = np.searchsorted(keys, targets)
+    found = positions < len(keys)
+    found[found] = keys[positions[found]] == targets[found]
+    validIndexes = np.flatnonzero(valid)
+    result[validIndexes[found]] = values[positions[found]]
+    return result
 
 
 def dnorm(x, mu, sd):
@@ -268,11 +418,11 @@ def adjustDoseToScenario(scenario, nominal, plan: PhotonPlan): ### Shift beamlet
         weights = nominal._weights
         doseGridSize = nominal.doseGridSize
         dose = np.zeros(doseGridSize)
-        sizeImage = nominal._sparseBeamlets.shape[0]
-        nofBeamlets = nominal._sparseBeamlets.shape[1]
+        sizeImage = nominal.toSparseMatrix().shape[0]
+        nofBeamlets = nominal.toSparseMatrix().shape[1]
         assert nofBeamlets==len(plan.beamlets), f"The number of beamlets in the dose influece matrix is {nofBeamlets} but the number of beamlets in the treatment plan is {len(plan.beamlets)}"
         for segment in plan.beamSegments:
-            beamletsSegment = nominal._sparseBeamlets[:, cumulativeNumberBeamlets: cumulativeNumberBeamlets + len(segment)]
+            beamletsSegment = nominal.toSparseMatrix()[:, cumulativeNumberBeamlets: cumulativeNumberBeamlets + len(segment)]
             weightsSegment = weights[cumulativeNumberBeamlets: cumulativeNumberBeamlets + len(segment)]
             result = csc_matrix.dot(beamletsSegment, weightsSegment).reshape(sizeImage,1)
             result = np.reshape(result, doseGridSize, order='F')
@@ -10,6 +10,7 @@ import scipy as sp
 import time
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional, Sequence, Union
 from typing import Optional, Sequence, Union, Dict, Any
@@ -17,6 +18,7 @@ from typing import Optional, Sequence, Union, Dict, Any
 from opentps.core.data.images import DoseImage
 from opentps.core.data import SparseBeamlets
 from opentps.core.processing.doseCalculation.abstractDoseCalculator import AbstractDoseCalculator
+from opentps.core.processing.doseCalculation.beamletCache import BeamletCache
 from opentps.core.utils.programSettings import ProgramSettings
 from opentps.core.data.CTCalibrations._abstractCTCalibration import AbstractCTCalibration
 from opentps.core.data.images import CTImage
@@ -67,6 +69,9 @@ class CCCDoseCalculator(AbstractDoseCalculator):
         Path to the directory where the opentps code was cloned
     self.ROFolder : str
         Name of the folder where robust scenarios are stored
+    beamletCache : BeamletCache
+        If set, computeBeamlets returns the cached beamlets when it was already called with the same inputs and caches
+        the beamlets it computes (default: None)
         
     """
     def __init__(self, batchSize=1, simulationDir=None):
@@ -99,6 +104,8 @@ class CCCDoseCalculator(AbstractDoseCalculator):
         self.WorkSpaceDir = os.path.abspath(os.path.join(current_dir, os.pardir, os.pardir, os.pardir, os.pardir, os.pardir))
         self.ROFolder = ''
 
+        self.beamletCache: Optional[BeamletCache] = None
+
     @property
     def _CCCSimuDir(self):
         if self._simulationDirOverride is not None:
@@ -253,7 +260,17 @@ class CCCDoseCalculator(AbstractDoseCalculator):
         if os.path.isdir(dirPath):
             shutil.rmtree(dirPath)
 
-    def _startCCC(self, opti=False):
+    def _startCCC(self, opti=False, batchFinishedCallback=None):
+        """
+        Run the CCC batches as subprocesses and wait for them to finish
+
+        Parameters
+        ----------
+        opti : bool
+            Run the optimization executables
+        batchFinishedCallback : callable, optional
+            Called with the batch index as soon as the subprocess of this batch has finished (in completion order)
+        """
         if len(self._subprocess) > 0:
             raise Exception("CCC already running")
 
@@ -274,16 +291,14 @@ class CCCDoseCalculator(AbstractDoseCalculator):
                         self._subprocess.append(subprocess.Popen(["sh", 'CCC_simulation_batch{}'.format(batch)], cwd=self._executableDir, stdout=out_handles[batch], stderr=err_handles[batch]))
                     else:
                         self._subprocess.append(subprocess.Popen(["sh", 'CCC_simulation_opti_batch{}'.format(batch)], cwd=self._executableDir, stdout=out_handles[batch], stderr=err_handles[batch]))
-                for process in self._subprocess:
-                    process.wait()
+                self._waitForBatches(batchFinishedCallback)
             if platform.system() == "Windows":
                 for batch in range(self.batchSize):
                     if not opti:
                         self._subprocess.append(subprocess.Popen(os.path.join(self._executableDir,'CCC_simulation_batch{}.bat'.format(batch)), cwd=self._executableDir, stdout=out_handles[batch], stderr=err_handles[batch]))
                     else:
                         self._subprocess.append(subprocess.Popen(os.path.join(self._executableDir, 'CCC_simulation_opti_batch{}.bat'.format(batch)), cwd=self._executableDir, stdout=out_handles[batch], stderr=err_handles[batch]))
-                for process in self._subprocess:
-                    process.wait()
+                self._waitForBatches(batchFinishedCallback)
         finally:
             for f in out_handles + err_handles:
                 f.close()
@@ -294,10 +309,44 @@ class CCCDoseCalculator(AbstractDoseCalculator):
         self._subprocess = []
 
 
-    def _importBeamlets(self):
-        beamletDose = CCCdoseEngineIO.readBeamlets(os.path.join(self._ctDirName, 'CT_HeaderFile.txt'), self.outputDir, self.batchSize, self._roi)
+    def _waitForBatches(self, batchFinishedCallback=None):
+        if batchFinishedCallback is None:
+            for process in self._subprocess:
+                process.wait()
+            return
+
+        remainingBatches = list(range(len(self._subprocess)))
+        while len(remainingBatches) > 0:
+            for batch in list(remainingBatches):
+                if not (self._subprocess[batch].poll() is None):
+                    remainingBatches.remove(batch)
+                    if not self._subprocessKilled:
+                        batchFinishedCallback(batch)
+            if len(remainingBatches) > 0:
+                time.sleep(0.05)
+
+    def _importBeamlets(self, batches=None):
+        beamletDose = CCCdoseEngineIO.readBeamlets(os.path.join(self._ctDirName, 'CT_HeaderFile.txt'), self.outputDir, self.batchSize, self._roi, batches=batches)
         return beamletDose
 
+    def _runCCCAndImportBeamlets(self):
+        """
+        Run the CCC batches and read each batch file in a worker thread as soon as its subprocess has finished, so that
+        reading overlaps with the batches still running
+        """
+        header = CCCdoseEngineIO.read_header(os.path.join(self._ctDirName, 'CT_HeaderFile.txt'))
+        roiVector = CCCdoseEngineIO.roiToVector(self._roi)
+        futures = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(self.batchSize, os.cpu_count() or 1))) as executor:
+            def readBatch(batch):
+                logger.info('Read binary file: {}'.format(CCCdoseEngineIO.batchFilePath(self.outputDir, batch)))
+                futures[batch] = executor.submit(CCCdoseEngineIO.read_sparse_data, CCCdoseEngineIO.batchFilePath(self.outputDir, batch), header, roiVector)
+
+            self._startCCC(batchFinishedCallback=readBatch)
+            batches = [futures[batch].result() for batch in range(self.batchSize)]
+
+        return self._importBeamlets(batches=batches)
+
     def _importDose(self):
         beamletDose = CCCdoseEngineIO.readDose(os.path.join(self._ctDirName, 'CT_HeaderFile.txt'), self.outputDir, self.batchSize, self._plan.beamletMUs)
         return beamletDose
@@ -367,16 +416,24 @@ class CCCDoseCalculator(AbstractDoseCalculator):
                     mask = contour
                 self._roi.append(mask)
 
-        self._cleanDir(self.outputDir)
-        self._cleanDir(self._executableDir)
-        self._cleanDir(self._beamDirectory)
-        self._writeFilesToSimuDir()
-        self.writeExecuteCCCfile()
-        self._startCCC()
-
-        beamletDose = self._importBeamlets()
-
-        nbOfBeamlets = beamletDose._sparseBeamlets.shape[1]
+        cacheKey = None
+        beamletDose = None
+        if not (self.beamletCache is None):
+            self._plan.simplify() # as done when writing the plan, so that the beamlets match the cached ones
+            cacheKey = self._beamletCacheKey()
+            beamletDose = self.beamletCache.get(cacheKey)
+
+        if beamletDose is None:
+            self._cleanDir(self.outputDir)
+            self._cleanDir(self._executableDir)
+            self._cleanDir(self._beamDirectory)
+            self._writeFilesToSimuDir()
+            self.writeExecuteCCCfile()
+            beamletDose = self._runCCCAndImportBeamlets()
+            if not (cacheKey is None):
+                self.beamletCache.put(cacheKey, beamletDose)
+
+        nbOfBeamlets = beamletDose.shape[1]
         assert(nbOfBeamlets==len(self._plan.beamlets))
         beamletDose.beamletAngles_rad = self._plan.beamletsAngle_rad
 
@@ -392,6 +449,20 @@ class CCCDoseCalculator(AbstractDoseCalculator):
         return beamletDose
 
 
+    def _beamletCacheKey(self) -> str:
+        beams = []
+        for beam in self._plan.beams:
+            beams.append((beam.SAD_mm, np.asarray(beam.isocenterPosition_mm)))
+            for segment in beam.beamSegments:
+                beams.append((segment.gantryAngle_degree, segment.couchAngle_degree, segment.beamLimitingDeviceAngle_degree,
+                              segment.xBeamletSpacing_mm, segment.yBeamletSpacing_mm, np.asarray(segment.beamletsXY_mm)))
+
+        kernelsDir = self.getKernelDirectory()
+        kernels = [(fileName, os.path.getsize(os.path.join(kernelsDir, fileName))) for fileName in sorted(os.listdir(kernelsDir))]
+
+        # self._ct already holds the densities, i.e. the HU calibration and overrides are accounted for
+        return BeamletCache.computeKey('CCC', self._ct, beams, kernels, self.overwriteOutsideROI, self._roi)
+
     def computeRobustScenarioBeamlets(self, ct: CTImage, plan: PhotonPlan, roi: Sequence[Union[ROIContour, ROIMask]] = None, overRidingList: Sequence[Dict[str, Any]] = None, robustMode = "Shift", computeNominal = True, storePath:Optional[str] = None) -> SparseBeamlets:
         """
         Compute beamlets for different scenarios using Collapse Cone Convolution algorithm. The beamlets are saved in plan.planDesign.robustness
@@ -480,10 +551,10 @@ class CCCDoseCalculator(AbstractDoseCalculator):
             if nominal == None:
                 KeyError('To calculate the robust scenarios beamlets in precise mode it is necessary the nominal beamlets')
 
-            nbOfBeamlets = nominal._sparseBeamlets.shape[1]
+            nbOfBeamlets = nominal.toSparseMatrix().shape[1]
             assert(nbOfBeamlets==len(self._plan.beamlets))
 
-            BeamletMatrix = shiftBeamlets(nominal._sparseBeamlets, nominal.doseGridSize, scenarioShift_voxel, self._plan.beamletsAngle_rad) ### Implement the convolutions in case of sre in GPU look at shiftBeamlets
+            BeamletMatrix = shiftBeamlets(nominal.toSparseMatrix(), nominal.doseGridSize, scenarioShift_voxel, self._plan.beamletsAngle_rad) ### Implement the convolutions in case of sre in GPU look at shiftBeamlets
             beamletsScenario = SparseBeamlets()
             beamletsScenario.setUnitaryBeamlets(BeamletMatrix)
             beamletsScenario.doseOrigin = nominal.doseOrigin
@@ -613,7 +684,7 @@ class CCCDoseCalculator(AbstractDoseCalculator):
 
         elif mode == "Shift":
             nominal.doseSpacing = self._ct.spacing
-            nbOfBeamlets = nominal._sparseBeamlets.shape[1]
+            nbOfBeamlets = nominal.toSparseMatrix().shape[1]
             assert(nbOfBeamlets==len(self._plan.beamlets))
             DoseScenario = adjustDoseToScenario(scenario, nominal, self._plan)
 
@@ -1,5 +1,6 @@
 
 import copy
+import hashlib
 import logging
 import math
 import os
@@ -7,6 +8,9 @@ import sys
 import platform
 import shutil
 import subprocess
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional, Sequence, Union, Tuple
 import matplotlib.pyplot as plt
@@ -17,6 +21,7 @@ from opentps.core.data.MCsquare import MCsquareConfig
 from opentps.core.data import SparseBeamlets
 from opentps.core.processing.planEvaluation.robustnessEvaluation import RobustnessEvalProton
 from opentps.core.processing.doseCalculation.abstractDoseInfluenceCalculator import AbstractDoseInfluenceCalculator
+from opentps.core.processing.doseCalculation.beamletCache import BeamletCache
 from opentps.core.processing.doseCalculation.protons.abstractMCDoseCalculator import AbstractMCDoseCalculator
 from opentps.core.processing.imageProcessing import resampler3D
 from opentps.core.utils.programSettings import ProgramSettings
@@ -86,6 +91,15 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
         Sparse dose file path
     _sparseDoseScenarioToRead : int
         Sparse dose scenario to read
+    scenarioImportWorkers : int
+        Maximum number of robust scenarios imported concurrently by computeRobustScenarioBeamlets
+        (default: min(4, number of CPUs))
+    scenarioImportMemoryBudget : int
+        Maximum number of bytes used at once by concurrent scenario imports, None for no limit (default: None).
+        A scenario larger than the budget is still imported, alone.
+    beamletCache : BeamletCache
+        If set, computeBeamlets returns the cached beamlets when it was already called with the same inputs and caches
+        the beamlets it computes (default: None). Not used for LET and robust scenario computations.
     """
     def __init__(self):
         AbstractMCDoseCalculator.__init__(self)
@@ -125,18 +139,28 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
 
         self._sparseDoseScenarioToRead = None
 
+        self.scenarioImportWorkers = min(4, os.cpu_count() or 1)
+        self.scenarioImportMemoryBudget = None
+
+        self.beamletCache: Optional[BeamletCache] = None
+
     @property
     def _sparseDoseFilePath(self):
         if (self._plan.planDesign is None) or self._plan.planDesign.robustness.selectionStrategy==self._plan.planDesign.robustness.Strategies.DISABLED:
             return os.path.join(self._workDir, "Sparse_Dose.txt")
         elif self._sparseDoseScenarioToRead==None:
             return os.path.join(self._workDir, "Sparse_Dose_Nominal.txt")
-        elif self._plan.planDesign.robustness.Mode4D == self._plan.planDesign.robustness.Mode4D.MCsquareSystematic :
-            return os.path.join(self._workDir, "Sparse_Dose_Scenario_" + str(self._sparseDoseScenarioToRead + 1) + "-" + str(
-                self._plan.planDesign.robustness.numScenarios) + "_Phase" + str(self.phase) + ".txt")
         else:
-            return os.path.join(self._workDir, "Sparse_Dose_Scenario_" + str(self._sparseDoseScenarioToRead + 1) + "-" + str(
-                self._plan.planDesign.robustness.numScenarios) + ".txt")
+            return os.path.join(self._workDir, "Sparse_Dose_" + self._scenarioName(self._sparseDoseScenarioToRead, self._phase) + ".txt")
+
+    def _scenarioName(self, scenarioIndex:int, phase:int=0) -> str:
+        """
+        Name of an error scenario (and of a phase in 4D systematic mode) in MCsquare output and stored beamlet files
+        """
+        scenarioName = "Scenario_" + str(scenarioIndex + 1) + "-" + str(self._plan.planDesign.robustness.numScenarios)
+        if self._plan.planDesign.robustness.Mode4D == self._plan.planDesign.robustness.Mode4D.MCsquareSystematic:
+            scenarioName += "_Phase" + str(phase)
+        return scenarioName
 
 
     @property
@@ -467,6 +491,15 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
             planDesign.targetMask = roi
             planDesign.scoringVoxelSpacing = self.scoringVoxelSpacing
             self._plan.planDesign = planDesign
+
+        cacheKey = None
+        if self._useBeamletCache():
+            cacheKey = self._beamletCacheKey()
+            beamletDose = self.beamletCache.get(cacheKey)
+            if not (beamletDose is None):
+                if beamletDose.spotKeys is None:
+                    beamletDose.spotKeys = _spotKeys(self._plan)
+                return beamletDose
             
         self._config = self._beamletComputationConfig
 
@@ -479,8 +512,106 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
             self._startMCsquare()
             beamletDose = self._importBeamlets()
 
+        beamletDose.spotKeys = _spotKeys(self._plan)
+
+        if not (cacheKey is None):
+            self.beamletCache.put(cacheKey, beamletDose)
+
         return beamletDose
 
+    def computeBeamletsIncremental(self, ct: CTImage, plan: ProtonPlan, previousBeamlets: SparseBeamlets,
+                                   roi: Optional[Sequence[Union[ROIContour, ROIMask]]] = None) -> SparseBeamlets:
+        """
+        Update beamlets after a change of the spot map: only the spots of plan that are not in previousBeamlets are
+        simulated, the beamlets of the spots that are no longer in plan are dropped and the remaining columns are reused
+        as they are. Spots are matched on their beam geometry, energy, range shifter and position.
+
+        Parameters
+        ----------
+        ct : CTImage
+            CT image of the patient
+        plan : ProtonPlan
+            RT plan with the new spot map
+        previousBeamlets : SparseBeamlets
+            Beamlets computed by computeBeamlets with the same CT, beam model and scoring grid
+        roi : Optional[Sequence[Union[ROIContour, ROIMask]]], optional
+            ROI contours or masks on which the new beamlets will be cropped at import, by default None
+
+        Returns
+        -------
+        beamletDose:SparseBeamlets
+            Beamlets of all the spots of plan, in plan order
+        """
+        if previousBeamlets.spotKeys is None:
+            raise ValueError('Previous beamlets have no spot keys and cannot be updated incrementally')
+
+        newPlan = copy.deepcopy(plan)
+        newPlan.simplify(threshold=None)
+        keys = _spotKeys(newPlan)
+
+        previousKeys = np.asarray(previousBeamlets.spotKeys)
+        previousColumns = _matchKeys(keys, previousKeys)
+        isNew = previousColumns < 0
+        nReused = int(np.count_nonzero(~isNew))
+        logger.info('Incremental beamlet computation: {} spots reused, {} new, {} removed'.format(
+            nReused, int(np.count_nonzero(isNew)), len(previousKeys) - nReused))
+
+        matrices = [previousBeamlets.toSparseMatrix()]
+        sources = np.zeros(len(keys), dtype=np.int64)
+        columns = previousColumns.copy()
+
+        if np.any(isNew):
+            newPlan.spotMUs = isNew.astype(float)
+            newPlan.simplify(threshold=0.5)
+            newBeamlets = self.computeBeamlets(ct, newPlan, roi)
+
+            if tuple(newBeamlets.doseGridSize) != tuple(previousBeamlets.doseGridSize) \
+                    or not np.allclose(newBeamlets.doseOrigin, previousBeamlets.doseOrigin) \
+                    or not np.allclose(newBeamlets.doseSpacing, previousBeamlets.doseSpacing):
+                raise ValueError('Previous beamlets were computed on a different dose grid')
+
+            if previousBeamlets.hasCompactRows:
+                voxelMask = np.zeros(previousBeamlets.numberOfVoxels, dtype=bool)
+                voxelMask[previousBeamlets.voxelIndices] = True
+                newBeamlets.compactRows(voxelMask)
+
+            newColumns = _matchKeys(keys[isNew], np.asarray(newBeamlets.spotKeys))
+            if np.any(newColumns < 0):
+                raise RuntimeError('Some new spots are missing from the computed beamlets')
+            matrices.append(newBeamlets.toSparseMatrix())
+            sources[isNew] = 1
+            columns[isNew] = newColumns
+
+        beamletDose = SparseBeamlets()
+        beamletDose.setUnitaryBeamlets(_gatherColumns(matrices, sources, columns))
+        beamletDose.doseOrigin = previousBeamlets.doseOrigin
+        beamletDose.doseSpacing = previousBeamlets.doseSpacing
+        beamletDose.doseGridSize = previousBeamlets.doseGridSize
+        beamletDose.doseOrientation = previousBeamlets.doseOrientation
+        if previousBeamlets.hasCompactRows:
+            beamletDose._voxelIndices = np.array(previousBeamlets.voxelIndices)
+        beamletDose.spotKeys = keys
+        return beamletDose
+
+    def _useBeamletCache(self) -> bool:
+        # LET and robust scenarios are read from the files of the same MCsquare run as the nominal beamlets
+        robustness = self._plan.planDesign.robustness
+        return not (self.beamletCache is None) and not self._computeLETDistribution \
+            and (robustness is None or robustness.selectionStrategy == robustness.Strategies.DISABLED)
+
+    def _beamletCacheKey(self) -> str:
+        spots = []
+        for beam in self._plan:
+            spots.append((beam.gantryAngle, beam.couchAngle, np.asarray(beam.isocenterPosition), beam.rangeShifter))
+            for layer in beam:
+                spots.append((layer.nominalEnergy, layer.numberOfPaintings, layer.rangeShifterSettings,
+                              np.asarray(layer.spotX), np.asarray(layer.spotY)))
+
+        return BeamletCache.computeKey('MCsquare', self.ct, self._ctCalibration, str(self._beamModel), spots,
+                                       np.asarray(self.scoringOrigin), np.asarray(self.scoringGridSize),
+                                       np.asarray(self.scoringVoxelSpacing), self._nbPrimaries, self._statUncertainty,
+                                       self.overwriteOutsideROI, self._roi)
+
     def _computeBeamletsLinux(self):
         """
         Compute beamlets using MCsquare on Linux
@@ -498,8 +629,8 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
         sparseBeamlets = self._mc2Lib.computeBeamletsSharedLib(self._configFilePath, nVoxels, self._plan.numberOfSpots)
 
         beamletDose = SparseBeamlets()
-        beamletDose.setUnitaryBeamlets(
-            csc_matrix.dot(sparseBeamlets, csc_matrix(np.diag(self._beamletRescaling()), dtype=np.float32)))
+        beamletDose.setUnitaryBeamlets(csc_matrix(sparseBeamlets, dtype=np.float32))
+        beamletDose.scaleColumns(self._beamletRescaling())
 
         beamletDose.doseOrigin = self.scoringOrigin
 
@@ -582,6 +713,9 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
         """
         Compute nominal and error scenarios beamlets using MCsquare
 
+        Error scenarios are imported concurrently (see scenarioImportWorkers and scenarioImportMemoryBudget). When
+        storePath is given, each scenario is written to its .blm file as soon as it is imported and returned unloaded.
+
         Parameters
         ----------
         ct : CTImage
@@ -598,37 +732,90 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
         nominal:SparseBeamlets
             Nominal beamlets dose with same grid size and spacing as the CT image
         scenarios:Sequence[SparseBeamlets]
-            Error scenarios beamlets dose with same grid size and spacing as the CT image
+            Error scenarios beamlets dose with same grid size and spacing as the CT image (loaded from their .blm file
+            on access if storePath is given)
         """
         nominal = self.computeBeamlets(ct, plan, roi)
         if not (storePath is None):
             outputBeamletFile = os.path.join(storePath, "BeamletMatrix_" + plan.seriesInstanceUID + "_Nominal.blm")
             nominal.storeOnFS(outputBeamletFile)
 
-        scenarios = []
+        scenarioFiles = []
         for s in range(self._plan.planDesign.robustness.numScenarios):
-            self._sparseDoseScenarioToRead = s
             if self._plan.planDesign.robustness.Mode4D == self._plan.planDesign.robustness.Mode4D.MCsquareSystematic:
-                for p in range(self._nbPhase):
-                    self._phase = p+1
-                    scenario = self._importBeamlets()
-                    if not (storePath is None):
-                        outputBeamletFile = os.path.join(storePath,
-                                                        "BeamletMatrix_" + plan.seriesInstanceUID + "_Scenario_" + str(
-                                                            s + 1) + "-" + str(self._plan.planDesign.robustness.numScenarios) + "_Phase" + str(self._phase) + ".blm")
-                        scenario.storeOnFS(outputBeamletFile)
-                    scenarios.append(scenario)
-            else : 
-                scenario = self._importBeamlets()
-                if not (storePath is None):
-                    outputBeamletFile = os.path.join(storePath,
-                                                 "BeamletMatrix_" + plan.seriesInstanceUID + "_Scenario_" + str(
-                                                     s + 1) + "-" + str(self._plan.planDesign.robustness.numScenarios) + ".blm")
-                    scenario.storeOnFS(outputBeamletFile)
-                scenarios.append(scenario)
+                phases = range(1, self._nbPhase + 1)
+            else:
+                phases = [0]
+            for phase in phases:
+                scenarioName = self._scenarioName(s, phase)
+                sparseDoseFile = os.path.join(self._workDir, "Sparse_Dose_" + scenarioName + ".txt")
+                if storePath is None:
+                    outputBeamletFile = None
+                else:
+                    outputBeamletFile = os.path.join(storePath, "BeamletMatrix_" + plan.seriesInstanceUID + "_" + scenarioName + ".blm")
+                scenarioFiles.append((sparseDoseFile, outputBeamletFile))
+
+        scenarios = self._importScenarioBeamlets(scenarioFiles)
 
         return nominal, scenarios
 
+    def _importScenarioBeamlets(self, scenarioFiles:Sequence[Tuple[str, Optional[str]]]) -> Sequence[SparseBeamlets]:
+        """
+        Import the beamlets of the error scenarios in a pool of worker threads.
+        Each imported scenario is written to its .blm file (if any) and unloaded as soon as it is read, so that at most
+        scenarioImportWorkers scenarios are held in memory at once. The number of concurrent imports is further limited
+        by scenarioImportMemoryBudget.
+
+        Parameters
+        ----------
+        scenarioFiles : Sequence[Tuple[str, Optional[str]]]
+            Pairs of (MCsquare sparse dose file, output beamlet file or None to keep the scenario in memory)
+
+        Returns
+        -------
+        scenarios:Sequence[SparseBeamlets]
+            Error scenarios beamlets in the order of scenarioFiles. Stored scenarios are unloaded and reloaded from
+            their file when accessed.
+        """
+        if len(scenarioFiles) == 0:
+            return []
+
+        self._resampleROI()
+        beamletRescaling = self._beamletRescaling()
+        scoringOrigin = self.scoringOrigin
+
+        memoryNeeds = [mcsquareIO.estimateBeamletsImportMemory(sparseDoseFile) for sparseDoseFile, _ in scenarioFiles]
+        budget = self.scenarioImportMemoryBudget
+        nWorkers = max(1, min(self.scenarioImportWorkers, len(scenarioFiles)))
+        if not (budget is None):
+            nWorkers = max(1, min(nWorkers, int(budget // max(memoryNeeds))))
+        logger.info('Import {} scenario beamlets with {} worker(s)'.format(len(scenarioFiles), nWorkers))
+
+        memoryCondition = threading.Condition()
+        memoryInUse = [0]
+
+        def importScenario(sparseDoseFile, outputBeamletFile, memoryNeed):
+            with memoryCondition:
+                # A scenario is always allowed to start when nothing else is running, even if it exceeds the budget
+                memoryCondition.wait_for(lambda: budget is None or memoryInUse[0] == 0 or memoryInUse[0] + memoryNeed <= budget)
+                memoryInUse[0] += memoryNeed
+            try:
+                scenario = mcsquareIO.readBeamlets(sparseDoseFile, beamletRescaling, scoringOrigin, self._roi)
+                if not (outputBeamletFile is None):
+                    scenario.storeOnFS(outputBeamletFile)
+            finally:
+                with memoryCondition:
+                    memoryInUse[0] -= memoryNeed
+                    memoryCondition.notify_all()
+            return scenario
+
+        with ThreadPoolExecutor(max_workers=nWorkers) as executor:
+            futures = [executor.submit(importScenario, sparseDoseFile, outputBeamletFile, memoryNeed)
+                       for (sparseDoseFile, outputBeamletFile), memoryNeed in zip(scenarioFiles, memoryNeeds)]
+            scenarios = [future.result() for future in futures]
+
+        return scenarios
+
     def optimizeBeamletFree(self, ct: CTImage, plan: ProtonPlan, roi: Sequence[Union[ROIContour, ROIMask]]) -> DoseImage:
         """
         Optimize weights using beamlet free optimization
@@ -1227,3 +1414,179 @@ class MCsquareDoseCalculator(AbstractMCDoseCalculator, AbstractDoseInfluenceCalc
 
         if not folder.is_dir():
             os.mkdir(folder)
+
+
+def _spotKeys(plan:ProtonPlan) -> np.ndarray:
+    """
+    One 64-bit identifier per spot of plan, in plan order, hashing the beam geometry, range shifter, energy and spot
+    position (rounded to 1e-3)
+    """
+    keys = np.empty(plan.numberOfSpots, dtype=np.uint64)
+    spotIndex = 0
+    for beam in plan:
+        rangeShifterID = None if beam.rangeShifter is None else beam.rangeShifter.ID
+        beamDescriptor = (round(float(beam.gantryAngle), 3), round(float(beam.couchAngle), 3),
+                          tuple(np.round(np.asarray(beam.isocenterPosition, dtype=float), 3).tolist()), rangeShifterID)
+        for layer in beam:
+            settings = layer.rangeShifterSettings
+            layerDescriptor = beamDescriptor + (round(float(layer.nominalEnergy), 3), str(settings.rangeShifterSetting),
+                                                settings.isocenterToRangeShifterDistance,
+                                                settings.rangeShifterWaterEquivalentThickness)
+            for x, y in zip(np.round(np.asarray(layer.spotX, dtype=float), 3), np.round(np.asarray(layer.spotY, dtype=float), 3)):
+                digest = hashlib.blake2b(repr(layerDescriptor + (float(x), float(y))).encode(), digest_size=8).digest()
+                keys[spotIndex] = int.from_bytes(digest, 'little')
+                spotIndex += 1
+    return keys
+
+
+def _matchKeys(keys:np.ndarray, referenceKeys:np.ndarray) -> np.ndarray:
+    """
+    Position of each key in referenceKeys, -1 for the keys that are not found
+    """
+    positions = np.full(len(keys), -1, dtype=np.int64)
+    if len(referenceKeys) == 0 or len(keys) == 0:
+        return positions
+    sorter = np.argsort(referenceKeys, kind='stable')
+    found = np.searchsorted(referenceKeys, keys, sorter=sorter)
+    found = np.minimum(found, len(referenceKeys) - 1)
+    matched = referenceKeys[sorter[found]] == keys
+    positions[matched] = sorter[found[matched]]
+    return positions
+
+
+def _gatherColumns(matrices:Sequence[csc_matrix], sources:np.ndarray, columns:np.ndarray) -> csc_matrix:
+    """
+    Build a CSC matrix whose column j is column columns[j] of matrices[sources[j]], copying the entries only once
+    """
+    nRows = matrices[0].shape[0]
+    counts = np.zeros(len(columns), dtype=np.int64)
+    for matrixIndex, matrix in enumerate(matrices):
+        selected = sources == matrixIndex
+        counts[selected] = np.diff(matrix.indptr)[columns[selected]]
+
+    nnz = int(counts.sum())
+    indexDtype = np.int32 if max(nRows, nnz) < np.iinfo(np.int32).max else np.int64
+    indptr = np.zeros(len(columns) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    data = np.empty(nnz, dtype=np.float32)
+    indices = np.empty(nnz, dtype=indexDtype)
+
+    for matrixIndex, matrix in enumerate(matrices):
+        selected = np.flatnonzero(sources == matrixIndex)
+        selectedCounts = counts[selected]
+        total = int(selectedCounts.sum())
+        if total == 0:
+            continue
+        # Position of each copied entry within its column
+        entryOffsets = np.arange(total, dtype=np.int64) - np.repeat(np.cumsum(selectedCounts) - selectedCounts, selectedCounts)
+        sourcePositions = np.repeat(matrix.indptr[columns[selected]].astype(np.int64), selectedCounts) + entryOffsets
+        targetPositions = np.repeat(indptr[selected], selectedCounts) + entryOffsets
+        data[targetPositions] = matrix.data[sourcePositions]
+        indices[targetPositions] = matrix.indices[sourcePositions]
+
+    return csc_matrix((data, indices, indptr.astype(indexDtype)), shape=(nRows, len(columns)))
+
+
+class MCsquareDoseCalculatorTestCase(unittest.TestCase):
+    def testGatherColumns(self):
+        import scipy.sparse as sp
+
+        rng = np.random.default_rng(0)
+        first = sp.random(50, 8, density=0.3, format='csc', dtype=np.float32, random_state=rng)
+        second = sp.random(50, 5, density=0.3, format='csc', dtype=np.float32, random_state=rng)
+        first.data[first.indptr[2]:first.indptr[3]] = 0  # Empty column
+        first.eliminate_zeros()
+        matrices = [first, second]
+        sources = np.array([1, 0, 0, 1, 0, 1, 0], dtype=np.int64)
+        columns = np.array([4, 2, 7, 0, 0, 4, 5], dtype=np.int64)
+
+        gathered = _gatherColumns(matrices, sources, columns)
+        expected = sp.hstack([matrices[source][:, column] for source, column in zip(sources, columns)], format='csc')
+        self.assertEqual(gathered.shape, (50, len(columns)))
+        self.assertEqual(gathered.nnz, expected.nnz)
+        np.testing.assert_array_equal(np.diff(gathered.indptr), np.diff(expected.indptr))
+        np.testing.assert_array_equal(gathered.toarray(), expected.toarray())
+
+        self.assertEqual(_gatherColumns(matrices, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)).shape, (50, 0))
+        self.assertEqual(_gatherColumns(matrices, np.zeros(2, dtype=np.int64), np.array([2, 2])).nnz, 0)
+
+    def testMatchKeys(self):
+        referenceKeys = np.array([2**63 + 5, 17, 3, 2**40], dtype=np.uint64)
+        keys = np.array([3, 4, 2**63 + 5, 2**40, 0, 2**64 - 1], dtype=np.uint64)
+        np.testing.assert_array_equal(_matchKeys(keys, referenceKeys), [2, -1, 0, 3, -1, -1])
+        np.testing.assert_array_equal(_matchKeys(keys, np.zeros(0, dtype=np.uint64)), -np.ones(len(keys)))
+        self.assertEqual(len(_matchKeys(np.zeros(0, dtype=np.uint64), referenceKeys)), 0)
+
+    def testComputeBeamletsIncremental(self):
+        from opentps.core.data.plan import PlanProtonBeam, PlanProtonLayer
+
+        nVoxels = 40
+
+        def createPlan(layers):
+            plan = ProtonPlan()
+            beam = PlanProtonBeam()
+            for energy, spotX in layers:
+                layer = PlanProtonLayer(energy)
+                layer.appendSpot(spotX, np.zeros(len(spotX)), np.ones(len(spotX)))
+                beam.appendLayer(layer)
+            plan.appendBeam(beam)
+            return plan
+
+        def spotColumns(keys):
+            # Beamlet of each spot: a function of its key only, so that reused and new columns can be told apart
+            columns = np.zeros((nVoxels, len(keys)), dtype=np.float32)
+            for j, key in enumerate(keys):
+                columns[int(key % np.uint64(nVoxels)), j] = 1 + int(key % np.uint64(997))
+                columns[int((key >> np.uint64(16)) % np.uint64(nVoxels)), j] += 0.5
+            return columns
+
+        def createBeamlets(plan):
+            keys = _spotKeys(plan)
+            beamlets = SparseBeamlets()
+            beamlets.setUnitaryBeamlets(csc_matrix(spotColumns(keys)))
+            beamlets.doseGridSize = (nVoxels, 1, 1)
+            beamlets.doseOrigin = (0, 0, 0)
+            beamlets.doseSpacing = (1, 1, 1)
+            beamlets.spotKeys = keys
+            return beamlets
+
+        computedPlans = []
+
+        def computeBeamlets(ct, plan, roi=None):
+            plan = copy.deepcopy(plan)
+            plan.simplify(threshold=None)
+            computedPlans.append(plan)
+            return createBeamlets(plan)
+
+        calculator = MCsquareDoseCalculator()
+        calculator.computeBeamlets = computeBeamlets
+        previousPlan = createPlan([(150., [0., 5., 10., 15.]), (140., [0., 5.])])
+        newPlan = createPlan([(150., [5., 15., 20.]), (130., [0.]), (140., [5.])])
+        newKeys = _spotKeys(newPlan)
+
+        for compact in (False, True):
+            computedPlans.clear()
+            previousBeamlets = createBeamlets(previousPlan)
+            voxelMask = np.arange(nVoxels) % 3 != 0
+            if compact:
+                previousBeamlets.compactRows(voxelMask)
+
+            beamlets = calculator.computeBeamletsIncremental(None, newPlan, previousBeamlets)
+
+            # Only the two new spots are simulated, the removed spots are dropped
+            self.assertEqual(len(computedPlans), 1)
+            self.assertEqual(computedPlans[0].numberOfSpots, 2)
+            np.testing.assert_array_equal(beamlets.spotKeys, newKeys)
+            expected = spotColumns(newKeys)
+            if compact:
+                np.testing.assert_array_equal(beamlets.voxelIndices, np.flatnonzero(voxelMask))
+                expected = expected[voxelMask]
+            np.testing.assert_array_equal(beamlets.toSparseMatrix().toarray(), expected)
+
+        previousBeamlets.spotKeys = None
+        with self.assertRaises(ValueError):
+            calculator.computeBeamletsIncremental(None, newPlan, previousBeamlets)
+
+
+if __name__ == '__main__':
+    unittest.main()
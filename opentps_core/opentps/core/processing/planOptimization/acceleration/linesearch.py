@@ -1,8 +1,8 @@
 # Copyright (c) 2014, EPFL LTS2
 # All rights reserved.
-import copy
 import numpy as np
 from opentps.core.processing.planOptimization.acceleration.baseAccel import Dummy
+from opentps.core.processing.planOptimization.optimizationTrace import traceSpan
 # -----------------------------------------------------------------------------
 # Stepsize optimizers
 # -----------------------------------------------------------------------------
@@ -35,16 +35,20 @@ class LineSearch(Dummy):
         super(LineSearch, self).__init__(**kwargs)
 
     def _update_step(self, solver, objective, niter):
-        # Save current state of the solver
-        properties = copy.deepcopy(vars(solver))
-        logger.debug('(Begin) solver properties: {}'.format(properties))
+        with traceSpan(getattr(solver, 'trace', None), 'linesearch'):
+            return self._lineSearch(solver)
+
+    def _lineSearch(self, solver):
+        # Save current solution. The rest of the solver state is not modified by the line search (and the objective
+        # functions, holding the beamlet matrices and locks, cannot be copied)
+        sol = np.array(solver.sol, copy=True)
         # initialize some useful variables
         self.f = solver.smoothFuns[0]
-        derphi = np.dot(self.f.grad(properties['sol']),solver.pk)
+        derphi = np.dot(self.f.grad(sol),solver.pk)
         step = 1.0
         n = 0
-        fn = self.f.eval(properties['sol']+ step * solver.pk)
-        flim = self.f.eval(properties['sol']) + self.c1 * step * derphi
+        fn = self.f.eval(sol+ step * solver.pk)
+        flim = self.f.eval(sol) + self.c1 * step * derphi
         len_p = np.linalg.norm(solver.pk)
 
         #Loop until Armijo condition is satisfied
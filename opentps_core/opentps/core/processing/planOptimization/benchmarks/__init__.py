@@ -0,0 +1,8 @@
+__all__ = ['SyntheticCase', 'createSyntheticCase', 'braggPeakDepthDose', 'createOptimizer', 'buildObjectiveFunction',
+           'releaseObjectiveFunction', 'createSolver', 'measurePeakMemory', 'timeObjectiveFunction', 'runSolver',
+           'runOptimizerBenchmark', 'saveBenchmarkResults', 'DEFAULT_METHODS', 'DEFAULT_CONFIGURATIONS']
+
+from .syntheticCase import SyntheticCase, createSyntheticCase, braggPeakDepthDose
+from .optimizerBenchmark import createOptimizer, buildObjectiveFunction, releaseObjectiveFunction, createSolver, \
+    measurePeakMemory, timeObjectiveFunction, runSolver, runOptimizerBenchmark, saveBenchmarkResults, \
+    DEFAULT_METHODS, DEFAULT_CONFIGURATIONS
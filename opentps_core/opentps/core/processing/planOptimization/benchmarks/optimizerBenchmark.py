@@ -0,0 +1,390 @@
+import datetime
+import json
+import logging
+import math
+import os
+import platform
+import time
+import tracemalloc
+from typing import Callable, Optional, Sequence
+
+import numpy as np
+import scipy
+
+from opentps.core.processing.C_libraries.libSparseDot_wrapper import isAvailable as nativeSparseDotAvailable
+from opentps.core.processing.planOptimization.acceleration.fistaAccel import FistaAccel
+from opentps.core.processing.planOptimization.acceleration.linesearch import LineSearch
+from opentps.core.processing.planOptimization.benchmarks.syntheticCase import SyntheticCase, createSyntheticCase
+from opentps.core.processing.planOptimization.planOptimization import PlanOptimizer
+from opentps.core.processing.planOptimization.solvers import bfgs, fista, gradientDescent, scipyOpt
+
+try:
+    import sparse_dot_mkl
+    sdm_available = True
+except:
+    sdm_available = False
+
+try:
+    import resource
+    resource_available = True
+except:
+    resource_available = False
+
+logger = logging.getLogger(__name__)
+
+# Solvers, named as the methods of IntensityModulationOptimizer
+DEFAULT_METHODS = ('Scipy_L-BFGS-B', 'Scipy_BFGS', 'Gradient', 'BFGS', 'LBFGS', 'FISTA')
+
+# Options of the objective function, named as the options of PlanOptimizer (ROI_cropping is an option of the plan
+# design)
+DEFAULT_CONFIGURATIONS = {'default': {},
+                          'MKL': {'hardwareAcceleration': 'MKL'},
+                          'NATIVE': {'hardwareAcceleration': 'NATIVE'},
+                          'MT-4': {'hardwareAcceleration': 'MT-4'},
+                          'ROI cropping': {'ROI_cropping': True},
+                          'CSR': {'csrBeamlets': True},
+                          'quantized': {'quantizedBeamlets': True}}
+
+
+def _unavailableReason(hardwareAcceleration:Optional[str]) -> Optional[str]:
+    if hardwareAcceleration is None or hardwareAcceleration[:2] == 'MT':
+        return None
+    if hardwareAcceleration[:3] == 'MKL':
+        return None if sdm_available else 'sparse_dot_mkl is not installed'
+    if hardwareAcceleration[:6] == 'NATIVE':
+        return None if nativeSparseDotAvailable() else 'libSparseDot could not be loaded'
+    return 'Hardware acceleration {} is not supported by the benchmark'.format(hardwareAcceleration)
+
+
+def createOptimizer(case:SyntheticCase, ROI_cropping=False, **kwargs) -> PlanOptimizer:
+    """
+    PlanOptimizer of a new plan of a synthetic case (see SyntheticCase.createPlan)
+
+    Parameters
+    ----------
+    case : SyntheticCase
+        The case
+    ROI_cropping : bool (default: False)
+        ROI_cropping option of the plan design
+    kwargs
+        Options of PlanOptimizer (hardwareAcceleration, csrBeamlets, quantizedBeamlets, ...)
+
+    Returns
+    -------
+    PlanOptimizer
+        The optimizer
+    """
+    reason = _unavailableReason(kwargs.get('hardwareAcceleration', None))
+    if not (reason is None):
+        raise ValueError(reason)
+    return PlanOptimizer(case.createPlan(ROI_cropping=ROI_cropping), **kwargs)
+
+
+def buildObjectiveFunction(case:SyntheticCase, **options):
+    """
+    Objective function built by PlanOptimizer for a new plan of a synthetic case (see createOptimizer). The function
+    is set up by the same code as in an optimization: cropping, row indices, quantization, dose evaluator and weighted
+    sums.
+
+    Parameters
+    ----------
+    case : SyntheticCase
+        The case
+    options
+        Options of createOptimizer. GPU acceleration is not supported.
+
+    Returns
+    -------
+    BaseFunc
+        The objective function. The thread pool of the multithreaded objectives (MT-n), if any, is released by
+        releaseObjectiveFunction.
+    """
+    optimizer = createOptimizer(case, **options)
+    optimizer.initializeFidObjectiveFunction()
+    return optimizer.functions[0]
+
+
+def releaseObjectiveFunction(function):
+    """
+    Shuts down the thread pool of the multithreaded objectives of a function built by buildObjectiveFunction
+    """
+    executor = getattr(getattr(function, 'function', None), 'executor', None)
+    if not (executor is None):
+        executor.shutdown(wait=True)
+
+
+def createSolver(method:str, maxiter:int):
+    """
+    New solver of an optimization method of IntensityModulationOptimizer, with its own accelerator
+
+    Parameters
+    ----------
+    method : str
+        'Scipy_<algorithm>', 'Gradient', 'BFGS', 'LBFGS' or 'FISTA'
+    maxiter : int
+        Maximum number of iterations
+
+    Returns
+    -------
+    The solver
+    """
+    if 'Scipy' in method:
+        return scipyOpt.ScipyOpt(method.split('_')[1], maxiter=maxiter)
+    elif method == 'Gradient':
+        return gradientDescent.GradientDescent(maxiter=maxiter)
+    elif method == 'BFGS':
+        return bfgs.BFGS(accel=LineSearch(), maxiter=maxiter)
+    elif method == 'LBFGS':
+        return bfgs.LBFGS(accel=LineSearch(), maxiter=maxiter)
+    elif method == 'FISTA':
+        return fista.FISTA(accel=FistaAccel(), maxiter=maxiter)
+    raise ValueError('Method {} is not implemented. Pick among {}'.format(method, list(DEFAULT_METHODS)))
+
+
+def measurePeakMemory(func:Callable, *args, **kwargs):
+    """
+    Calls a function and measures the peak of the memory allocated meanwhile through the Python allocators, which
+    includes NumPy and SciPy arrays but not the buffers of native libraries (MKL, libSparseDot)
+
+    Returns
+    -------
+    The result of the function and the peak memory in bytes
+    """
+    wasTracing = tracemalloc.is_tracing()
+    if not wasTracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    try:
+        result = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not wasTracing:
+            tracemalloc.stop()
+    return result, peak - baseline
+
+
+def _statistics(samples:Sequence[float]) -> dict:
+    return {'median': float(np.median(samples)), 'min': float(np.min(samples)), 'samples': [float(t) for t in samples]}
+
+
+def timeObjectiveFunction(function, x0:np.ndarray, repeats:int=5, seed:int=0) -> dict:
+    """
+    Times eval, grad and valueAndGrad of an objective function. Each call is made at a new point close to x0 so that
+    neither the function nor the dose evaluator can return a cached result.
+
+    Parameters
+    ----------
+    function : BaseFunc
+        The function
+    x0 : np.ndarray
+        Reference point
+    repeats : int (default: 5)
+        Number of calls of each method
+    seed : int (default: 0)
+        Seed of the points
+
+    Returns
+    -------
+    dict
+        Time of the first call (which builds the lazy operators of the function), then median, minimum and samples of
+        the time of each method, in seconds
+    """
+    rng = np.random.default_rng(seed)
+
+    def points():
+        return [(x0 * rng.uniform(0.9, 1.1, x0.shape)).astype(x0.dtype) for _ in range(repeats)]
+
+    result = {}
+    startTime = time.perf_counter()
+    function.valueAndGrad(points()[0])
+    result['firstCall'] = time.perf_counter() - startTime
+
+    for name in ('eval', 'grad', 'valueAndGrad'):
+        method = getattr(function, name)
+        samples = []
+        for x in points():
+            startTime = time.perf_counter()
+            method(x)
+            samples.append(time.perf_counter() - startTime)
+        result[name] = _statistics(samples)
+    return result
+
+
+def runSolver(function, method:str, x0:np.ndarray, maxiter:int) -> dict:
+    """
+    Minimizes an objective function from x0
+
+    Returns
+    -------
+    dict
+        Time (seconds), number of iterations, stopping criterion and final cost
+    """
+    solver = createSolver(method, maxiter)
+    x0 = np.array(x0, copy=True)
+    startTime = time.perf_counter()
+    result = solver.solve([function], x0)
+    elapsedTime = time.perf_counter() - startTime
+
+    sol = np.asarray(result['sol'], dtype=x0.dtype)
+    return {'time': elapsedTime, 'niter': int(result['niter']), 'crit': result.get('crit', None),
+            'cost': float(function.eval(sol))}
+
+
+def runOptimizerBenchmark(case:Optional[SyntheticCase]=None, methods:Sequence[str]=DEFAULT_METHODS,
+                          configurations:Optional[dict]=None, solveConfigurations:Optional[Sequence[str]]=None,
+                          repeats:int=5, maxiter:int=50, trackMemory:bool=True, seed:int=0) -> dict:
+    """
+    Times the objective function of a synthetic case with each configuration, then the solves of each method with the
+    configurations of solveConfigurations.
+
+    Example:
+        case = createSyntheticCase(gridSize=(96, 96, 64), numberOfSpots=8000)
+        results = runOptimizerBenchmark(case, methods=('Scipy_L-BFGS-B', 'LBFGS'), maxiter=100)
+        saveBenchmarkResults(results, 'optimizerBenchmark.jsonl')
+
+    Parameters
+    ----------
+    case : SyntheticCase (default: None)
+        The case. createSyntheticCase() if None.
+    methods : Sequence[str] (default: DEFAULT_METHODS)
+        Optimization methods, as for IntensityModulationOptimizer
+    configurations : dict (default: None)
+        Options of createOptimizer by configuration name. DEFAULT_CONFIGURATIONS if None. The configurations
+        whose hardware acceleration is not available are reported as skipped.
+    solveConfigurations : Sequence[str] (default: None)
+        Names of the configurations with which each method is run. All the configurations if None.
+    repeats : int (default: 5)
+        Number of calls of each method of the objective function
+    maxiter : int (default: 50)
+        Maximum number of iterations of the solves
+    trackMemory : bool (default: True)
+        If true, each measure is run a second time to record the peak of the memory allocated by Python (see
+        measurePeakMemory). Timings are not made while the allocations are traced.
+    seed : int (default: 0)
+        Seed of the evaluation points
+
+    Returns
+    -------
+    dict
+        Metadata of the run (versions, platform, date), description of the case, timings of the functions ('functions')
+        and of the solves ('solves')
+    """
+    case = createSyntheticCase() if case is None else case
+    configurations = DEFAULT_CONFIGURATIONS if configurations is None else configurations
+    solveConfigurations = list(configurations.keys()) if solveConfigurations is None else solveConfigurations
+    x0 = case.initialWeights()
+
+    results = {'metadata': benchmarkMetadata(), 'case': case.describe(),
+               'parameters': {'methods': list(methods), 'configurations': configurations,
+                              'solveConfigurations': list(solveConfigurations), 'repeats': repeats,
+                              'maxiter': maxiter, 'seed': seed},
+               'functions': [], 'solves': []}
+
+    for name, options in configurations.items():
+        entry = {'configuration': name}
+        reason = _unavailableReason(options.get('hardwareAcceleration', None))
+        if not (reason is None):
+            logger.warning('Configuration {} skipped: {}'.format(name, reason))
+            entry['skipped'] = reason
+            results['functions'].append(entry)
+            continue
+
+        startTime = time.perf_counter()
+        function = buildObjectiveFunction(case, **options)
+        entry['setupTime'] = time.perf_counter() - startTime
+        try:
+            entry.update(timeObjectiveFunction(function, x0, repeats=repeats, seed=seed))
+            entry['cost'] = float(function.eval(x0))
+        finally:
+            releaseObjectiveFunction(function)
+        if trackMemory:
+            function = buildObjectiveFunction(case, **options)
+            try:
+                _, entry['peakMemory'] = measurePeakMemory(function.valueAndGrad, x0)
+            finally:
+                releaseObjectiveFunction(function)
+        logger.info('Configuration {}: valueAndGrad in {:.4f} s'.format(name, entry['valueAndGrad']['median']))
+        results['functions'].append(entry)
+
+        if not (name in solveConfigurations):
+            continue
+        for method in methods:
+            solveEntry = {'configuration': name, 'method': method}
+            function = buildObjectiveFunction(case, **options)
+            try:
+                solveEntry.update(runSolver(function, method, x0, maxiter))
+            finally:
+                releaseObjectiveFunction(function)
+            if trackMemory:
+                function = buildObjectiveFunction(case, **options)
+                try:
+                    _, solveEntry['peakMemory'] = measurePeakMemory(runSolver, function, method, x0, maxiter)
+                finally:
+                    releaseObjectiveFunction(function)
+            logger.info('{} with configuration {}: {} iterations in {:.3f} s, cost {:.6e}'.format(
+                method, name, solveEntry['niter'], solveEntry['time'], solveEntry['cost']))
+            results['solves'].append(solveEntry)
+
+    results['processPeakRSS'] = processPeakRSS()
+    return results
+
+
+def processPeakRSS() -> Optional[int]:
+    """
+    High-water mark of the resident memory of the process in bytes, including the native libraries. None if not
+    available on the platform.
+    """
+    if not resource_available:
+        return None
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return int(maxRSS) if platform.system() == 'Darwin' else int(maxRSS) * 1024
+
+
+def benchmarkMetadata() -> dict:
+    """
+    Versions, platform and date of a benchmark run
+    """
+    try:
+        from importlib.metadata import version
+        opentpsVersion = version('opentps-core')
+    except Exception:
+        opentpsVersion = None
+    return {'opentpsVersion': opentpsVersion, 'python': platform.python_version(), 'numpy': np.__version__,
+            'scipy': scipy.__version__, 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpuCount': os.cpu_count(), 'sparseDotMKL': sdm_available, 'libSparseDot': nativeSparseDotAvailable(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds')}
+
+
+def _jsonCompatible(value):
+    # Strict JSON has no NaN or infinity: non-finite costs (diverging solver) are saved as null
+    if isinstance(value, dict):
+        return {str(key): _jsonCompatible(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonCompatible(item) for item in value]
+    if isinstance(value, (np.integer, np.bool_)):
+        return value.item()
+    if isinstance(value, (float, np.floating)):
+        return float(value) if math.isfinite(value) else None
+    return value
+
+
+def saveBenchmarkResults(results:dict, filePath:str):
+    """
+    Saves benchmark results as JSON. With a .jsonl file, the results are appended as one line, so that the runs of
+    successive releases can be gathered in the same file.
+
+    Parameters
+    ----------
+    results : dict
+        Results of runOptimizerBenchmark
+    filePath : str
+        Path of the .json or .jsonl file
+    """
+    results = _jsonCompatible(results)
+    if filePath.endswith('.jsonl'):
+        with open(filePath, 'a') as f:
+            f.write(json.dumps(results) + '\n')
+    else:
+        with open(filePath, 'w') as f:
+            json.dump(results, f, indent=2)
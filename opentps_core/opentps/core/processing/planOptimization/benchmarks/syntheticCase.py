@@ -0,0 +1,314 @@
+import logging
+import math
+from typing import Optional, Sequence
+
+import numpy as np
+from scipy.sparse import csc_matrix
+from scipy.special import erfc
+
+from opentps.core.data._sparseBeamlets import SparseBeamlets
+from opentps.core.data.images._roiMask import ROIMask
+from opentps.core.data.plan._protonPlan import ProtonPlan
+from opentps.core.data.plan._protonPlanDesign import ProtonPlanDesign
+from opentps.core.processing.planOptimization.objectives.dosimetricObjectives import DMax, DMin, DMaxMean, DVHMax, EUDMax
+
+logger = logging.getLogger(__name__)
+
+OBJECTIVE_SETS = ('target', 'clinical')
+
+
+def _rowOrder(imageArray:np.ndarray) -> np.ndarray:
+    # Voxel order of the beamlet matrix rows and of the objective masks (see DosimetricObjective._updateMaskVec)
+    return np.flip(imageArray, (0, 1)).flatten('F')
+
+
+def braggPeakDepthDose(depth:np.ndarray, peakDepth, rangeStraggling) -> np.ndarray:
+    """
+    Analytical integral depth dose of a proton pencil beam, normalized to 1 at the Bragg peak: a plateau rising with
+    depth, followed by a Gaussian Bragg peak and a distal fall-off whose width is the range straggling.
+
+    Parameters
+    ----------
+    depth : np.ndarray
+        Depths in mm
+    peakDepth : float or np.ndarray
+        Depth of the Bragg peak in mm
+    rangeStraggling : float or np.ndarray
+        Standard deviation of the range in mm
+
+    Returns
+    -------
+    np.ndarray
+        Relative dose at each depth
+    """
+    u = (depth - peakDepth) / rangeStraggling
+    plateau = 0.3 + 0.25 * np.square(np.clip(depth / peakDepth, 0, 1))
+    return (plateau * 0.5 * erfc(u / math.sqrt(2)) + 0.6 * np.exp(-0.5 * np.square(u))) / 1.15
+
+
+class SyntheticCase:
+    """
+    Reproducible synthetic optimization problem: a spherical target in a water cube irradiated by coplanar proton
+    beams, an organ at risk next to the target, a ring around it and a body contour. The beamlet matrix is built from
+    analytical pencil beams (see createSyntheticCase) with the voxel order of the beamlets computed by MCsquare, so that
+    the objectives are set up exactly as in a real plan.
+
+    Attributes
+    ----------
+    beamletMatrix : csc_matrix
+        Dose per MU of each spot (columns) in each voxel (rows)
+    gridSize : tuple
+        Size of the dose grid
+    spacing : tuple
+        Voxel spacing in mm
+    origin : tuple
+        Position of the first voxel in mm
+    rois : dict
+        ROIMask of the target ('PTV'), the organ at risk ('OAR'), the ring ('Ring') and the body ('Body')
+    prescription : float
+        Target prescription in Gy
+    objectiveSet : str
+        Objectives of the case: 'target' (DMin and DMax on the target) or 'clinical' (target objectives with organ at
+        risk, ring and body objectives)
+    seed : int
+        Seed of the spot positions
+    """
+    def __init__(self, beamletMatrix:csc_matrix, gridSize, spacing, origin, rois:dict, prescription:float=60.,
+                 objectiveSet:str='clinical', seed:int=0):
+        if not (objectiveSet in OBJECTIVE_SETS):
+            raise ValueError('Unknown objective set {}. Pick among {}'.format(objectiveSet, OBJECTIVE_SETS))
+        self.beamletMatrix = beamletMatrix
+        self.gridSize = tuple(gridSize)
+        self.spacing = tuple(float(s) for s in spacing)
+        self.origin = tuple(float(o) for o in origin)
+        self.rois = rois
+        self.prescription = prescription
+        self.objectiveSet = objectiveSet
+        self.seed = seed
+
+    @property
+    def numberOfVoxels(self) -> int:
+        return self.beamletMatrix.shape[0]
+
+    @property
+    def numberOfSpots(self) -> int:
+        return self.beamletMatrix.shape[1]
+
+    @property
+    def density(self) -> float:
+        return self.beamletMatrix.nnz / (self.numberOfVoxels * self.numberOfSpots)
+
+    def createBeamlets(self) -> SparseBeamlets:
+        """
+        New SparseBeamlets on the beamlet matrix of the case. Cropping or quantizing them leaves the case unchanged.
+        """
+        beamlets = SparseBeamlets()
+        beamlets.doseGridSize = self.gridSize
+        beamlets.doseSpacing = self.spacing
+        beamlets.doseOrigin = self.origin
+        beamlets.setUnitaryBeamlets(self.beamletMatrix)
+        return beamlets
+
+    def createObjectives(self) -> list:
+        """
+        New objectives of the objective set of the case, with their masks over the full dose grid
+        """
+        p = self.prescription
+        objectives = [DMin(self.rois['PTV'], 0.98 * p, weight=1.),
+                      DMax(self.rois['PTV'], 1.02 * p, weight=1.)]
+        if self.objectiveSet == 'clinical':
+            objectives += [DMax(self.rois['Ring'], 0.8 * p, weight=1.),
+                           DMaxMean(self.rois['OAR'], 0.3 * p, weight=0.5),
+                           DVHMax(self.rois['OAR'], 0.5 * p, 0.2, weight=0.5),
+                           EUDMax(self.rois['OAR'], 0.4 * p, 4., weight=0.5),
+                           DMax(self.rois['Body'], 1.05 * p, weight=0.2)]
+        for objective in objectives:
+            objective._updateMaskVec(spacing=self.spacing, gridSize=self.gridSize, origin=self.origin)
+        return objectives
+
+    def createPlan(self, ROI_cropping:bool=False) -> ProtonPlan:
+        """
+        New plan without beams, whose plan design holds new beamlets and objectives of the case and the dose grid of the
+        beamlets as scoring grid, so that PlanOptimizer builds its objective function as for a real plan (see
+        PlanOptimizer.initializeFidObjectiveFunction)
+
+        Parameters
+        ----------
+        ROI_cropping : bool (default: False)
+            ROI_cropping option of the plan design
+        """
+        planDesign = ProtonPlanDesign()
+        planDesign.ROI_cropping = ROI_cropping
+        planDesign.setScoringParameters(scoringGridSize=self.gridSize, scoringSpacing=self.spacing,
+                                        scoringOrigin=self.origin)
+        planDesign.beamlets = self.createBeamlets()
+        planDesign.objectives.setTarget('PTV', self.rois['PTV'], self.prescription)
+        for objective in self.createObjectives():
+            planDesign.objectives.addObjective(objective)
+
+        plan = ProtonPlan()
+        plan.planDesign = planDesign
+        return plan
+
+    def initialWeights(self) -> np.ndarray:
+        """
+        Uniform initial weights of the optimization variables (square roots of the spot MUs) scaling the maximum dose to
+        the prescription, as PlanOptimizer.initializeWeights
+        """
+        maxDose = np.max(self.beamletMatrix.dot(np.ones(self.numberOfSpots, dtype=np.float32)))
+        return math.sqrt(self.prescription / maxDose) * np.ones(self.numberOfSpots, dtype=np.float32)
+
+    def describe(self) -> dict:
+        """
+        Size of the case, as saved with benchmark results
+        """
+        return {'gridSize': list(self.gridSize), 'spacing': list(self.spacing),
+                'numberOfVoxels': self.numberOfVoxels, 'numberOfSpots': self.numberOfSpots,
+                'nnz': int(self.beamletMatrix.nnz), 'density': self.density,
+                'roiVoxels': {name: int(np.count_nonzero(roi.imageArray)) for name, roi in self.rois.items()},
+                'prescription': self.prescription, 'objectiveSet': self.objectiveSet, 'seed': self.seed}
+
+
+def createSyntheticCase(gridSize:Sequence[int]=(64, 64, 48), spacing:Sequence[float]=(3., 3., 3.),
+                        numberOfBeams:int=3, numberOfSpots:Optional[int]=None, spotSpacing:float=7.,
+                        targetRadius:float=30., spotSigma:float=4., sparsityThreshold:float=1e-3,
+                        lateralCutoff:float=3., prescription:float=60., objectiveSet:str='clinical',
+                        seed:int=0) -> SyntheticCase:
+    """
+    Builds a synthetic case. The beams are equally spaced in the axial plane and their spots are placed on a grid of
+    pitch spotSpacing (laterally and in depth) covering the target with a margin of one pitch, with a random jitter.
+    The dose of a spot is its Bragg peak depth dose times a Gaussian lateral profile widening with depth. Entries
+    beyond lateralCutoff lateral sigmas or below sparsityThreshold times the maximum of their column are not stored.
+
+    Parameters
+    ----------
+    gridSize : Sequence[int] (default: (64, 64, 48))
+        Size of the dose grid
+    spacing : Sequence[float] (default: (3., 3., 3.))
+        Voxel spacing in mm
+    numberOfBeams : int (default: 3)
+        Number of beams
+    numberOfSpots : int (default: None)
+        Approximate total number of spots. If set, spotSpacing is derived from it.
+    spotSpacing : float (default: 7.)
+        Spot and energy layer spacing in mm
+    targetRadius : float (default: 30.)
+        Radius of the spherical target in mm
+    spotSigma : float (default: 4.)
+        Lateral sigma of the spots at the entrance in mm
+    sparsityThreshold : float (default: 1e-3)
+        Relative dose below which the entries of a column are dropped
+    lateralCutoff : float (default: 3.)
+        Lateral extent of the spots in sigmas
+    prescription : float (default: 60.)
+        Target prescription in Gy
+    objectiveSet : str (default: 'clinical')
+        Objectives of the case (see SyntheticCase)
+    seed : int (default: 0)
+        Seed of the spot positions
+
+    Returns
+    -------
+    SyntheticCase
+        The case
+    """
+    rng = np.random.default_rng(seed)
+    gridSize = tuple(int(n) for n in gridSize)
+    spacing = np.asarray(spacing, dtype=float)
+    origin = -0.5 * spacing * (np.asarray(gridSize) - 1)  # Centered on (0, 0, 0)
+
+    axes = [origin[i] + spacing[i] * np.arange(gridSize[i]) for i in range(3)]
+    X, Y, Z = np.meshgrid(*axes, indexing='ij')
+    rois = _createROIs(X, Y, Z, targetRadius, spacing, origin)
+    voxels = np.stack([_rowOrder(X), _rowOrder(Y), _rowOrder(Z)], axis=1).astype(np.float32)
+    del X, Y, Z
+
+    if not (numberOfSpots is None):
+        # Spots per beam: volume of the target with its margin divided by spotSpacing^3
+        ratio = (4. / 3. * math.pi * numberOfBeams / numberOfSpots) ** (1. / 3.)
+        if ratio >= 1:
+            raise ValueError('Too few spots to cover the target: {}'.format(numberOfSpots))
+        spotSpacing = ratio * targetRadius / (1 - ratio)
+    entranceDepth = 0.5 * math.hypot(spacing[0] * gridSize[0], spacing[1] * gridSize[1])
+
+    columns = []
+    for angle in np.arange(numberOfBeams) * 2 * math.pi / numberOfBeams:
+        columns += _beamColumns(voxels, angle, entranceDepth, targetRadius, spotSpacing, spotSigma,
+                                lateralCutoff, sparsityThreshold, rng)
+
+    indptr = np.zeros(len(columns) + 1, dtype=np.int64)
+    np.cumsum([len(rows) for rows, _ in columns], out=indptr[1:])
+    indexDtype = np.int32 if max(indptr[-1], len(voxels)) < np.iinfo(np.int32).max else np.int64
+    indices = np.concatenate([rows for rows, _ in columns]).astype(indexDtype)
+    data = np.concatenate([values for _, values in columns]).astype(np.float32)
+    beamletMatrix = csc_matrix((data, indices, indptr.astype(indexDtype)), shape=(len(voxels), len(columns)))
+
+    case = SyntheticCase(beamletMatrix, gridSize, spacing, origin, rois, prescription=prescription,
+                         objectiveSet=objectiveSet, seed=seed)
+    logger.info('Synthetic case: {} voxels, {} spots, {:.3%} non-zero entries'.format(
+        case.numberOfVoxels, case.numberOfSpots, case.density))
+    return case
+
+
+def _createROIs(X, Y, Z, targetRadius, spacing, origin) -> dict:
+    radius = np.sqrt(X ** 2 + Y ** 2 + Z ** 2)
+    target = radius <= targetRadius
+    ring = np.logical_and(radius > targetRadius + 5., radius <= targetRadius + 20.)
+    oarRadius = 0.5 * targetRadius
+    oar = np.logical_and(np.sqrt(X ** 2 + (Y - targetRadius - 0.8 * oarRadius) ** 2 + Z ** 2) <= oarRadius,
+                         np.logical_not(target))
+    halfWidth = -origin[:2]
+    body = (X / halfWidth[0]) ** 2 + (Y / halfWidth[1]) ** 2 <= 0.9
+
+    rois = {}
+    for name, mask, color in (('PTV', target, (255, 0, 0)), ('OAR', oar, (0, 255, 0)),
+                              ('Ring', ring, (0, 0, 255)), ('Body', body, (255, 255, 0))):
+        rois[name] = ROIMask(imageArray=mask, name=name, origin=tuple(origin), spacing=tuple(spacing), displayColor=color)
+    return rois
+
+
+def _beamColumns(voxels, angle, entranceDepth, targetRadius, spotSpacing, spotSigma, lateralCutoff,
+                 sparsityThreshold, rng) -> list:
+    # Beam frame: depth along the beam direction from the entrance, lateral positions u (axial plane) and v (z)
+    direction = np.array([math.cos(angle), math.sin(angle), 0.], dtype=np.float32)
+    lateral = np.array([-math.sin(angle), math.cos(angle), 0.], dtype=np.float32)
+    depth = voxels.dot(direction) + entranceDepth
+    u = voxels.dot(lateral)
+    v = voxels[:, 2]
+
+    order = np.argsort(u, kind='stable')
+    uSorted = u[order]
+
+    # Spot grid covering the target with a margin of one spot
+    extent = targetRadius + spotSpacing
+    ticks = np.arange(-extent, extent + 1e-6, spotSpacing)
+    spotU, spotV, spotW = np.meshgrid(ticks, ticks, ticks, indexing='ij')
+    inTarget = spotU ** 2 + spotV ** 2 + spotW ** 2 <= extent ** 2
+    spots = np.stack([spotU[inTarget], spotV[inTarget], spotW[inTarget]], axis=1)
+    spots += rng.uniform(-0.25, 0.25, spots.shape) * spotSpacing
+    spots = spots[np.lexsort((spots[:, 1], spots[:, 0], -spots[:, 2]))]  # By decreasing energy, as in a plan
+
+    columns = []
+    for spotLateral, spotHeight, spotDepth in spots:
+        peakDepth = entranceDepth + spotDepth
+        straggling = 0.012 * peakDepth + 1.
+        maxSigma = math.hypot(spotSigma, 0.02 * (peakDepth + 3 * straggling))
+        halfWidth = lateralCutoff * maxSigma
+
+        start, stop = np.searchsorted(uSorted, [spotLateral - halfWidth, spotLateral + halfWidth])
+        candidates = order[start:stop]
+        du = u[candidates] - spotLateral
+        dv = v[candidates] - spotHeight
+        d = depth[candidates]
+        sigma2 = spotSigma ** 2 + (0.02 * d) ** 2
+        r2 = du ** 2 + dv ** 2
+        keep = np.logical_and(r2 <= lateralCutoff ** 2 * sigma2, d <= peakDepth + 4 * straggling)
+        candidates, d, r2, sigma2 = candidates[keep], d[keep], r2[keep], sigma2[keep]
+
+        dose = braggPeakDepthDose(d, peakDepth, straggling) * np.exp(-0.5 * r2 / sigma2) / (2 * math.pi * sigma2)
+        if len(dose):
+            keep = dose >= sparsityThreshold * dose.max()
+            candidates, dose = candidates[keep], dose[keep]
+        rowOrder = np.argsort(candidates)
+        columns.append((candidates[rowOrder], dose[rowOrder]))
+    return columns
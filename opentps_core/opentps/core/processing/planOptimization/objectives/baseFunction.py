@@ -12,6 +12,10 @@ class BaseFunc(object):
     The instanced objects are meant to be passed
     to the :func: "solver.solve" solving
     function
+
+    When cacheResults is True, the last value and gradient are kept together with the point x at which they were
+    computed, so that repeated evaluations at the same point (solver callbacks, line searches, separate calls to eval
+    and grad) are not recomputed. Only calls without keyword arguments are cached.
     """
 
     def __init__(self,robust=False,weight = 1,**kwargs):
@@ -24,6 +28,10 @@ class BaseFunc(object):
         self.MKL_acceleration = kwargs.get('MKL_acceleration', False)
         self.GPU_acceleration = kwargs.get('GPU_acceleration', False)
         self.xSquared = kwargs.get('xSquared', True)
+        self.cacheResults = kwargs.get('cacheResults', False)
+        self._cachedX = None
+        self._cachedValue = None
+        self._cachedGrad = None
 
     def eval(self, x, **kwargs):
         """
@@ -39,9 +47,12 @@ class BaseFunc(object):
         sol : float
             Function value at x
         """
+        if self._isCached(x, kwargs) and not (self._cachedValue is None):
+            return self._cachedValue
         sol = self._eval(x,**kwargs)
         name = self.__class__.__name__
         logger.debug('    {} evaluation: {}'.format(name, sol))
+        self._storeInCache(x, kwargs, value=sol)
         return sol
 
     def _eval(self, x, **kwargs):
@@ -82,11 +93,65 @@ class BaseFunc(object):
         sol : array_like
             Gradient value at x
         """
-        return self._grad(x, **kwargs)
+        if self._isCached(x, kwargs) and not (self._cachedGrad is None):
+            return self._cachedGrad
+        sol = self._grad(x, **kwargs)
+        self._storeInCache(x, kwargs, grad=sol)
+        return sol
 
     def _grad(self, x, **kwargs):
         raise NotImplementedError("Class user should define this prox method.")
 
+    def valueAndGrad(self, x, **kwargs):
+        """
+        Function value and gradient, computed together. Functions sharing intermediate results (e.g. the dose) between
+        the evaluation and the gradient compute them only once.
+
+        Parameters
+        ----------
+        x : array_like
+            Point at which the function and its gradient are evaluated
+
+        Returns
+        -------
+        value : float
+            Function value at x
+        grad : array_like
+            Gradient value at x
+        """
+        if self._isCached(x, kwargs) and not (self._cachedValue is None) and not (self._cachedGrad is None):
+            return self._cachedValue, self._cachedGrad
+        value, grad = self._valueAndGrad(x, **kwargs)
+        self._storeInCache(x, kwargs, value=value, grad=grad)
+        return value, grad
+
+    def _valueAndGrad(self, x, **kwargs):
+        return self.eval(x, **kwargs), self.grad(x, **kwargs)
+
+    def clearCache(self):
+        """
+        Discard the cached value and gradient, e.g. after a change of the function parameters
+        """
+        self._cachedX = None
+        self._cachedValue = None
+        self._cachedGrad = None
+
+    def _isCached(self, x, kwargs) -> bool:
+        return self.cacheResults and not kwargs and isSamePoint(x, self._cachedX)
+
+    def _storeInCache(self, x, kwargs, value=None, grad=None):
+        if not self.cacheResults or kwargs or not hasattr(x, 'shape'):
+            return
+        if not isSamePoint(x, self._cachedX):
+            # x may be modified in place by the solver
+            self._cachedX = x.copy()
+            self._cachedValue = None
+            self._cachedGrad = None
+        if not (value is None):
+            self._cachedValue = value
+        if not (grad is None):
+            self._cachedGrad = grad
+
     def cap(self, x):
         """
         Test the capabilities of the function object
@@ -117,6 +182,25 @@ class BaseFunc(object):
         return cap
 
 
+def isSamePoint(x, y) -> bool:
+    """
+    Check whether two points (numpy or cupy arrays) are identical
+
+    Parameters
+    ----------
+    x, y : array_like or None
+        The points to compare
+
+    Returns
+    -------
+    bool
+        True if x and y have the same type, shape and values
+    """
+    if x is None or y is None or type(x) is not type(y) or not hasattr(x, 'shape') or x.shape != y.shape:
+        return False
+    return bool((x == y).all())
+
+
 class Dummy(BaseFunc):
     """
     Dummy function which returns 0 (eval, prox, grad)
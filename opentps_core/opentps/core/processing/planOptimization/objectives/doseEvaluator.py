@@ -0,0 +1,247 @@
+import threading
+
+import numpy as np
+import scipy.sparse as sp
+import logging
+logger = logging.getLogger(__name__)
+
+from opentps.core.processing.planOptimization.objectives.baseFunction import isSamePoint
+from opentps.core.data._quantizedSparseMatrix import QuantizedSparseMatrix
+from opentps.core.processing.C_libraries.libSparseDot_wrapper import NativeSparseOperator, isAvailable as nativeSparseDotAvailable
+from opentps.core.processing.planOptimization.optimizationTrace import traceSpan
+
+try:
+    import sparse_dot_mkl
+    sdm_available = True
+except:
+    sdm_available = False
+
+try:
+    import cupy as cp
+    import cupyx as cpx
+    cupy_available = True
+except:
+    cupy_available = False
+
+
+class DoseEvaluator:
+    """
+    Dose evaluation layer shared by the DoseFidelity terms that reference the same beamlet matrix (e.g. the nominal
+    scenario of the robust and non-robust objectives). The dose B.w is computed once per weight vector x.
+
+    Attributes
+    ----------
+    beamlets : sparse matrix or QuantizedSparseMatrix
+        Beamlet matrix (cupy sparse matrix if GPU_acceleration is True)
+    xSquared : bool (default: True)
+        If true, the weights are w = x^2. If false, w = x.
+    GPU_acceleration : bool (default: False)
+        If true, the products are computed on the GPU.
+    MKL_acceleration : bool (default: False)
+        If true, the products are computed with MKL.
+    Native_acceleration : bool (default: False)
+        If true, the products are computed by the multithreaded native library libSparseDot (see NativeSparseOperator)
+    nativeThreads : int or None (default: None)
+        Number of threads of the native products. All the CPUs if None.
+    rowBeamlets : csr_matrix or None (default: None)
+        CSR copy of beamlets (see SparseBeamlets.toCSRMatrix). If set, the dose B.w is computed as one dot product per
+        row with it, while B^T.y still uses the CSC matrix. Not used on GPU or with quantized beamlets.
+    transposedBeamlets : sparse matrix
+        Transposed beamlet matrix, a view on beamlets that shares its arrays. None for quantized beamlets.
+    scenarioBatch : ScenarioBatch or None (default: None)
+        If set, the dose is taken from the doses of all the scenarios computed together by the batch
+    scenarioIndex : int (default: 0)
+        Index of the scenario of beamlets in scenarioBatch
+    trace : OptimizationTrace or None (default: None)
+        If set, the time of the products is added to the trace
+    """
+    def __init__(self, beamlets, xSquared=True, GPU_acceleration=False, MKL_acceleration=False, Native_acceleration=False,
+                 nativeThreads=None, rowBeamlets=None):
+        self.xSquared = xSquared
+        self.GPU_acceleration = GPU_acceleration
+        self.MKL_acceleration = MKL_acceleration
+        self.Native_acceleration = Native_acceleration and not GPU_acceleration \
+                                   and not isinstance(beamlets, QuantizedSparseMatrix)
+        if self.Native_acceleration and not nativeSparseDotAvailable():
+            logger.warning('libSparseDot could not be loaded: scipy sparse products are used instead')
+            self.Native_acceleration = False
+        self.nativeThreads = nativeThreads
+
+        if self.GPU_acceleration and not isinstance(beamlets, QuantizedSparseMatrix) \
+                and not cpx.scipy.sparse.issparse(beamlets):
+            beamlets = cpx.scipy.sparse.csc_matrix(beamlets)
+        self.beamlets = beamlets
+        self.rowBeamlets = None if GPU_acceleration or isinstance(beamlets, QuantizedSparseMatrix) else rowBeamlets
+        self.scenarioBatch = None
+        self.scenarioIndex = 0
+        self.trace = None
+
+        self._lock = threading.Lock()
+        self._doseX = None
+        self._dose = None
+        self._transposedBeamlets = None
+        self._transposedSource = None
+        self._nativeOperator = None
+        self._nativeSource = None
+        self._rowNativeOperator = None
+        self._rowNativeSource = None
+
+    @property
+    def nativeOperator(self):
+        if self._nativeOperator is None or not (self._nativeSource is self.beamlets):
+            self._nativeOperator = NativeSparseOperator(self.beamlets, nThreads=self.nativeThreads)
+            self._nativeSource = self.beamlets
+        return self._nativeOperator
+
+    @property
+    def rowNativeOperator(self):
+        if self._rowNativeOperator is None or not (self._rowNativeSource is self.rowBeamlets):
+            self._rowNativeOperator = NativeSparseOperator(self.rowBeamlets, nThreads=self.nativeThreads)
+            self._rowNativeSource = self.rowBeamlets
+        return self._rowNativeOperator
+
+    @property
+    def transposedBeamlets(self):
+        if isinstance(self.beamlets, QuantizedSparseMatrix):
+            return None
+        if self._transposedBeamlets is None or not (self._transposedSource is self.beamlets):
+            # The transpose of a CSC matrix is a CSR view on the same arrays
+            self._transposedBeamlets = self.beamlets.T
+            self._transposedSource = self.beamlets
+        return self._transposedBeamlets
+
+    def weights(self, x):
+        """
+        Beamlet weights w corresponding to the optimization variables x
+
+        Parameters
+        ----------
+        x : array or cupy array if GPU_acceleration is True
+            Optimization variables
+
+        Returns
+        -------
+        w : array or cupy array if GPU_acceleration is True
+            Weights (float32)
+        """
+        if self.xSquared:
+            # w = x^2
+            if self.GPU_acceleration:
+                return cp.square(x.astype(cp.float32))
+            return np.square(x).astype(np.float32)
+        # w = x
+        if self.GPU_acceleration:
+            return x.astype(cp.float32)
+        return x.astype(np.float32)
+
+    def computeDose(self, x):
+        """
+        Computes the dose B.w without caching
+
+        Parameters
+        ----------
+        x : array or cupy array if GPU_acceleration is True
+            Optimization variables
+
+        Returns
+        -------
+        dose : array or cupy array if GPU_acceleration is True
+            Dose distribution
+        """
+        w = self.weights(x)
+        if isinstance(self.beamlets, QuantizedSparseMatrix):
+            return self.beamlets.dot(w)
+        elif self.GPU_acceleration:
+            return cp.sparse.csc_matrix.dot(self.beamlets, w)
+        elif not (self.rowBeamlets is None):
+            if self.Native_acceleration:
+                return self.rowNativeOperator.dot(w)
+            elif self.MKL_acceleration:
+                return sparse_dot_mkl.dot_product_mkl(self.rowBeamlets, w)
+            return sp.csr_matrix.dot(self.rowBeamlets, w)
+        elif self.Native_acceleration:
+            return self.nativeOperator.dot(w)
+        elif self.MKL_acceleration:
+            return sparse_dot_mkl.dot_product_mkl(self.beamlets, w)
+        return sp.csc_matrix.dot(self.beamlets, w)
+
+    def dose(self, x):
+        """
+        Dose B.w at x, computed only if x differs from the point of the last call
+
+        Parameters
+        ----------
+        x : array or cupy array if GPU_acceleration is True
+            Optimization variables
+
+        Returns
+        -------
+        dose : array or cupy array if GPU_acceleration is True
+            Dose distribution
+        """
+        with self._lock:
+            if self._dose is None or not isSamePoint(x, self._doseX):
+                with traceSpan(self.trace, 'spmv', 'dose'):
+                    if self.scenarioBatch is None:
+                        self._dose = self.computeDose(x)
+                    else:
+                        self._dose = self.scenarioBatch.dose(x, self.scenarioIndex)
+                self._doseX = x.copy()
+            return self._dose
+
+    def transposeDot(self, y):
+        """
+        Product B^T.y with the transposed beamlet matrix
+
+        Parameters
+        ----------
+        y : array or cupy array if GPU_acceleration is True
+            Vector over the rows of the beamlet matrix, typically the gradient of an objective with respect to the dose
+
+        Returns
+        -------
+        array or cupy array if GPU_acceleration is True
+            Vector over the beamlets
+        """
+        with traceSpan(self.trace, 'spmv', 'transposeDot'):
+            if isinstance(self.beamlets, QuantizedSparseMatrix):
+                product = self.beamlets.transposeDot(y)
+            elif self.GPU_acceleration:
+                product = self.transposedBeamlets.dot(y)
+            elif self.Native_acceleration:
+                product = self.nativeOperator.transposeDot(y)
+            elif self.MKL_acceleration:
+                product = sparse_dot_mkl.dot_product_mkl(self.transposedBeamlets, y)
+            else:
+                product = self.transposedBeamlets.dot(y)
+        return product
+
+    def gradient(self, x, dFdD):
+        """
+        Gradient with respect to x of an objective whose gradient with respect to the dose is dFdD, computed on vectors
+        only: dFdx = dwdx * (B^T.dFdD) with dwdx = 2x if the weights are squared
+
+        Parameters
+        ----------
+        x : array or cupy array if GPU_acceleration is True
+            Optimization variables
+        dFdD : array or cupy array if GPU_acceleration is True
+            Gradient of the objective with respect to the dose
+
+        Returns
+        -------
+        array or cupy array if GPU_acceleration is True
+            Gradient with respect to x
+        """
+        g = self.transposeDot(dFdD)
+        if self.xSquared:
+            g = g * (2 * x)
+        return g
+
+    def clearCache(self):
+        """
+        Discard the cached dose
+        """
+        with self._lock:
+            self._doseX = None
+            self._dose = None
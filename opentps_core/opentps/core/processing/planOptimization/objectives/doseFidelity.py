@@ -1,29 +1,10 @@
 import numpy as np
-import scipy.sparse as sp
 import logging
 logger = logging.getLogger(__name__)
 
 from opentps.core.processing.planOptimization.objectives.baseFunction import BaseFunc
-
-try:
-    import sparse_dot_mkl
-    sdm_available = True
-except:
-    sdm_available = False
-
-try:
-    import mkl as mkl
-    mkl_available = True
-
-except:
-    mkl_available = False
-
-try:
-    import cupy as cp
-    import cupyx as cpx
-    cupy_available = True
-except:
-    cupy_available = False
+from opentps.core.processing.planOptimization.objectives.doseEvaluator import DoseEvaluator
+from opentps.core.processing.planOptimization.optimizationTrace import traceSpan
 
 
 class DoseFidelity(BaseFunc):
@@ -36,7 +17,7 @@ class DoseFidelity(BaseFunc):
         List of objectives
     xSquared : bool
         If true, the weights are squared. If false, the weights are not squared.
-    beamlets : sparse matrix
+    beamlets : sparse matrix or QuantizedSparseMatrix
         Beamlet matrix
     scenariosBL : list
         List of scenarios
@@ -44,97 +25,47 @@ class DoseFidelity(BaseFunc):
         If true, the GPU is used for the computation of the fidelity function and gradient.
     MKL_acceleration : bool (default: False)
         If true, the MKL is used for the computation of the fidelity function and gradient.
+    Native_acceleration : bool (default: False)
+        If true, the multithreaded native sparse products (libSparseDot) are used for the computation of the fidelity
+        function and gradient.
+    nativeThreads : int or None (default: None)
+        Number of threads of the native products. All the CPUs if None.
     dose : array or cupy array if GPU_acceleration is True
         Dose distribution
     function : objective function
         Objective function
-    unionMaskVec : array or cupy array if GPU_acceleration is True
-        Union mask vector for cropped multiplication
-    croppedMultiplication : bool
-        If true, cropped multiplication is used for the computation of the fidelity gradient.
+    transposedBeamlets : sparse matrix
+        Transposed beamlet matrix, a view on beamlets that shares its arrays. With squared weights, the gradient is
+        computed on vectors only, dFdx = 2x * (B^T.dFdD), so that no scaled copy of the beamlet matrix is built.
+    doseEvaluator : DoseEvaluator
+        Computes and caches the dose, and computes the transposed products. DoseFidelity terms built on the same
+        beamlet matrix can share one DoseEvaluator (given instead of beamlets) so that the dose is computed once per
+        weight vector.
+    trace : OptimizationTrace or None (default: None)
+        If set, the time of the passes over the objectives and the number of voxels with a non-zero gradient are
+        added to the trace
+
+    The last value and gradient are cached (see BaseFunc).
     """
-    def __init__(self, beamlets, xSquared=True, GPU_acceleration=False, MKL_acceleration=False):
-        super(DoseFidelity, self).__init__(xSquared=xSquared, GPU_acceleration=GPU_acceleration, MKL_acceleration=MKL_acceleration)
-        self.beamlets = beamlets
+    def __init__(self, beamlets=None, xSquared=True, GPU_acceleration=False, MKL_acceleration=False, doseEvaluator=None,
+                 Native_acceleration=False, nativeThreads=None):
+        if doseEvaluator is None:
+            doseEvaluator = DoseEvaluator(beamlets, xSquared=xSquared, GPU_acceleration=GPU_acceleration,
+                                          MKL_acceleration=MKL_acceleration, Native_acceleration=Native_acceleration,
+                                          nativeThreads=nativeThreads)
+        super(DoseFidelity, self).__init__(xSquared=doseEvaluator.xSquared, GPU_acceleration=doseEvaluator.GPU_acceleration,
+                                           MKL_acceleration=doseEvaluator.MKL_acceleration, cacheResults=True)
+        self.doseEvaluator = doseEvaluator
+        self.Native_acceleration = doseEvaluator.Native_acceleration
+        self.nativeThreads = doseEvaluator.nativeThreads
+        self.beamlets = doseEvaluator.beamlets
         self.dose = None
         self.function = None
-        self.unionMaskVec = None
-        self.croppedMultiplication = False
-
-        if self.GPU_acceleration:
-            self.beamlets = cpx.scipy.sparse.csc_matrix(beamlets)
-            if self.croppedMultiplication:
-                self.unionMaskVec = cp.asarray(self.unionMaskVec)
-
-
-    def update_dose(self,x,beamlets):
-        """
-        Updates the dose distribution based on the current weights and beamlet matrix.
-
-        Parameters
-        ----------
-        x : array or cupy array if GPU_acceleration is True
-            Weights
-
-        beamlets : scipy sparse matrix or cupy sparse matrix if GPU_acceleration is True
-            Beamlet matrix
-
-        Returns
-        -------
-        dose : array or cupy array if GPU_acceleration is True
-            Updated dose distribution
-
-        """
-        if self.xSquared:
-            # w = x^2
-            if self.GPU_acceleration:
-                w = cp.square(x.astype(cp.float32))
-            else:
-                w = np.square(x).astype(np.float32)
-        else:
-            # w = x
-            if self.GPU_acceleration:
-                w = x.astype(cp.float32)
-            else:
-                w = x.astype(np.float32)
-
-        if self.GPU_acceleration:
-            dose = cp.sparse.csc_matrix.dot(beamlets, w)
-
-        elif self.MKL_acceleration:
-            dose = sparse_dot_mkl.dot_product_mkl(beamlets, w)
-        else:
-            dose = sp.csc_matrix.dot(beamlets, w)
-        return dose
-
-    def dDdx(self,x,beamlets):
-        """
-        Computes the derivative of the dose with respect to the weights.
-        dDdx = beamlets if weights are not squared
-        dDdx = beamlets * dwdx if weights are squared
-        where dwdx = 2*x
-        Parameters
-        ----------
-        x : array or cupy array if GPU_acceleration is True
-            Weights
-        beamlets : scipy sparse matrix or cupy sparse matrix if GPU_acceleration is True
-            Beamlet matrix
+        self.trace = None
 
-        Returns
-        -------
-        dDdx : scipy sparse matrix or cupy sparse matrix if GPU_acceleration is True
-            Derivative of the dose with respect to the weights
-
-        """
-        # If the weights are squared, the change of variable is dDdx = dDdw * dwdx
-        # pointwise multiplication is much faster than creating a diagonal matrix with dwdx and then multiplying
-        if self.GPU_acceleration:
-            dwdx = 2 * x
-            dDdx = cpx.scipy.sparse.csc_matrix.multiply(beamlets, dwdx)
-        else:
-            dwdx = 2 * x
-            dDdx = sp.csc_matrix.multiply(beamlets, dwdx).tocsc()
-        return dDdx
+    @property
+    def transposedBeamlets(self):
+        return self.doseEvaluator.transposedBeamlets
 
     def computeFidelityFunction(self, x, dose):
         """
@@ -158,9 +89,9 @@ class DoseFidelity(BaseFunc):
         return F
 
 
-    def computeFidelityGradient(self, x,dose,dDdx):
+    def doseGradient(self, x):
         """
-        Computes the fidelity gradient.
+        Gradient of the objective function with respect to the dose
 
         Parameters
         ----------
@@ -169,41 +100,49 @@ class DoseFidelity(BaseFunc):
 
         Returns
         -------
-        dfTot : array
-            Fidelity gradient
-
-        Raises
-        ------
-        Exception
-            If the objective metric is not supported.
+        dFdD : array
+            Gradient over the rows of the beamlet matrix
         """
-        if self.croppedMultiplication:
-            dFdD = self.function.grad(x, dose=dose, dDdx=dDdx, return_dfdD=True)
-            if self.GPU_acceleration:
-                dFdx = cp.sparse.csc_matrix.dot(dDdx[:, self.unionMaskVec], dFdD[self.unionMaskVec])
-            elif self.MKL_acceleration:
-                dFdx = sparse_dot_mkl.dot_product_mkl(dDdx[:, self.unionMaskVec], dFdD[self.unionMaskVec])
-            else:
-                dFdx = sp.csc_matrix.dot(dDdx[:, self.unionMaskVec], dFdD[self.unionMaskVec])
-
-        else:
-            dFdx = self.function.grad(x, dose=dose, dDdx=dDdx, return_dfdD=False)
-        return dFdx
+        dose = self._doseAt(x)
+        with traceSpan(self.trace, 'grad'):
+            _, dFdD = self.function.valueAndGrad(x, dose=dose, return_dfdD=True)
+        self._traceActiveVoxels(dFdD)
+        return dFdD
 
+    def _doseAt(self, x):
+        self.dose = self.doseEvaluator.dose(x)
+        return self.dose
 
     def _eval(self, x, **kwargs):
-        self.dose = self.update_dose(x,self.beamlets)
-        f = self.computeFidelityFunction(x,self.dose)
+        dose = self._doseAt(x)
+        with traceSpan(self.trace, 'eval'):
+            f = self.computeFidelityFunction(x,dose)
         self.fValue = f
         return self.fValue
 
     def _grad(self, x, **kwargs):
-        dose = self.dose
-        if self.xSquared:
-            dDdx = self.dDdx(x,self.beamlets)
-        else:
-            dDdx = self.beamlets
-        dDdx = dDdx.T
-        g = self.computeFidelityGradient(x,dose,dDdx)
-        self.gradVector = g
-        return self.gradVector
\ No newline at end of file
+        self.gradVector = self._gradient(x, self._doseAt(x))
+        return self.gradVector
+
+    def _valueAndGrad(self, x, **kwargs):
+        dose = self._doseAt(x)
+        # A single pass over the objectives gives both the value and the gradient with respect to the dose
+        with traceSpan(self.trace, 'eval'):
+            self.fValue, dFdD = self.function.valueAndGrad(x, dose=dose, return_dfdD=True)
+        self.gradVector = self._gradient(x, dose, dFdD)
+        return self.fValue, self.gradVector
+
+    def _gradient(self, x, dose, dFdD=None):
+        # The objective gradients are scattered in one vector over the dose rows (see WeightedSum) and multiplied once
+        # by the transposed matrix, shared with the other terms using the same DoseEvaluator
+        if dFdD is None:
+            # Objectives such as DVHMin/DVHMax keep state from their last evaluation, which may have been on another
+            # scenario sharing the same objectives: evaluate them again on this dose
+            with traceSpan(self.trace, 'grad'):
+                _, dFdD = self.function.valueAndGrad(x, dose=dose, return_dfdD=True)
+        self._traceActiveVoxels(dFdD)
+        return self.doseEvaluator.gradient(x, dFdD)
+
+    def _traceActiveVoxels(self, dFdD):
+        if not (self.trace is None):
+            self.trace.setValue('activeVoxels', int(np.count_nonzero(dFdD)))
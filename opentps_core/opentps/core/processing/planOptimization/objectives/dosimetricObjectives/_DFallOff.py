@@ -100,6 +100,7 @@ class DFallOff(DosimetricObjective):
         voxelsIN = np.logical_and(euclidDistROI > 0, euclidDistROI < self.fallOffDistance)  # ?
         self.maskVec = np.flip(voxelsIN, (0, 1))
         self.maskVec = np.ndarray.flatten(self.maskVec, 'F')
+        self._clearRowIndices()
         # get dose rate
         doseRate = (self.fallOffHighDoseLevel - self.fallOffLowDoseLevel) / self.fallOffDistance
         # get reference dose (Dref) as voxel-by-voxel objective
@@ -121,7 +122,7 @@ class DFallOff(DosimetricObjective):
         else:
             f = np.mean(np.maximum(0, dose[self.maskVec] - self.voxelwiseLimitValue) ** 2)
             self.fValue = f
-        return self.fValue
+        return f
 
     def _grad(self, x, **kwargs):
         dose = kwargs.get('dose', None)
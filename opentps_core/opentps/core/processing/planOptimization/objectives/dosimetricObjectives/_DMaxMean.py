@@ -63,7 +63,7 @@ class DMaxMean(DosimetricObjective):
         else:
             f = np.maximum(0, np.mean(dose[self.maskVec]) - self.limitValue) ** 2
             self.fValue = f
-        return self.fValue
+        return f
 
     def _grad(self, x, **kwargs):
         dose = kwargs.get('dose', None)
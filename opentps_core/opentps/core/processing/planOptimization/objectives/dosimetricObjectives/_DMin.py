@@ -69,7 +69,7 @@ class DMin(DosimetricObjective):
         else:
             f = np.mean(np.minimum(0, dose[self.maskVec] - self.limitValue) ** 2)
             self.fValue = f
-        return self.fValue
+        return f
 
     def _grad(self, x, **kwargs):
         dose = kwargs.get('dose', None)
@@ -62,7 +62,7 @@ class DMinMean(DosimetricObjective):
         else:
             f = np.minimum(0, np.mean(dose[self.maskVec]) - self.limitValue) ** 2
             self.fValue = f
-        return self.fValue
+        return f
 
     def _grad(self, x, **kwargs):
         dose = kwargs.get('dose', None)
@@ -57,7 +57,7 @@ class DUniform(DosimetricObjective):
         else:
             f = np.mean((dose[self.maskVec] - self.limitValue) ** 2)
             self.fValue = f
-        return self.fValue
+        return f
 
     def _grad(self, x, **kwargs):
         dose = kwargs.get('dose', None)
@@ -62,17 +62,20 @@ class DVHMax(DosimetricObjective):
         if dose is None:
             logger.error("Dose must be provided")
             raise ValueError("Dose must be provided")
+        # Local variables first: the same objective can be evaluated concurrently on several scenarios
         if self.GPU_acceleration:
-            self.DaV = self._calcInverseDVH(self.volume, dose[self.maskVec_GPU])
-            self.active_region = (dose[self.maskVec_GPU] >= self.limitValue) & (dose[self.maskVec_GPU] <= self.DaV)
-            f = cp.sum((dose[self.maskVec_GPU][self.active_region] - self.limitValue) ** 2) / cp.sum(self.maskVec_GPU)
-            self.fValue = f
+            DaV = self._calcInverseDVH(self.volume, dose[self.maskVec_GPU])
+            active_region = (dose[self.maskVec_GPU] >= self.limitValue) & (dose[self.maskVec_GPU] <= DaV)
+            f = cp.sum((dose[self.maskVec_GPU][active_region] - self.limitValue) ** 2) / cp.sum(self.maskVec_GPU)
         else:
-            self.DaV = self._calcInverseDVH(self.volume, dose[self.maskVec])
-            self.active_region = (dose[self.maskVec] >= self.limitValue) & (dose[self.maskVec] <= self.DaV)
-            f = np.sum((dose[self.maskVec][self.active_region] - self.limitValue) ** 2) / np.sum(self.maskVec)
-            self.fValue = f
-        return self.fValue
+            DaV = self._calcInverseDVH(self.volume, dose[self.maskVec])
+            active_region = (dose[self.maskVec] >= self.limitValue) & (dose[self.maskVec] <= DaV)
+            f = np.sum((dose[self.maskVec][active_region] - self.limitValue) ** 2) / np.sum(self.maskVec)
+
+        self.DaV = DaV
+        self.active_region = active_region
+        self.fValue = f
+        return f
 
 
     def _grad(self, x, **kwargs):
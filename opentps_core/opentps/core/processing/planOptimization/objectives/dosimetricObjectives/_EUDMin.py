@@ -66,7 +66,7 @@ class EUDMin(DosimetricObjective):
             DVH_a = np.pow(np.mean(np.pow(dose[self.maskVec], self.EUDa)),(1 / self.EUDa))
             f = (np.minimum(0, DVH_a - self.limitValue))**2
             self.fValue = f
-        return self.fValue
+        return f
 
     def _grad(self, x, **kwargs):
         dose = kwargs.get('dose', None)
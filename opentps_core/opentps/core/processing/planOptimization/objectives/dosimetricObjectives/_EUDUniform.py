@@ -66,7 +66,7 @@ class EUDUniform(DosimetricObjective):
             DVH_a = np.power(np.mean(np.power(dose[self.maskVec], self.EUDa)),(1 / self.EUDa))
             f = (DVH_a - self.limitValue) ** 2
             self.fValue = f
-        return self.fValue
+        return f
 
     def _grad(self, x, **kwargs):
         dose = kwargs.get('dose', None)
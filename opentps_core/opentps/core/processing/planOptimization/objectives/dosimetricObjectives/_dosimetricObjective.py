@@ -47,6 +47,11 @@ class DosimetricObjective(BaseFunc):
             A flattened binary mask vector representing the ROI.
         maskVec_GPU : Optional[cp.ndarray] (default: None)
             A GPU-accelerated version of the mask vector, if GPU acceleration is enabled.
+        rowIndices : Optional[np.ndarray] (default: None)
+            Indices of the non-zero entries of maskVec, computed once before the optimization to scatter the gradient
+            with respect to the dose in the dose space.
+        rowIndices_GPU : Optional[cp.ndarray] (default: None)
+            A GPU-accelerated version of rowIndices, if GPU acceleration is enabled.
         kind : str (default: "Soft")
             The type of dosimetric objective. Will be deprecated in future versions.
     """
@@ -57,6 +62,8 @@ class DosimetricObjective(BaseFunc):
         self.dose = None
         self.maskVec = None
         self.maskVec_GPU = None
+        self.rowIndices = None
+        self.rowIndices_GPU = None
         self.kind = "Soft"
 
     class Metrics(Enum):
@@ -81,13 +88,14 @@ class DosimetricObjective(BaseFunc):
         return None
 
     def _calcInverseDVH(self,volume,dose):
+        # The dose at the index-th position of the sorted dose is found by a linear-time selection (partial sort)
+        dose = dose.ravel()
         if self.GPU_acceleration:
-            sorted_dose = cp.sort(dose.flatten())
-            index = cp.rint((1 - volume) * len(sorted_dose)).astype(cp.int32)
+            index = min(int(np.rint((1 - volume) * len(dose))), len(dose) - 1)
+            return cp.partition(dose, index)[index]
         else:
-            sorted_dose = np.sort(dose.flatten())
-            index = int((1 - volume) * len(sorted_dose))
-        return sorted_dose[index]
+            index = int((1 - volume) * len(dose))
+            return np.partition(dose, index)[index]
 
     def _updateMaskVec(self, spacing: Sequence[float], gridSize: Sequence[int], origin: Sequence[float]):
 
@@ -104,9 +112,21 @@ class DosimetricObjective(BaseFunc):
 
         self.maskVec = np.flip(mask.imageArray, (0, 1))
         self.maskVec = np.ndarray.flatten(self.maskVec, 'F').astype('bool')
+        self._clearRowIndices()
+
+    def _updateRowIndices(self):
+        self.rowIndices = np.flatnonzero(self.maskVec)
+        self.rowIndices_GPU = None
+
+    def _clearRowIndices(self):
+        # The row indices are only valid for the mask they were computed from: they must be cleared (or updated)
+        # whenever maskVec is replaced, otherwise the gradients are scattered with the indices of the previous mask
+        self.rowIndices = None
+        self.rowIndices_GPU = None
 
     def _loadMaskVecToGPU(self):
         self.maskVec_GPU = cp.asarray(self.maskVec)
+        self.rowIndices_GPU = None if self.rowIndices is None else cp.asarray(self.rowIndices)
 
     @property
     def roiName(self) -> str:
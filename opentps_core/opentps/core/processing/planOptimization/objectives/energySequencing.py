@@ -27,103 +27,40 @@ class EnergySeq(BaseFunc):
         self.factor = factor
         super(EnergySeq, self).__init__(**kwargs)
 
-    def _eval(self, x, **kwargs):
-        beamLayerStruct = self.struct.getBeamStructure(x)
-
-        beamElements = np.zeros(self.struct.nBeams)
-        for i, beam in enumerate(beamLayerStruct):
-            # vector of size nOfLayers in beam i
-            # contains sum of weights in each layer of beam i
+    def _beamLSE(self, K):
+        # log-sum-exp of K over the layers of each beam
+        offsets = self.struct.beamLayerOffsets
+        return np.array([logsumexp(K[offsets[i]:offsets[i + 1]]) for i in range(self.struct.nBeams)])
 
-            yb = np.zeros(len(beam))
-            for j, layer in enumerate(beam):
-                yb[j] = np.sum(layer)
-
-            yb[:] = self.factor * yb
-            sigmoidYb = np.tanh(yb)
-            energies = np.multiply(self.struct.energyLayers[i], sigmoidYb)
-            LSE = logsumexp(energies)
-            beamElements[i] = LSE
+    def _eval(self, x, **kwargs):
+        # sum of weights in each layer, weighted energies of the layers
+        yb = self.factor * self.struct.sumPerLayer(x)
+        energies = np.multiply(self.struct.layerEnergies, np.tanh(yb))
+        beamElements = self._beamLSE(energies)
 
         deltaE = np.diff(beamElements)
-        leakyReluDeltaE = [0.01 * elem if elem < 0 else elem for elem in deltaE]
-        res = np.sum(leakyReluDeltaE)
+        res = np.sum(np.where(deltaE < 0, 0.01 * deltaE, deltaE))
 
         return res * self.gamma
 
     def _grad(self, x, **kwargs):
-        beamLayerStruct = self.struct.getBeamStructure(x)
-        res = []
-        gradX = [[]]
-        beamKs = []
-        beamYbs = []
-        for i, beam in enumerate(beamLayerStruct):
-            yb = np.zeros(len(beam))
-            for j, layer in enumerate(beam):
-                yb[j] = np.sum(layer)
-            zb = self.struct.energyLayers[i]
-            Kb = np.multiply(zb, np.tanh(self.factor * yb))
-
-            beamYbs.append(yb)
-            beamKs.append(Kb)
-
-        # first beam
-        y1 = beamYbs[0]
-        z1 = np.array(self.struct.energyLayers[0])
-        K1 = beamKs[0]
-        tmp = (np.exp(K1) / np.sum(np.exp(K1))) * (z1 * self.factor * (1 - (np.tanh(self.factor * y1) ** 2)))
-        expr = logsumexp(beamKs[1]) - logsumexp(K1)
-        if expr < 0:
-            cFirst = 0.01
-        else:
-            cFirst = 1.
-        # should be a vector of size nOfLayers in first beam
-        res.append(- cFirst * tmp)
-
-        # intermediate
-        for i, beam in enumerate(beamLayerStruct, start=1):
-            if i >= len(beamLayerStruct) - 1:
-                break
-            yb = beamYbs[i]
-            zb = np.array(self.struct.energyLayers[i])
-            Kb = beamKs[i]
-            tmp = (np.exp(Kb) / np.sum(np.exp(Kb))) * (zb * self.factor * (1 - (np.tanh(self.factor * yb) ** 2)))
-
-            expr1 = logsumexp(Kb) - logsumexp(beamKs[i - 1])
-            expr2 = logsumexp(beamKs[i + 1]) - logsumexp(Kb)
-            if expr1 < 0:
-                c1 = 0.01
-            else:
-                c1 = 1.0
-            if expr2 < 0:
-                c2 = 0.01
-            else:
-                c2 = 1.0
-
-            # should be a vector of size nOfLayers in beam i
-            res.append(c1 * tmp - c2 * tmp)
-
-        # last beam
-        yB = beamYbs[-1]
-        zB = np.array(self.struct.energyLayers[-1])
-
-        KB = beamKs[-1]
-        tmpLast = (np.exp(KB) / np.sum(np.exp(KB))) * (zB * self.factor * (1 - (np.tanh(self.factor * yB) ** 2)))
-
-        exprLast = np.log(np.sum(np.exp(KB))) - np.log(np.sum(np.exp(beamKs[-2])))
-        if exprLast < 0.:
-            cLast = 0.01
-        else:
-            cLast = 1.0
-        # should be a vector of size nOfLayers in last beam
-        res.append(cLast * tmpLast)
-
-        flatRes = [item for sublist in res for item in sublist]
-
-        for layer in range(len(flatRes)):
-            tmp = np.tile(flatRes[layer], (1, self.struct.nSpotsInLayer[layer]))
-            gradX = np.concatenate((gradX, tmp), axis=1)
-
-        gradX = gradX.flatten()
+        yb = self.struct.sumPerLayer(x)
+        zb = self.struct.layerEnergies
+        tanhYb = np.tanh(self.factor * yb)
+        Kb = np.multiply(zb, tanhYb)
+        beamLSE = self._beamLSE(Kb)
+
+        # derivative of the log-sum-exp of each beam with respect to the sum of weights of its layers
+        tmp = np.exp(Kb - beamLSE[self.struct.layerBeams]) * (zb * self.factor * (1 - tanhYb ** 2))
+
+        # leaky ReLU slopes of the energy differences between consecutive beams: beam b contributes to the differences
+        # (b-1, b) with a positive sign and (b, b+1) with a negative sign
+        slopes = np.where(np.diff(beamLSE) < 0, 0.01, 1.)
+        beamCoefficients = np.zeros(self.struct.nBeams)
+        beamCoefficients[1:] += slopes
+        beamCoefficients[:-1] -= slopes
+
+        layerGrad = beamCoefficients[self.struct.layerBeams] * tmp
+        gradX = layerGrad[self.struct.spotLayers]
 
         return gradX * self.gamma
@@ -26,60 +26,12 @@ class LogBarrier(BaseFunc):
         self.struct = WeightStructure(plan)
         super(LogBarrier, self).__init__(**kwargs)
 
-    def logCols(self, x):
-        """
-         Calculates log of each beam
-
-        Parameters
-        ----------
-        x : list
-            List of beams and layers.
-
-        Returns
-        -------
-        res : list
-            List of log of each beam.
-        """
-        res = np.zeros(len(x))
-        for beam in range(len(x)):
-            for layer in range(len(x[beam])):
-                res[beam] += np.sum(x[beam][layer])
-        return np.log(np.where(res > 0., res, 1e-300))
-
     def _eval(self, x, **kwargs):
-        beamLayerStruct = self.struct.getBeamStructure(x)
-        res = - self.beta * np.sum(self.logCols(beamLayerStruct))
+        beamSum = self.struct.sumPerBeam(x)
+        res = - self.beta * np.sum(np.log(np.where(beamSum > 0., beamSum, 1e-300)))
         return res
 
     def _grad(self, x, **kwargs):
-        beamLayerStruct = self.struct.getBeamStructure(x)
-        res = -self.beta * self.dlogCols(beamLayerStruct)
-        return res
-
-    def dlogCols(self, x):
-        """
-        Calculates derivative log of each layer and sum in each beam
-
-        Parameters
-        ----------
-        x : list
-            List of beams and layers.
-
-        Returns
-        -------
-        res : list
-            List of derivative log of each layer and sum in each beam.
-        """
-        X = [[]]
-        layerSum = np.zeros(len(x))
-        for beam in range(len(x)):
-            for layer in range(len(x[beam])):
-                layerSum[beam] += np.sum(x[beam][layer])
-        layerSum[:] = np.reciprocal(np.where(layerSum > 0., layerSum, 1e-300))
-        for beam in range(len(layerSum)):
-            tmp = np.tile(layerSum[beam], (1, self.struct.nSpotsInBeam[beam]))
-            X = np.concatenate((X, tmp), axis=1)
-
-        res = X.flatten()
-
+        beamSum = self.struct.sumPerBeam(x)
+        res = -self.beta * np.reciprocal(np.where(beamSum > 0., beamSum, 1e-300))[self.struct.spotBeams]
         return res
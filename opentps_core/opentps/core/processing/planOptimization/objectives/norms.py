@@ -86,6 +86,9 @@ class NormL21(Norm):
     The proximal operator for reg*||w||_2 (not squared).
     source lasso. Inherit from Norm.
     Code from EPFL LTS2 toolbox.
+
+    The groups are the energy layers: the norms and the proximal operator are computed for all the layers at once with
+    the spot -> layer index of the WeightStructure.
     """
 
     def __init__(self, plan=None, scaleReg="group_size", oldRegularisation=False,
@@ -94,9 +97,7 @@ class NormL21(Norm):
         self.plan = plan
         self.struct = tools.WeightStructure(self.plan)
         # liste de taille nSpots qui dit à quel layer appartient le spot en question
-        self.groupsIds_ = np.concatenate([size * [i] for i, size in enumerate(self.struct.nSpotsInLayer)])
-        # liste de taille nLayers qui reprend tous les weights et == true si actif dans la layer en question
-        self.groups_ = [self.groupsIds_ == u for u in np.unique(self.groupsIds_) if u >= 0]
+        self.groupsIds_ = self.struct.spotLayers
         self.scaleReg = scaleReg
         self.oldRegularisation = oldRegularisation
         targetMask = self.plan.objectives.ROIRelatedObjList[0].maskVec
@@ -110,10 +111,7 @@ class NormL21(Norm):
             groupRegVector_ = self.groupRegVector_
         else:
             groupRegVector_ = self.groupRegVector_
-        regulariser = 0
-        for group, reg in zip(self.groups_, groupRegVector_):
-            regulariser += reg * la.norm(x[group])
-        return regulariser
+        return np.dot(groupRegVector_, self.struct.layerNorms(x))
 
     def _prox(self, x, T):
         if self.iter % 10 == 0:
@@ -124,7 +122,7 @@ class NormL21(Norm):
         if not self.oldRegularisation:
             groupRegVector = np.asarray(groupRegVector) * T
         self.iter += 1
-        return self._group_l2_prox(x, groupRegVector, self.groups_)
+        return self._group_l2_prox(x, groupRegVector)
 
     def _l2_prox(self, x, reg):
         """The proximal operator for reg*||w||_2 (not squared).
@@ -134,79 +132,72 @@ class NormL21(Norm):
             return 0 * x
         return max(0, 1 - reg / norm_x) * x
 
-    def _l21demi(self, X):
+    def _l21demi(self, x):
         """
         L2,1/2 norm
         """
-        res = np.zeros(len(X))
-        for col, layer in enumerate(X):
-            res[col] = np.sqrt(np.sum(np.square(X[col])))
-        total = math.sqrt(np.sum(res))
-        return total
-
-    def _group_l2_prox(self, x, regCoeffs, groups):
-        """The proximal map for the specified groups of coefficients.
-        """
-        x = x.copy()
+        return math.sqrt(np.sum(self.struct.layerNorms(x)))
 
-        for group, reg in zip(groups, regCoeffs):
-            x[group] = self._l2_prox(x[group], reg)
-        return x
+    def _group_l2_prox(self, x, regCoeffs):
+        """The proximal map for the groups of coefficients (layers): the spots of layer l are scaled by
+        max(0, 1 - reg_l / ||x_l||), zero if ||x_l|| = 0.
+        """
+        norms = self.struct.layerNorms(x)
+        ratios = np.divide(np.asarray(regCoeffs, dtype=float), norms, out=np.full(len(norms), np.inf), where=norms > 0)
+        scales = np.maximum(0, 1 - ratios)
+        return (x * scales[self.struct.spotLayers]).astype(x.dtype, copy=False)
 
-    def _get_reg_strength(self, x1D, x, group, reg, energyWeight, index):
-        """Get the regularisation coefficient for one group.
+    def _get_reg_strengths(self, x, reg, layerMUs, energiesWeight):
+        """Get the regularisation coefficients of all the groups.
         """
         scale_reg = str(self.scaleReg).lower()
+        nSpotsInLayer = self.struct.nSpotsInLayer
         if scale_reg == "group_size":
-            scale = math.sqrt(group.sum())
+            scale = np.sqrt(nSpotsInLayer)
         elif scale_reg == "none":
-            scale = 1
+            scale = np.ones(self.struct.nLayers)
         elif scale_reg == "inverse_group_size":
-            scale = 1 / math.sqrt(group.sum())
+            scale = 1 / np.sqrt(nSpotsInLayer)
         elif scale_reg == "active":
-            scale = 1 / self.activeLayers[index]
+            scale = 1 / self.activeLayers
         elif scale_reg == "summu":
-            if self.sumMuInlayer(x, index) != 0:
-                scale = 1. / (self.sumMuInlayer(x, index))
-            else:
-                scale = 1.
+            scale = np.ones(self.struct.nLayers)
+            np.divide(1., layerMUs, out=scale, where=layerMUs != 0)
         elif scale_reg == "energy":
-            if energyWeight == 0:
-                scale = 0
-            else:
-                scale = 1 / energyWeight
+            scale = np.zeros(self.struct.nLayers)
+            np.divide(1., energiesWeight, out=scale, where=energiesWeight != 0)
         elif scale_reg == "wenbo":
-            arrayWithOnes = np.ones(len(x1D[group]))
-            if use_MKL:
-                beamDoseTarget = sparse_dot_mkl.dot_product_mkl(self.BLTarget[:, group], arrayWithOnes.astype(np.float32))
-            else:
-                beamDoseTarget = sp.dot_product_mkl(self.BLTarget[:, group],
-                                                                arrayWithOnes.astype(np.float32))
-            scale = np.sqrt(la.norm(beamDoseTarget) / self.struct.nSpotsInLayer[index])
+            scale = np.zeros(self.struct.nLayers)
+            offsets = self.struct.layerOffsets
+            for index in range(self.struct.nLayers):
+                arrayWithOnes = np.ones(nSpotsInLayer[index], dtype=np.float32)
+                BLTargetLayer = self.BLTarget[:, offsets[index]:offsets[index + 1]]
+                if use_MKL:
+                    beamDoseTarget = sparse_dot_mkl.dot_product_mkl(BLTargetLayer, arrayWithOnes)
+                else:
+                    beamDoseTarget = BLTargetLayer.dot(arrayWithOnes)
+                scale[index] = np.sqrt(la.norm(beamDoseTarget) / nSpotsInLayer[index])
         else:
             logger.error(
                 '``scale_reg`` must be equal to "group_size",'
                 ' "inverse_group_size" or "summu"  or "none"'
             )
+            raise ValueError('Unknown scale_reg {}'.format(self.scaleReg))
         return reg * scale
 
     def _get_reg_vector(self, x, reg):
         """Get the group-wise regularisation coefficients from ``reg``.
         """
+        layerMUs = self.struct.sumPerLayer(x)
         self.activeEnergies = self.struct.getListOfActiveEnergies(x)
         self.activeLayersInBeam = self.struct.getListOfActiveLayersInBeams(x)
-        self.activeLayers = np.concatenate(
-            [size * [item] for item, size in zip(self.activeLayersInBeam, self.struct.nLayersInBeam)])
+        self.activeLayers = np.asarray(self.activeLayersInBeam)[self.struct.layerBeams]
         energiesWeight = tools.getEnergyWeights(self.activeEnergies)
-        X = self.struct.getEnergyStructure(x)
         scale_reg = str(self.scaleReg).lower()
         if isinstance(reg, Number) and scale_reg != "l21demi":
-            reg = [
-                self._get_reg_strength(x, X, group, reg, energiesWeight[i], i) for i, group in enumerate(self.groups_)
-            ]
+            reg = self._get_reg_strengths(x, reg, layerMUs, energiesWeight)
         elif scale_reg == 'l21demi':
-            scale = self._l21demi(X)
-            reg = [reg * (1 / scale) for i, group in enumerate(self.groups_)]
+            reg = np.full(self.struct.nLayers, reg * (1 / self._l21demi(x)))
         else:
             reg = list(reg)
         return reg
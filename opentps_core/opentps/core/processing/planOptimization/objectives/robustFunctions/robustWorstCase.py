@@ -47,14 +47,20 @@ class RobustWorstCase(BaseFunc):
             Flag to indicate if MKL acceleration is enabled.
         GPU_acceleration : bool (default: False)
             Flag to indicate if GPU acceleration is enabled.
+        executor : concurrent.futures.Executor or None (default: None)
+            Pool on which the scenarios are evaluated concurrently (the sparse products and NumPy kernels release the
+            GIL). The scenarios are evaluated serially if None.
         nScenarios : int
             Number of scenarios to consider in the robust optimization including the nominal one.
         savedWC : any
             Placeholder for saving the worst-case scenario details if needed.
+        trace : OptimizationTrace or None (default: None)
+            If set, the index of the worst-case scenario is recorded in the trace at each evaluation.
         """
 
-    def __init__(self,nScenarios,GPU_acceleration=False):
-        super(RobustWorstCase, self).__init__(GPU_acceleration=GPU_acceleration)
+    def __init__(self,nScenarios,GPU_acceleration=False,executor=None):
+        super(RobustWorstCase, self).__init__(GPU_acceleration=GPU_acceleration, cacheResults=True)
+        self.executor = executor
         self.worstCaseIndex = 0
         self.nominalIndex = 0
         self.robustFunctions = []
@@ -65,36 +71,61 @@ class RobustWorstCase(BaseFunc):
         self.nonRobustFunction = None
         self.nScenarios = nScenarios
         self.savedWC = None
+        self.trace = None
         if self.GPU_acceleration:
             self.robustfValues = cp.zeros(self.nScenarios, dtype=cp.float32)
         else:
             self.robustfValues = np.zeros(self.nScenarios, dtype=np.float32)
 
     def _eval(self, x, **kwargs):
-        # Nominal scenario loop
-        if self.nonRobustFunction is not None:
-            self.nonRobustfValue = self.nonRobustFunction.eval(x)
-        else:
-            self.nonRobustfValue = 0.0
+        if self.executor is None or self.GPU_acceleration:
+            # Nominal scenario loop
+            if self.nonRobustFunction is not None:
+                self.nonRobustfValue = self.nonRobustFunction.eval(x)
+            else:
+                self.nonRobustfValue = 0.0
 
-        for scenarioIndex in range(self.nScenarios):
-            self.robustfValues[scenarioIndex] = self.robustFunctions[scenarioIndex].eval(x)
+            for scenarioIndex in range(self.nScenarios):
+                self.robustfValues[scenarioIndex] = self.robustFunctions[scenarioIndex].eval(x)
+        else:
+            # All the scenarios at once, gathered in scenario order
+            nonRobustFuture = None
+            if self.nonRobustFunction is not None:
+                nonRobustFuture = self.executor.submit(self.nonRobustFunction.eval, x)
+            futures = [self.executor.submit(function.eval, x) for function in self.robustFunctions[:self.nScenarios]]
+            for scenarioIndex, future in enumerate(futures):
+                self.robustfValues[scenarioIndex] = future.result()
+            self.nonRobustfValue = 0.0 if nonRobustFuture is None else nonRobustFuture.result()
         if self.GPU_acceleration:
             self.worstCaseIndex = int(cp.argmax(self.robustfValues))
         else:
             self.worstCaseIndex = np.argmax(self.robustfValues)
+        if not (self.trace is None):
+            self.trace.setValue('worstCaseScenario', int(self.worstCaseIndex))
         self.robustfValues[:] += self.nonRobustfValue
         self.fValue = self.robustfValues[self.worstCaseIndex]
         return self.fValue
 
     def _grad(self, x, **kwargs):
+        if not self._isCached(x, {}) or self._cachedValue is None:
+            # The worst case scenario must be the one at x
+            self.eval(x)
+        worstCaseFunction = self.robustFunctions[self.worstCaseIndex]
         if self.nonRobustFunction is not None:
-            nonRobustGrad = self.nonRobustFunction.grad(x)
-            robustGrad = self.robustFunctions[self.worstCaseIndex].grad(x)
-            grad = nonRobustGrad + robustGrad
+            if self._sharesDose(self.nonRobustFunction, worstCaseFunction):
+                # Same beamlet matrix (nominal worst case): a single product with the transposed matrix
+                dFdD = self.nonRobustFunction.doseGradient(x) + worstCaseFunction.doseGradient(x)
+                grad = worstCaseFunction.doseEvaluator.gradient(x, dFdD)
+            else:
+                nonRobustGrad = self.nonRobustFunction.grad(x)
+                robustGrad = worstCaseFunction.grad(x)
+                grad = nonRobustGrad + robustGrad
         else:
-            grad = self.robustFunctions[self.worstCaseIndex].grad(x)
+            grad = worstCaseFunction.grad(x)
         self.gradVector = grad
         return self.gradVector
 
-
+    @staticmethod
+    def _sharesDose(function1, function2) -> bool:
+        doseEvaluator = getattr(function1, 'doseEvaluator', None)
+        return not (doseEvaluator is None) and doseEvaluator is getattr(function2, 'doseEvaluator', None)
@@ -0,0 +1,225 @@
+import threading
+import time
+import unittest
+from typing import Sequence
+
+import numpy as np
+import scipy.sparse as sp
+import logging
+logger = logging.getLogger(__name__)
+
+from opentps.core.processing.planOptimization.objectives.baseFunction import isSamePoint
+from opentps.core.processing.C_libraries.libSparseDot_wrapper import NativeSparseOperator, isAvailable as nativeSparseDotAvailable
+
+try:
+    import sparse_dot_mkl
+    sdm_available = True
+except:
+    sdm_available = False
+
+
+class ScenarioBatch:
+    """
+    Block operator interleaving the beamlet matrices of several scenarios (nominal and robust) that share the same rows
+    and spot columns. The doses of all the scenarios are obtained with a single sparse product per weight vector.
+
+    Row v*S + s of the interleaved matrix is voxel v of scenario s (S scenarios): within each spot column, the entries of
+    all the scenarios for a voxel are stored next to each other, so that they are written to the same cache lines of
+    the output and the weight of the spot is read once.
+
+    The interleaved matrix is a copy of the scenario matrices: the batch trades memory for fewer, larger products.
+
+    Attributes
+    ----------
+    interleavedBeamlets : csc_matrix
+        Interleaved scenario matrices
+    xSquared : bool (default: True)
+        If true, the weights are w = x^2. If false, w = x.
+    MKL_acceleration : bool (default: False)
+        If true, the products are computed with MKL.
+    Native_acceleration : bool (default: False)
+        If true, the products are computed by the multithreaded native library libSparseDot
+    nativeThreads : int or None (default: None)
+        Number of threads of the native products. All the CPUs if None.
+    """
+    def __init__(self, scenarioBeamlets:Sequence[sp.spmatrix], xSquared=True, MKL_acceleration=False,
+                 Native_acceleration=False, nativeThreads=None):
+        self.xSquared = xSquared
+        self.MKL_acceleration = MKL_acceleration
+        self.Native_acceleration = Native_acceleration
+        if self.Native_acceleration and not nativeSparseDotAvailable():
+            logger.warning('libSparseDot could not be loaded: scipy sparse products are used instead')
+            self.Native_acceleration = False
+
+        shapes = {matrix.shape for matrix in scenarioBeamlets}
+        if len(shapes) != 1:
+            raise ValueError('Scenario beamlet matrices must have the same shape')
+        self._nRows, nCols = scenarioBeamlets[0].shape
+        self._nScenarios = len(scenarioBeamlets)
+
+        # Stack the scenarios, then renumber the rows voxel by voxel: stacked row s*nRows + v becomes v*S + s
+        interleaved = sp.vstack(scenarioBeamlets, format='csc', dtype=np.float32)
+        stackedRows = interleaved.indices.astype(np.int64)
+        interleavedRows = (stackedRows % self._nRows) * self._nScenarios + stackedRows // self._nRows
+        indexDtype = np.int32 if max(self._nRows * self._nScenarios, interleaved.nnz) < np.iinfo(np.int32).max else np.int64
+        interleaved = sp.csc_matrix((interleaved.data, interleavedRows.astype(indexDtype), interleaved.indptr.astype(indexDtype)),
+                                    shape=(self._nRows * self._nScenarios, nCols))
+        interleaved.sort_indices()
+        self.interleavedBeamlets = interleaved
+        self._nativeOperator = NativeSparseOperator(interleaved, nThreads=nativeThreads) if self.Native_acceleration else None
+        logger.info('Scenario batch of {} scenarios: {} non-zero values'.format(self._nScenarios, interleaved.nnz))
+
+        self._lock = threading.Lock()
+        self._doseX = None
+        self._doses = None
+
+    @property
+    def numberOfScenarios(self) -> int:
+        return self._nScenarios
+
+    def weights(self, x):
+        if self.xSquared:
+            return np.square(x).astype(np.float32)
+        return x.astype(np.float32)
+
+    def computeDoses(self, x) -> np.ndarray:
+        """
+        Computes the doses of all the scenarios without caching
+
+        Parameters
+        ----------
+        x : array
+            Optimization variables
+
+        Returns
+        -------
+        np.ndarray
+            Doses of shape (numberOfScenarios, number of rows)
+        """
+        w = self.weights(x)
+        if self.Native_acceleration:
+            doses = self._nativeOperator.dot(w)
+        elif self.MKL_acceleration:
+            doses = sparse_dot_mkl.dot_product_mkl(self.interleavedBeamlets, w)
+        else:
+            doses = self.interleavedBeamlets.dot(w)
+        return np.ascontiguousarray(doses.reshape(self._nRows, self._nScenarios).T)
+
+    def dose(self, x, scenarioIndex:int) -> np.ndarray:
+        """
+        Dose of one scenario. The doses of all the scenarios are computed together, once per x.
+
+        Parameters
+        ----------
+        x : array
+            Optimization variables
+        scenarioIndex : int
+            Index of the scenario in the batch
+
+        Returns
+        -------
+        np.ndarray
+            Dose of the scenario
+        """
+        with self._lock:
+            if self._doses is None or not isSamePoint(x, self._doseX):
+                self._doses = self.computeDoses(x)
+                self._doseX = x.copy()
+            return self._doses[scenarioIndex]
+
+    def clearCache(self):
+        with self._lock:
+            self._doseX = None
+            self._doses = None
+
+
+def benchmarkScenarioBatch(scenarioBeamlets:Sequence[sp.spmatrix], repeats:int=10, seed:int=0) -> dict:
+    """
+    Compares the time needed to compute the doses of all the scenarios with a ScenarioBatch and with one product per
+    scenario
+
+    Parameters
+    ----------
+    scenarioBeamlets : Sequence[sparse matrix]
+        Beamlet matrices of the scenarios
+    repeats : int (default: 10)
+        Number of timed evaluations
+    seed : int (default: 0)
+        Seed of the random weight vectors
+
+    Returns
+    -------
+    dict
+        Mean time per evaluation of the loop and of the batch (seconds), speedup and maximum absolute difference
+        between the doses
+    """
+    matrices = [sp.csc_matrix(matrix, dtype=np.float32) for matrix in scenarioBeamlets]
+    batch = ScenarioBatch(matrices)
+    rng = np.random.default_rng(seed)
+    xs = [rng.random(matrices[0].shape[1]) for _ in range(repeats)]
+
+    start = time.perf_counter()
+    loopDoses = [[matrix.dot(batch.weights(x)) for matrix in matrices] for x in xs]
+    loopTime = (time.perf_counter() - start) / repeats
+
+    start = time.perf_counter()
+    batchDoses = [batch.computeDoses(x) for x in xs]
+    batchTime = (time.perf_counter() - start) / repeats
+
+    maxDifference = max(float(np.max(np.abs(np.stack(loop) - batched), initial=0.0))
+                        for loop, batched in zip(loopDoses, batchDoses))
+    result = {'numberOfScenarios': len(matrices), 'nnz': int(batch.interleavedBeamlets.nnz), 'loopTime': loopTime,
+              'batchTime': batchTime, 'speedup': loopTime / batchTime if batchTime > 0 else float('inf'),
+              'maxDifference': maxDifference}
+    logger.info('Scenario doses: {:.4f} s per loop, {:.4f} s batched (speedup {:.2f})'.format(
+        loopTime, batchTime, result['speedup']))
+    return result
+
+
+class ScenarioBatchTestCase(unittest.TestCase):
+    def _createScenarios(self, nRows=300, nCols=40, densities=(0.05, 0.2, 0.01), seed=0):
+        rng = np.random.default_rng(seed)
+        return [sp.random(nRows, nCols, density=density, format='csc', dtype=np.float32, random_state=rng)
+                for density in densities]
+
+    def testComputeDosesMatchesLoop(self):
+        scenarios = self._createScenarios()
+        self.assertEqual(len({matrix.nnz for matrix in scenarios}), len(scenarios))
+        x = np.random.default_rng(1).random(scenarios[0].shape[1]).astype(np.float32)
+
+        configurations = [(True, False), (False, False)]
+        if nativeSparseDotAvailable():
+            configurations.append((True, True))
+        for xSquared, native in configurations:
+            batch = ScenarioBatch(scenarios, xSquared=xSquared, Native_acceleration=native, nativeThreads=2)
+            w = np.square(x) if xSquared else x
+            doses = batch.computeDoses(x)
+            self.assertEqual(doses.shape, (len(scenarios), scenarios[0].shape[0]))
+            self.assertEqual(batch.interleavedBeamlets.nnz, sum(matrix.nnz for matrix in scenarios))
+            for s, matrix in enumerate(scenarios):
+                np.testing.assert_allclose(doses[s], matrix.dot(w), rtol=1e-5, atol=1e-6)
+
+    def testEmptyScenario(self):
+        scenarios = self._createScenarios(densities=(0.1, 0.0))
+        x = np.ones(scenarios[0].shape[1], dtype=np.float32)
+        doses = ScenarioBatch(scenarios).computeDoses(x)
+        np.testing.assert_allclose(doses[0], scenarios[0].dot(x), rtol=1e-5, atol=1e-6)
+        np.testing.assert_array_equal(doses[1], 0)
+
+    def testDoseCache(self):
+        scenarios = self._createScenarios()
+        batch = ScenarioBatch(scenarios)
+        rng = np.random.default_rng(2)
+        for _ in range(2):
+            x = rng.random(scenarios[0].shape[1]).astype(np.float32)
+            for s, matrix in enumerate(scenarios):
+                np.testing.assert_allclose(batch.dose(x, s), matrix.dot(np.square(x)), rtol=1e-5, atol=1e-6)
+
+    def testDifferentShapes(self):
+        scenarios = self._createScenarios()
+        with self.assertRaises(ValueError):
+            ScenarioBatch([scenarios[0], scenarios[1][:-1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
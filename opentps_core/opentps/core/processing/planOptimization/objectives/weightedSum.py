@@ -23,31 +23,44 @@ class WeightedSum(BaseFunc):
             f_i = self.functionList[i].weight * self.functionList[i].eval(x, **kwargs)
             F += f_i
         self.fValue = F
-        return self.fValue
+        return F
 
     def _grad(self, x, **kwargs):
-        if kwargs.get('return_dfdD', False):
-            if self.GPU_acceleration:
-                dFdD = cp.zeros(kwargs['dose'].shape, dtype=cp.float32)
-            else:
-                dFdD = np.zeros(kwargs['dose'].shape, dtype=np.float32)
-
-            for i in range(len(self.functionList)):
-                df_idD = self.functionList[i].weight * self.functionList[i].grad(x, **kwargs)
-                if self.GPU_acceleration:
-                    dFdD[self.functionList[i].maskVec_GPU] += df_idD
-                else:
-                    dFdD[self.functionList[i].maskVec] += df_idD
-            self.gradVector = dFdD
+        gradVector = self._zeroGrad(x, **kwargs)
+        for i in range(len(self.functionList)):
+            self._addGrad(gradVector, self.functionList[i], self.functionList[i].grad(x, **kwargs), **kwargs)
+        self.gradVector = gradVector
+        return gradVector
+
+    def _valueAndGrad(self, x, **kwargs):
+        # Single pass over the objectives
+        F = 0.0
+        gradVector = self._zeroGrad(x, **kwargs)
+        for i in range(len(self.functionList)):
+            f_i, g_i = self.functionList[i].valueAndGrad(x, **kwargs)
+            F += self.functionList[i].weight * f_i
+            self._addGrad(gradVector, self.functionList[i], g_i, **kwargs)
+        self.fValue = F
+        self.gradVector = gradVector
+        return F, gradVector
+
+    def _zeroGrad(self, x, **kwargs):
+        size = kwargs['dose'].shape if kwargs.get('return_dfdD', False) else len(x)
+        if self.GPU_acceleration:
+            return cp.zeros(size, dtype=cp.float32)
+        return np.zeros(size, dtype=np.float32)
 
+    def _addGrad(self, gradVector, function, grad, **kwargs):
+        if kwargs.get('return_dfdD', False):
+            gradVector[_doseIndices(function, self.GPU_acceleration)] += function.weight * grad
         else:
-            if self.GPU_acceleration:
-                dFdx = cp.zeros(len(x), dtype=cp.float32)
-            else:
-                dFdx = np.zeros(len(x), dtype=np.float32)
-
-            for i in range(len(self.functionList)):
-                df_idx = self.functionList[i].weight * self.functionList[i].grad(x, **kwargs)
-                dFdx += df_idx
-            self.gradVector = dFdx
-        return self.gradVector
\ No newline at end of file
+            gradVector += function.weight * grad
+
+
+def _doseIndices(function, GPU_acceleration=False):
+    # Row index list of the objective ROI if precomputed (see DosimetricObjective._updateRowIndices), mask otherwise
+    if GPU_acceleration:
+        rowIndices = getattr(function, 'rowIndices_GPU', None)
+        return function.maskVec_GPU if rowIndices is None else rowIndices
+    rowIndices = getattr(function, 'rowIndices', None)
+    return function.maskVec if rowIndices is None else rowIndices
\ No newline at end of file
@@ -1,61 +1,66 @@
-from opentps.core.processing.planOptimization.objectives.baseFunction import BaseFunc
-import numpy as np
-import threading
-import time
+from opentps.core.processing.planOptimization.objectives.weightedSum import WeightedSum
+from concurrent.futures import ThreadPoolExecutor
 
 
-class WeightedSumMultiThread(BaseFunc):
-    def __init__(self, Nthreads=10):
+class WeightedSumMultiThread(WeightedSum):
+    """
+    Weighted sum of objectives evaluated concurrently on a pool of threads. The NumPy kernels of the objectives release
+    the GIL. The partial results are gathered and reduced in the calling thread, in the order of functionList, with the
+    helpers of WeightedSum.
+
+    Attributes
+    ----------
+    functionList : list of BaseFunc
+        The objectives
+    Nthreads : int (default: 10)
+        Number of threads of the pool created when no executor is given
+    executor : concurrent.futures.Executor or None
+        Pool running the objectives, typically owned by the PlanOptimizer and reused across evaluations. Created on
+        first use if None.
+    """
+    def __init__(self, Nthreads=10, executor=None):
         super(WeightedSumMultiThread, self).__init__()
-        self.functionList = []
-        self.fValue = 0.0
-        self.gradVector = None
         self.Nthreads = Nthreads
+        self.executor = executor
 
-    def _eval(self, x, **kwargs):
-        threads = []
+    def _getExecutor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.Nthreads, thread_name_prefix='WeightedSum')
+        return self.executor
 
-        # Launch evaluation threads
-        for obj in self.functionList:
-            while threading.active_count() > self.Nthreads:
-                time.sleep(0.01)
-            t = threading.Thread(target=obj.eval, args=(x,), kwargs=kwargs)
-            threads.append(t)
-            t.start()
+    def _eval(self, x, **kwargs):
+        executor = self._getExecutor()
+        futures = [executor.submit(obj.eval, x, **kwargs) for obj in self.functionList]
 
-        # Wait for results and accumulate
         f = 0.0
-        for idx, obj in enumerate(self.functionList):
-            threads[idx].join()
-            f += obj.weight * obj.fValue
+        for obj, future in zip(self.functionList, futures):
+            f += obj.weight * future.result()
 
         self.fValue = f
         return f
 
     def _grad(self, x, **kwargs):
-        return_dfdD = kwargs.get('return_dfdD', False)
-
-        if return_dfdD:
-            grad = np.zeros(kwargs['dose'].shape, dtype=np.float32)
-        else:
-            grad = np.zeros(len(x), dtype=np.float32)
-
-        # Launch gradient threads
-        threads = []
-        for obj in self.functionList:
-            while threading.active_count() > self.Nthreads:
-                time.sleep(0.01)
-            t = threading.Thread(target=obj.grad, args=(x,), kwargs=kwargs)
-            threads.append(t)
-            t.start()
-
-        # Wait for results and accumulate
-        for idx, obj in enumerate(self.functionList):
-            threads[idx].join()
-            if return_dfdD:
-                grad[obj.maskVec] += obj.weight * obj.gradVector
-            else:
-                grad += obj.weight * obj.gradVector
+        executor = self._getExecutor()
+        futures = [executor.submit(obj.grad, x, **kwargs) for obj in self.functionList]
+
+        grad = self._zeroGrad(x, **kwargs)
+        for obj, future in zip(self.functionList, futures):
+            self._addGrad(grad, obj, future.result(), **kwargs)
+
+        self.gradVector = grad
+        return grad
+
+    def _valueAndGrad(self, x, **kwargs):
+        executor = self._getExecutor()
+        futures = [executor.submit(obj.valueAndGrad, x, **kwargs) for obj in self.functionList]
 
+        f = 0.0
+        grad = self._zeroGrad(x, **kwargs)
+        for obj, future in zip(self.functionList, futures):
+            f_i, g_i = future.result()
+            f += obj.weight * f_i
+            self._addGrad(grad, obj, g_i, **kwargs)
+
+        self.fValue = f
         self.gradVector = grad
-        return grad
\ No newline at end of file
+        return f, grad
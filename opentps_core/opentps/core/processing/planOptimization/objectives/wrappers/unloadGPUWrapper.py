@@ -19,7 +19,7 @@ class UnloadGPUWrapper(BaseFunc):
         The function to be wrapped, which performs computations on the GPU.
     """
     def __init__(self, func):
-        super().__init__()
+        super().__init__(cacheResults=True)
         self.func = func
 
     def _eval(self, x, **kwargs):
@@ -33,4 +33,11 @@ class UnloadGPUWrapper(BaseFunc):
         grad = self.func.grad(x, **kwargs)
         grad = cp.asnumpy(grad)
         self.gradVector = grad
-        return self.gradVector
\ No newline at end of file
+        return self.gradVector
+
+    def _valueAndGrad(self, x, **kwargs):
+        x = cp.asarray(x)
+        f, grad = self.func.valueAndGrad(x, **kwargs)
+        self.fValue = f.get()
+        self.gradVector = cp.asnumpy(grad)
+        return self.fValue, self.gradVector
@@ -0,0 +1,410 @@
+import logging
+import time
+import unittest
+from typing import Optional, Sequence
+
+import numpy as np
+
+from opentps.core.data.plan._photonPlan import PhotonPlan
+from opentps.core.data.plan._protonPlan import ProtonPlan
+from opentps.core.processing.planOptimization.objectives.baseFunction import BaseFunc
+from opentps.core.processing.planOptimization.planOptimization import PlanOptimizer, BoundConstraintsOptimizer
+from opentps.core.processing.planOptimization.solvers import bfgs, scipyOpt
+
+logger = logging.getLogger(__name__)
+
+# Objective parameters that can change between two solves of a session. The others (metric, ROI, robustness, fall-off
+# distance) define the rows of the objectives and the structure of the objective function: they require a new session.
+TUNABLE_PARAMETERS = ('weight', 'limitValue', 'volume', 'EUDa', 'fallOffHighDoseLevel', 'fallOffLowDoseLevel')
+
+
+def _clearFunctionCaches(function, visited=None):
+    # Values and gradients cached in the objective function tree depend on the objective parameters. The doses cached
+    # by the dose evaluators only depend on the weights and are kept.
+    if visited is None:
+        visited = set()
+    if id(function) in visited:
+        return
+    visited.add(id(function))
+    if isinstance(function, BaseFunc):
+        function.clearCache()
+    for name in ('func', 'function', 'nonRobustFunction'):
+        child = getattr(function, name, None)
+        if not (child is None):
+            _clearFunctionCaches(child, visited)
+    for name in ('robustFunctions', 'functionList'):
+        for child in getattr(function, name, None) or []:
+            _clearFunctionCaches(child, visited)
+
+
+def _roiName(objective) -> Optional[str]:
+    roi = getattr(objective, 'roi', None)
+    return getattr(roi, 'name', None)
+
+
+class OptimizationSession:
+    """
+    Successive optimizations of a plan with the same objectives, whose parameters (weights, dose limits, DVH volumes,
+    ...) change between the solves, e.g. for interactive objective tuning.
+
+    The first solve prepares the optimizer as PlanOptimizer.optimize does: cropping of the beamlet matrices on the
+    objective ROIs, row indices of the ROIs and dose fidelity functions. The session keeps them for the next solves,
+    which start from the previous solution. With the in-house BFGS and L-BFGS solvers, the inverse Hessian estimate
+    (resp. the last update pairs) of the previous solve is kept as well, as is the inverse Hessian of Scipy BFGS.
+    Scipy L-BFGS-B cannot be given a prior memory: it only starts from the previous solution.
+
+    The spots with a low weight are only removed from the plan and the beamlet matrix (see PlanOptimizer.postProcess)
+    when the session is closed, so that the optimization variables are the same from one solve to the next. Adding or
+    removing objectives, changing their ROIs or the robustness settings requires a new session.
+
+    A session can continue an optimization made with PlanOptimizer.optimize: with warmStart=True, its first solve
+    starts from the MUs of the plan when the session is created, without multi-resolution levels.
+
+    Attributes
+    ----------
+    optimizer : PlanOptimizer
+        Optimizer of the plan. Its options (acceleration, cropping, multi-resolution, ...) are used as in optimize().
+    x : np.ndarray or None
+        Solution of the last solve, initial point of the next one
+    result : dict or None
+        Result of the last solve, as returned by the solver
+    numberOfSolves : int
+        Number of solves of the session
+    """
+    def __init__(self, optimizer:PlanOptimizer, warmStart:bool=False):
+        if isinstance(optimizer, BoundConstraintsOptimizer) and optimizer.bounds[0] > 0:
+            raise ValueError('The two-step optimization of a minimum spot weight removes spots: it cannot be used in an optimization session')
+        self.optimizer = optimizer
+        self.x = None
+        self.result = None
+        self.numberOfSolves = 0
+        self._objectiveList = optimizer.plan.planDesign.objectives
+        # Objective functions of a previous optimize() are built on the beamlets before the removal of the spots
+        optimizer.functions = []
+        self._initialX = self._planWeights() if warmStart else None
+
+        if isinstance(optimizer.solver, bfgs.BFGS):
+            optimizer.solver.keepMemory = True
+
+    @property
+    def plan(self):
+        return self.optimizer.plan
+
+    @property
+    def objectives(self) -> Sequence[BaseFunc]:
+        return self._objectiveList.objectivesList
+
+    def isCompatible(self, objectives:Sequence[BaseFunc]) -> bool:
+        """
+        Checks that a list of objectives only differs from the objectives of the session by tunable parameters (see
+        TUNABLE_PARAMETERS)
+
+        Parameters
+        ----------
+        objectives : Sequence[BaseFunc]
+            Objectives, in the order of the objectives of the session
+
+        Returns
+        -------
+        bool
+            True if updateObjectives can be called with these objectives
+        """
+        if len(objectives) != len(self.objectives):
+            return False
+        for objective, newObjective in zip(self.objectives, objectives):
+            if type(objective) is not type(newObjective) or objective.robust != newObjective.robust:
+                return False
+            if _roiName(objective) != _roiName(newObjective):
+                return False
+            if getattr(objective, 'fallOffDistance', None) != getattr(newObjective, 'fallOffDistance', None):
+                return False
+        return True
+
+    def updateObjectives(self, objectives:Sequence[BaseFunc]):
+        """
+        Copies the tunable parameters of a list of objectives (e.g. built again from a user interface) to the objectives
+        of the session. The objective list of the session is set back on the plan design.
+
+        Parameters
+        ----------
+        objectives : Sequence[BaseFunc]
+            Objectives, in the order of the objectives of the session
+        """
+        if not self.isCompatible(objectives):
+            raise ValueError('The objectives differ from the objectives of the session by more than their parameters')
+        for objective, newObjective in zip(self.objectives, objectives):
+            parameters = {name: getattr(newObjective, name) for name in TUNABLE_PARAMETERS if hasattr(newObjective, name)}
+            self.setObjectiveParameters(objective, **parameters)
+        self.plan.planDesign.objectives = self._objectiveList
+
+    def setObjectiveParameters(self, objective:BaseFunc, **parameters):
+        """
+        Changes parameters of an objective of the session. They are taken into account by the next solve.
+
+        Parameters
+        ----------
+        objective : BaseFunc
+            Objective of the session
+        parameters
+            New values of parameters in TUNABLE_PARAMETERS
+        """
+        for name in parameters:
+            if not (name in TUNABLE_PARAMETERS) or not hasattr(objective, name):
+                raise ValueError('{} is not a tunable parameter of {} objectives'.format(name, objective.__class__.__name__))
+        if parameters.get('weight', 0) < 0:
+            raise ValueError("weight must be non-negative (currently set to {} for {} objective)".format(parameters['weight'], objective.__class__.__name__))
+        if 'volume' in parameters and (parameters['volume'] <= 0 or parameters['volume'] > 1):
+            raise ValueError("volume must be in (0,1] but is set to {}".format(parameters['volume']))
+
+        highDoseLevel = parameters.pop('fallOffHighDoseLevel', getattr(objective, 'fallOffHighDoseLevel', None))
+        lowDoseLevel = parameters.pop('fallOffLowDoseLevel', getattr(objective, 'fallOffLowDoseLevel', None))
+        if not (highDoseLevel is None) and (highDoseLevel != objective.fallOffHighDoseLevel or lowDoseLevel != objective.fallOffLowDoseLevel):
+            self._setFallOffLevels(objective, highDoseLevel, lowDoseLevel)
+
+        for name, value in parameters.items():
+            setattr(objective, name, value)
+
+    @staticmethod
+    def _setFallOffLevels(objective, highDoseLevel, lowDoseLevel):
+        # The voxel-wise limits decrease linearly from the high to the low dose level with the distance to the target:
+        # the relative distance of each voxel is recovered from the current limits
+        if objective.fallOffHighDoseLevel == objective.fallOffLowDoseLevel:
+            raise ValueError('The distances of a fall-off objective with equal dose levels are unknown: a new session is needed')
+        relativeDistance = (objective.fallOffHighDoseLevel - objective.voxelwiseLimitValue) / \
+                           (objective.fallOffHighDoseLevel - objective.fallOffLowDoseLevel)
+        objective.voxelwiseLimitValue = highDoseLevel - relativeDistance * (highDoseLevel - lowDoseLevel)
+        objective.fallOffHighDoseLevel = highDoseLevel
+        objective.fallOffLowDoseLevel = lowDoseLevel
+
+    def _bounds(self):
+        if isinstance(self.optimizer, BoundConstraintsOptimizer):
+            return self.optimizer.formatBoundsForSolver(self.optimizer.bounds)
+        return self.optimizer.opti_params.get('bounds', None)
+
+    def _prepare(self, bounds):
+        logger.info('Prepare optimization session ...')
+        self.optimizer.initializeFidObjectiveFunction()
+        if not (self._initialX is None):
+            x0 = self._initialX.copy()
+        else:
+            x0 = np.asarray(self.optimizer.initializeWeights(), dtype=np.float32)
+        # The trace of the optimizer, if enabled, records all the solves of the session
+        self.optimizer._startTrace()
+        if self.optimizer.multiResolution and self._initialX is None:
+            x0 = self.optimizer._optimizeOnVoxelSamples(x0, bounds)
+        return x0
+
+    def _planWeights(self) -> np.ndarray:
+        # Optimization variables of the MUs of the plan (inverse of the conversion of _applyResult)
+        if isinstance(self.plan, ProtonPlan):
+            MUs = self.plan.spotMUs
+        else:
+            MUs = self.plan.beamletMUs
+        weights = np.asarray(MUs, dtype=np.float64) * self.plan.numberOfFractionsPlanned
+        if weights.size != self.plan.planDesign.beamlets.shape[1]:
+            raise ValueError('The plan has {} spots but the beamlet matrix has {} columns'.format(weights.size, self.plan.planDesign.beamlets.shape[1]))
+        if self.optimizer.xSquared:
+            weights = np.sqrt(np.maximum(weights, 0))
+        return weights.astype(np.float32)
+
+    def solve(self, maxiter:Optional[int]=None):
+        """
+        Optimizes the plan, starting from the solution of the previous solve. The optimized weights are saved in the
+        plan (spotMUs or beamletMUs).
+
+        Parameters
+        ----------
+        maxiter : int (default: None)
+            Maximum number of iterations of this solve. The option of the solver is used if None.
+
+        Returns
+        -------
+        DoseImage
+            The total dose.
+        list
+            The cost at each iteration.
+        """
+        startTime = time.time()
+        solver = self.optimizer.solver
+        bounds = self._bounds()
+        if self.x is None:
+            x0 = self._prepare(bounds)
+        else:
+            _clearFunctionCaches(self.optimizer.functions[0])
+            self.optimizer._startTrace(reset=False)
+            x0 = self.x.copy()
+            if isinstance(solver, scipyOpt.ScipyOpt) and solver.meth == 'BFGS':
+                hessInv = self._previousHessInv(solver, x0.size)
+                if not (hessInv is None):
+                    solver.params['hess_inv0'] = hessInv
+
+        hasMaxIter = 'maxiter' in solver.params
+        maxIter = solver.params.get('maxiter', None)
+        if not (maxiter is None):
+            solver.params['maxiter'] = maxiter
+        try:
+            if bounds is not None:
+                result = solver.solve(self.optimizer.functions, x0, bounds=bounds)
+            else:
+                result = solver.solve(self.optimizer.functions, x0)
+        finally:
+            if hasMaxIter:
+                solver.params['maxiter'] = maxIter
+            else:
+                solver.params.pop('maxiter', None)
+            solver.params.pop('hess_inv0', None)
+
+        self.numberOfSolves += 1
+        self.result = result
+        self.x = np.array(result['sol'], dtype=np.float32)
+        return self._applyResult(result, time.time() - startTime)
+
+    @staticmethod
+    def _previousHessInv(solver, size):
+        # The inverse Hessian estimate of Scipy BFGS may lose its positive definiteness in float precision
+        if solver.hessInv is None or solver.hessInv.shape[0] != size:
+            return None
+        hessInv = 0.5 * (solver.hessInv + solver.hessInv.T)
+        try:
+            np.linalg.cholesky(hessInv)
+        except np.linalg.LinAlgError:
+            logger.info('The inverse Hessian of the previous solve is not positive definite: BFGS starts from the identity')
+            return None
+        return hessInv
+
+    def _applyResult(self, result, elapsedTime):
+        optimizer = self.optimizer
+        optimizer.weights = np.array(result['sol'])
+        optimizer.niter = max(result['niter'], 1)
+        optimizer.time = result['time']
+        optimizer.cost = result['objective']
+        logger.info('Solve {} of the optimization session: {} iterations, {:.2f} s'.format(self.numberOfSolves, optimizer.niter, elapsedTime))
+
+        if optimizer.xSquared:
+            MUs = np.square(optimizer.weights).astype(np.float32) / self.plan.numberOfFractionsPlanned
+        else:
+            MUs = optimizer.weights.astype(np.float32) / self.plan.numberOfFractionsPlanned
+        if isinstance(self.plan, ProtonPlan):
+            self.plan.spotMUs = MUs
+        elif isinstance(self.plan, PhotonPlan):
+            self.plan.beamletMUs = MUs
+        self.plan.planDesign.beamlets._weights = MUs
+
+        return optimizer.computeDose(), optimizer.cost
+
+    def close(self):
+        """
+        Removes the spots with a low weight from the plan and the beamlet matrix (see PlanOptimizer.postProcess),
+        releases the objective functions of the session and unloads the scenario beamlets
+        """
+        if not (self.result is None):
+            self.optimizer.postProcess(self.result)
+        self.optimizer.functions = []
+        self.optimizer._shutdownExecutor()
+        for scenario in self.plan.planDesign.robustness.scenarios:
+            scenario.unload()
+        if isinstance(self.optimizer.solver, bfgs.BFGS):
+            self.optimizer.solver.keepMemory = False
+        self.x = None
+        self.result = None
+
+
+class OptimizationSessionTestCase(unittest.TestCase):
+    def _createOptimizer(self, **kwargs):
+        from opentps.core.data.plan._planProtonBeam import PlanProtonBeam
+        from opentps.core.data.plan._planProtonLayer import PlanProtonLayer
+        from opentps.core.processing.planOptimization.benchmarks import createSyntheticCase
+        from opentps.core.processing.planOptimization.planOptimization import IntensityModulationOptimizer
+
+        case = createSyntheticCase(gridSize=(24, 24, 20), spacing=(5., 5., 5.), numberOfBeams=2, spotSpacing=10.,
+                                   targetRadius=25., objectiveSet='target')
+        plan = case.createPlan()
+        # One spot per column of the beamlet matrix, so that the plan can be simplified by postProcess
+        layer = PlanProtonLayer(100.)
+        layer.appendSpot(np.arange(case.numberOfSpots, dtype=float), np.zeros(case.numberOfSpots), np.ones(case.numberOfSpots))
+        beam = PlanProtonBeam()
+        beam.appendLayer(layer)
+        plan.appendBeam(beam)
+        plan.numberOfFractionsPlanned = 1
+        return IntensityModulationOptimizer('Scipy_L-BFGS-B', plan, maxiter=15, **kwargs), case
+
+    def testWarmStartFromPreviousSolve(self):
+        from unittest import mock
+
+        optimizer, _ = self._createOptimizer()
+        session = OptimizationSession(optimizer)
+        solver = optimizer.solver
+        params = dict(solver.params)
+
+        _, cost = session.solve()
+        x = session.x.copy()
+        self.assertEqual(solver.params, params)
+
+        with mock.patch.object(solver, 'solve', wraps=solver.solve) as solve:
+            _, secondCost = session.solve(maxiter=3)
+        np.testing.assert_array_equal(solve.call_args[0][1], x)
+        self.assertLessEqual(secondCost[0], cost[-1] * (1 + 1e-5))
+        self.assertEqual(solver.params, params)
+        self.assertEqual(session.numberOfSolves, 2)
+        self.assertEqual(len(optimizer.functions), 1)
+        session.close()
+
+    def testObjectiveUpdates(self):
+        optimizer, case = self._createOptimizer()
+        session = OptimizationSession(optimizer)
+
+        objectives = case.createObjectives()
+        self.assertTrue(session.isCompatible(objectives))
+        objectives[0].weight = 5.
+        objectives[1].limitValue = 70.
+        session.updateObjectives(objectives)
+        self.assertEqual(session.objectives[0].weight, 5.)
+        self.assertEqual(session.objectives[1].limitValue, 70.)
+        self.assertIsNot(session.objectives[0], objectives[0])
+
+        self.assertFalse(session.isCompatible(objectives[:1]))
+        swapped = [objectives[1], objectives[0]]
+        self.assertFalse(session.isCompatible(swapped))
+        with self.assertRaises(ValueError):
+            session.updateObjectives(swapped)
+        with self.assertRaises(ValueError):
+            session.setObjectiveParameters(session.objectives[0], roi=None)
+
+    def testHessInvFallback(self):
+        from types import SimpleNamespace
+
+        hessInv = np.array([[2., 0.5], [0.4, 1.]])
+        np.testing.assert_allclose(OptimizationSession._previousHessInv(SimpleNamespace(hessInv=hessInv), 2),
+                                   [[2., 0.45], [0.45, 1.]])
+        self.assertIsNone(OptimizationSession._previousHessInv(SimpleNamespace(hessInv=np.diag([1., -1.])), 2))
+        self.assertIsNone(OptimizationSession._previousHessInv(SimpleNamespace(hessInv=hessInv), 3))
+        self.assertIsNone(OptimizationSession._previousHessInv(SimpleNamespace(hessInv=None), 2))
+
+    def testContinueOptimizeAndClose(self):
+        optimizer, _ = self._createOptimizer()
+        optimizer.optimize()
+        plan = optimizer.plan
+        MUs = np.array(plan.spotMUs)
+        self.assertEqual(plan.planDesign.beamlets.shape[1], len(MUs))
+
+        session = OptimizationSession(optimizer, warmStart=True)
+        self.assertEqual(optimizer.functions, [])
+        np.testing.assert_allclose(np.square(session._initialX), MUs, rtol=1e-5)
+        session.solve(maxiter=5)
+        session.close()
+
+        self.assertIsNone(session.x)
+        self.assertEqual(optimizer.functions, [])
+        self.assertEqual(plan.planDesign.beamlets.shape[1], len(plan.spotMUs))
+        self.assertTrue(np.all(plan.spotMUs > optimizer.thresholdSpotRemoval))
+
+    def testMinimumSpotWeightIsRejected(self):
+        from opentps.core.processing.planOptimization.planOptimization import BoundConstraintsOptimizer
+
+        optimizer, _ = self._createOptimizer()
+        with self.assertRaises(ValueError):
+            OptimizationSession(BoundConstraintsOptimizer(optimizer.plan, bounds=(0.1, 10)))
+
+
+if __name__ == '__main__':
+    unittest.main()
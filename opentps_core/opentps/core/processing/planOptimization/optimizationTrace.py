@@ -0,0 +1,433 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import unittest
+from typing import Optional
+
+try:
+    import resource
+    resource_available = True
+except:
+    resource_available = False
+
+logger = logging.getLogger(__name__)
+
+# Time categories of the iterations: sparse matrix-vector products with the beamlet matrices (B.w and B^T.y), passes
+# over the objectives computing their values (eval) or only their gradients (grad), and line searches of the in-house
+# solvers. The line search time includes the products and evaluations made during the line search.
+CATEGORIES = ('spmv', 'eval', 'grad', 'linesearch')
+
+_NO_SPAN = contextlib.nullcontext()
+
+
+def traceSpan(trace, category:str, name:Optional[str]=None):
+    """
+    Context manager timing a block of code in a trace, doing nothing if trace is None
+
+    Parameters
+    ----------
+    trace : OptimizationTrace or None
+        The trace
+    category : str
+        Time category of the block (see CATEGORIES)
+    name : str (default: None)
+        Name of the block in the exported events. category if None.
+    """
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, category, name)
+
+
+def setTrace(function, trace, visited=None):
+    """
+    Sets a trace on all the functions and dose evaluators of an objective function tree that support it
+
+    Parameters
+    ----------
+    function : BaseFunc
+        Root of the tree
+    trace : OptimizationTrace or None
+        The trace. None disables the tracing.
+    """
+    if visited is None:
+        visited = set()
+    if function is None or id(function) in visited:
+        return
+    visited.add(id(function))
+    if hasattr(function, 'trace'):
+        function.trace = trace
+    for name in ('func', 'function', 'nonRobustFunction', 'doseEvaluator'):
+        setTrace(getattr(function, name, None), trace, visited)
+    for name in ('robustFunctions', 'functionList'):
+        for child in getattr(function, name, None) or []:
+            setTrace(child, trace, visited)
+
+
+def processMemory() -> Optional[int]:
+    """
+    Resident memory of the process in bytes (high-water mark if the current value is not available on the platform).
+    None if unknown.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    if resource_available:
+        maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return int(maxRSS) if os.uname().sysname == 'Darwin' else int(maxRSS) * 1024
+    return None
+
+
+class _Span:
+    __slots__ = ('trace', 'category', 'name', 'start')
+
+    def __init__(self, trace, category, name):
+        self.trace = trace
+        self.category = category
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.trace.addTime(self.category, time.perf_counter() - self.start, name=self.name, start=self.start)
+        return False
+
+
+class OptimizationTrace:
+    """
+    Structured log of the iterations of a plan optimization (see PlanOptimizer.enableTrace). The dose evaluators,
+    dose fidelity functions and line searches add the time they spend to the current iteration, which the solvers
+    close at the end of each iteration.
+
+    Each record of the log is a dict with the keys:
+        solve : index of the solve (the multi-resolution levels and the two steps of BoundConstraintsOptimizer are
+        separate solves)
+        solver : name of the solver
+        stage : label of the solve set by the optimizer (e.g. voxel sampling level), None for a solve on all the voxels
+        iteration : iteration of the solve, 0 for the evaluations made before the first iteration
+        time : time since the start of the trace, in seconds
+        duration : wall time of the iteration, in seconds
+        spmvTime, evalTime, gradTime, lineSearchTime : time spent in each category (see CATEGORIES), in seconds
+        cost : value of the objective function at the end of the iteration
+        worstCaseScenario : index of the worst case scenario at the last evaluation (robust optimization)
+        activeVoxels : number of voxels with a non-zero gradient of the objectives at the last gradient evaluation
+        memory : resident memory of the process in bytes
+    When the scenarios or objectives are evaluated concurrently (MT-n), the times of the threads add up and may exceed
+    the wall time of the iteration. On GPU, the products are timed up to the launch of their kernels.
+
+    Attributes
+    ----------
+    records : list of dict
+        Iteration records
+    spans : list of tuple
+        (category, name, start time, duration, thread id) of each timed block, if keepSpans is True
+    metadata : dict
+        Description of the optimization, set by start()
+    keepSpans : bool (default: False)
+        If true, each timed block is kept in spans, for a detailed Chrome trace. Otherwise only the iteration totals
+        are kept.
+    trackMemory : bool (default: True)
+        If true, the resident memory of the process is recorded at each iteration
+    stage : str or None
+        Label of the following solves
+    """
+    def __init__(self, keepSpans:bool=False, trackMemory:bool=True):
+        self.keepSpans = keepSpans
+        self.trackMemory = trackMemory
+        self.records = []
+        self.spans = []
+        self.metadata = {}
+        self.stage = None
+        self._lock = threading.Lock()
+        self._startTime = time.perf_counter()
+        self._iterationStart = self._startTime
+        self._times = dict.fromkeys(CATEGORIES, 0.0)
+        self._values = {}
+        self._solve = -1
+        self._solver = None
+
+    def start(self, **metadata):
+        """
+        Clears the trace and sets its time origin
+
+        Parameters
+        ----------
+        metadata
+            Description of the optimization, saved with the exports
+        """
+        with self._lock:
+            self.records = []
+            self.spans = []
+            self.metadata = metadata
+            self.stage = None
+            self._startTime = time.perf_counter()
+            self._iterationStart = self._startTime
+            self._times = dict.fromkeys(CATEGORIES, 0.0)
+            self._values = {}
+            self._solve = -1
+            self._solver = None
+
+    def beginSolve(self, solver:str):
+        """
+        Starts a new solve. The time spent since the end of the last iteration (e.g. building the objective function
+        of a multi-resolution level) is not counted in the first iteration.
+
+        Parameters
+        ----------
+        solver : str
+            Name of the solver
+        """
+        with self._lock:
+            self._solve += 1
+            self._solver = solver
+            self._iterationStart = time.perf_counter()
+            self._times = dict.fromkeys(CATEGORIES, 0.0)
+            self._values = {}
+
+    def addTime(self, category:str, duration:float, name:Optional[str]=None, start:Optional[float]=None):
+        """
+        Adds time to a category of the current iteration
+
+        Parameters
+        ----------
+        category : str
+            Time category (see CATEGORIES)
+        duration : float
+            Time in seconds
+        name : str (default: None)
+            Name of the timed block, for the spans
+        start : float (default: None)
+            time.perf_counter() at the start of the block, for the spans
+        """
+        with self._lock:
+            self._times[category] = self._times.get(category, 0.0) + duration
+            if self.keepSpans:
+                self.spans.append((category, category if name is None else name,
+                                   (time.perf_counter() - duration) if start is None else start, duration,
+                                   threading.get_ident()))
+
+    def setValue(self, name:str, value):
+        """
+        Sets a value of the current iteration record (e.g. worstCaseScenario, activeVoxels). The last value set during
+        the iteration is recorded.
+        """
+        self._values[name] = value
+
+    def endIteration(self, iteration:int, cost=None):
+        """
+        Closes the current iteration and appends its record to the log
+
+        Parameters
+        ----------
+        iteration : int
+            Iteration of the solve
+        cost : float (default: None)
+            Value of the objective function at the end of the iteration
+        """
+        now = time.perf_counter()
+        memory = processMemory() if self.trackMemory else None
+        with self._lock:
+            record = {'solve': max(self._solve, 0), 'solver': self._solver, 'stage': self.stage, 'iteration': iteration,
+                      'time': now - self._startTime, 'duration': now - self._iterationStart,
+                      'spmvTime': self._times['spmv'], 'evalTime': self._times['eval'],
+                      'gradTime': self._times['grad'], 'lineSearchTime': self._times['linesearch'],
+                      'cost': None if cost is None else float(cost),
+                      'worstCaseScenario': self._values.get('worstCaseScenario', None),
+                      'activeVoxels': self._values.get('activeVoxels', None),
+                      'memory': memory}
+            self.records.append(record)
+            self._iterationStart = now
+            self._times = dict.fromkeys(CATEGORIES, 0.0)
+            self._values = {}
+        logger.debug('Iteration {}: {:.4f} s (SpMV {:.4f} s, eval {:.4f} s, grad {:.4f} s, line search {:.4f} s)'.format(
+            iteration, record['duration'], record['spmvTime'], record['evalTime'], record['gradTime'],
+            record['lineSearchTime']))
+        return record
+
+    def summary(self) -> dict:
+        """
+        Totals over all the iterations: number of iterations, wall time and time of each category in seconds
+        """
+        with self._lock:
+            records = list(self.records)
+        summary = {'iterations': sum(1 for record in records if record['iteration'] > 0),
+                   'duration': sum(record['duration'] for record in records)}
+        for key in ('spmvTime', 'evalTime', 'gradTime', 'lineSearchTime'):
+            summary[key] = sum(record[key] for record in records)
+        return summary
+
+    def toJSONLines(self, filePath:str):
+        """
+        Writes the metadata then one iteration record per line in a JSON-lines file
+        """
+        with self._lock:
+            records = list(self.records)
+        with open(filePath, 'w') as f:
+            f.write(json.dumps({'metadata': self.metadata}, default=str) + '\n')
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    def toChromeTrace(self, filePath:str):
+        """
+        Writes the trace in the Chrome trace event format (chrome://tracing, Perfetto). Each solve and each iteration is
+        a complete event, with the iteration record as arguments. The timed blocks are added if keepSpans is True.
+        The cost, memory and number of active voxels are counters.
+        """
+        with self._lock:
+            records = list(self.records)
+            spans = list(self.spans)
+        pid = os.getpid()
+        mainThread = threading.main_thread().ident
+        toMicroseconds = 1e6
+
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': 'Plan optimization'}}]
+        solves = {}
+        for record in records:
+            start = (record['time'] - record['duration']) * toMicroseconds
+            events.append({'name': 'Iteration {}'.format(record['iteration']), 'cat': 'iteration', 'ph': 'X',
+                           'ts': start, 'dur': record['duration'] * toMicroseconds, 'pid': pid, 'tid': mainThread,
+                           'args': record})
+            for key in ('cost', 'memory', 'activeVoxels'):
+                if not (record[key] is None):
+                    events.append({'name': key, 'ph': 'C', 'ts': record['time'] * toMicroseconds, 'pid': pid,
+                                   'args': {key: record[key]}})
+            solve = solves.setdefault(record['solve'], [start, start, record['solver'], record['stage']])
+            solve[1] = record['time'] * toMicroseconds
+
+        for index, (start, stop, solver, stage) in solves.items():
+            name = '{} ({})'.format(solver, stage) if stage else str(solver)
+            events.append({'name': name, 'cat': 'solve', 'ph': 'X', 'ts': start, 'dur': stop - start, 'pid': pid,
+                           'tid': mainThread, 'args': {'solve': index}})
+        for category, name, start, duration, threadId in spans:
+            events.append({'name': name, 'cat': category, 'ph': 'X', 'ts': (start - self._startTime) * toMicroseconds,
+                           'dur': duration * toMicroseconds, 'pid': pid, 'tid': threadId})
+
+        with open(filePath, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': self.metadata}, f, default=str)
+
+
+class OptimizationTraceTestCase(unittest.TestCase):
+    def testIterationRecords(self):
+        trace = OptimizationTrace(trackMemory=False)
+        trace.start(method='test')
+        trace.beginSolve('Scipy_L-BFGS-B')
+        trace.endIteration(0, cost=10.)
+        trace.addTime('spmv', 0.5)
+        trace.addTime('spmv', 0.25)
+        trace.addTime('eval', 0.125)
+        trace.setValue('activeVoxels', 42)
+        record = trace.endIteration(1, cost=5.)
+
+        self.assertEqual(record['solve'], 0)
+        self.assertEqual(record['solver'], 'Scipy_L-BFGS-B')
+        self.assertIsNone(record['stage'])
+        self.assertEqual(record['iteration'], 1)
+        self.assertEqual(record['spmvTime'], 0.75)
+        self.assertEqual(record['evalTime'], 0.125)
+        self.assertEqual(record['gradTime'], 0.)
+        self.assertEqual(record['cost'], 5.)
+        self.assertEqual(record['activeVoxels'], 42)
+        self.assertIsNone(record['worstCaseScenario'])
+        self.assertIsNone(record['memory'])
+
+        # The times and values are reset at the end of each iteration and at the start of each solve
+        trace.stage = 'sample'
+        trace.addTime('grad', 1.)
+        trace.beginSolve('FISTA')
+        trace.addTime('linesearch', 2.)
+        record = trace.endIteration(1, cost=4.)
+        self.assertEqual(record['solve'], 1)
+        self.assertEqual(record['stage'], 'sample')
+        self.assertEqual(record['gradTime'], 0.)
+        self.assertEqual(record['lineSearchTime'], 2.)
+        self.assertIsNone(record['activeVoxels'])
+
+        summary = trace.summary()
+        self.assertEqual(summary['iterations'], 2)
+        self.assertEqual(summary['spmvTime'], 0.75)
+        self.assertEqual(summary['evalTime'], 0.125)
+        self.assertEqual(summary['gradTime'], 0.)
+        self.assertEqual(summary['lineSearchTime'], 2.)
+        self.assertAlmostEqual(summary['duration'], sum(record['duration'] for record in trace.records))
+
+    def testTraceSpan(self):
+        self.assertIs(traceSpan(None, 'spmv'), _NO_SPAN)
+        with traceSpan(None, 'spmv'):
+            pass
+
+        trace = OptimizationTrace(keepSpans=True, trackMemory=False)
+        with traceSpan(trace, 'grad', 'dose'):
+            time.sleep(0.001)
+        record = trace.endIteration(1)
+        self.assertGreater(record['gradTime'], 0.)
+        self.assertEqual(len(trace.spans), 1)
+        category, name, start, duration, threadId = trace.spans[0]
+        self.assertEqual((category, name, duration, threadId), ('grad', 'dose', record['gradTime'], threading.get_ident()))
+
+    def testSetTrace(self):
+        from types import SimpleNamespace
+
+        evaluator = SimpleNamespace(trace=None)
+        fidelity = SimpleNamespace(trace=None, doseEvaluator=evaluator)
+        robust = SimpleNamespace(trace=None, nonRobustFunction=fidelity, robustFunctions=[fidelity])
+        noTrace = SimpleNamespace()
+        root = SimpleNamespace(functionList=[robust, noTrace])
+        root.func = root
+
+        trace = OptimizationTrace()
+        setTrace(root, trace)
+        self.assertFalse(hasattr(root, 'trace'))
+        self.assertFalse(hasattr(noTrace, 'trace'))
+        for function in (evaluator, fidelity, robust):
+            self.assertIs(function.trace, trace)
+
+        setTrace(root, None)
+        for function in (evaluator, fidelity, robust):
+            self.assertIsNone(function.trace)
+
+    def testExports(self):
+        import tempfile
+
+        trace = OptimizationTrace(keepSpans=True)
+        trace.start(method='test')
+        trace.beginSolve('Scipy_L-BFGS-B')
+        trace.addTime('spmv', 0.001, name='dose')
+        trace.setValue('activeVoxels', 7)
+        trace.endIteration(1, cost=3.)
+        trace.endIteration(2)
+
+        with tempfile.TemporaryDirectory() as directory:
+            jsonLinesPath = os.path.join(directory, 'trace.jsonl')
+            trace.toJSONLines(jsonLinesPath)
+            with open(jsonLinesPath) as f:
+                lines = [json.loads(line) for line in f]
+            chromePath = os.path.join(directory, 'trace.json')
+            trace.toChromeTrace(chromePath)
+            with open(chromePath) as f:
+                chrome = json.load(f)
+
+        self.assertEqual(lines[0], {'metadata': {'method': 'test'}})
+        self.assertEqual([line['iteration'] for line in lines[1:]], [1, 2])
+        self.assertEqual(lines[1]['cost'], 3.)
+
+        self.assertEqual(chrome['otherData'], {'method': 'test'})
+        events = chrome['traceEvents']
+        complete = [event for event in events if event['ph'] == 'X']
+        self.assertEqual(sorted(event['cat'] for event in complete), ['iteration', 'iteration', 'solve', 'spmv'])
+        self.assertEqual([event['name'] for event in complete if event['cat'] == 'solve'], ['Scipy_L-BFGS-B'])
+        self.assertEqual([event['name'] for event in complete if event['cat'] == 'spmv'], ['dose'])
+        counters = [event['name'] for event in events if event['ph'] == 'C']
+        self.assertEqual(counters.count('cost'), 1)
+        self.assertEqual(counters.count('activeVoxels'), 1)
+        if not (trace.records[0]['memory'] is None):
+            self.assertEqual(counters.count('memory'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
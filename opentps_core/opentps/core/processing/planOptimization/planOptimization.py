@@ -1,5 +1,7 @@
 import logging
 import math
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from typing import Iterable
 
 import numpy as np
@@ -8,12 +10,19 @@ import scipy.sparse as sp
 from opentps.core.data.plan._photonPlan import PhotonPlan
 from opentps.core.data.plan._rtPlan import RTPlan
 from opentps.core.data.plan._protonPlan import ProtonPlan
+from opentps.core.data._sparseBeamlets import SparseBeamlets
+from opentps.core.data._quantizedSparseMatrix import QuantizedSparseMatrix
 from opentps.core.processing.planOptimization.solvers import scipyOpt, bfgs
 from opentps.core.processing.planOptimization.solvers import fista, gradientDescent
 from opentps.core.processing.planOptimization import planPreprocessing
+from opentps.core.processing.planOptimization.voxelSampling import VoxelSampling
+from opentps.core.processing.planOptimization.optimizationTrace import OptimizationTrace, setTrace
 from scipy.sparse import csc_matrix
 from opentps.core.data.images._doseImage import DoseImage
 from opentps.core.processing.planOptimization.objectives.doseFidelity import DoseFidelity
+from opentps.core.processing.C_libraries import libSparseDot_wrapper
+from opentps.core.processing.planOptimization.objectives.doseEvaluator import DoseEvaluator
+from opentps.core.processing.planOptimization.objectives.scenarioBatch import ScenarioBatch
 from opentps.core.processing.planOptimization.objectives.weightedSum import WeightedSum
 from opentps.core.processing.planOptimization.objectives.weightedSumMultiThread import WeightedSumMultiThread
 from opentps.core.processing.planOptimization.objectives.robustFunctions.robustWorstCase import RobustWorstCase
@@ -71,11 +80,53 @@ class PlanOptimizer:
                 - 'MKL-n' : use the MKL library for the optimization with n threads.
                 - 'MKL-n-DEBUG' : use the MKL library for the optimization with n threads and the debug mode.
                 - 'MKL-DEBUG' : use the MKL library for the optimization with the debug mode.
-                - 'MT-n' : use multithreading for the optimization with n threads.
+                - 'MT-n' : use multithreading for the optimization with n threads (objectives and robust scenarios
+                  are evaluated concurrently, each on a pool of n threads).
                 - 'MT' : use multithreading for the optimization with 4 threads.
-            croppedMultiplication : bool (default: False)
-                If True, the beamlet matrix is cropped on the union of the ROIs defined in the objectives to speed up the gradient computation.
-                This method slows down multithreading though for GPU and acceleration, it remains faster.
+                - 'NATIVE-n' : compute the sparse products of the dose and gradient with the OpenMP library libSparseDot
+                  (C_libraries) with n threads. Linux only: the library is built with make in C_libraries. Falls back
+                  to scipy on the other systems or if the library is not built.
+                - 'NATIVE' : use libSparseDot with all the CPUs.
+            croppedMultiplication : bool
+                Deprecated and ignored. The gradients of all the objectives with respect to the dose are always
+                scattered in one vector over the union of their ROIs and multiplied once by the transposed beamlet matrix.
+            quantizedBeamlets : bool (default: False)
+                If True, the dose evaluators encode copies of the nominal and scenario beamlet matrices with 16-bit
+                values and a per-beamlet scale (see QuantizedSparseMatrix) and compute the products on them. The
+                beamlets of the plan keep their float32 matrix: to reduce memory usage, store them on the file system
+                first (SparseBeamlets.storeOnFS), so that the float32 matrix is memory-mapped and its pages can be
+                released during the optimization. Not available with GPU acceleration.
+            deltaCodedIndices : bool (default: False)
+                If True and quantizedBeamlets is True, the row indices of the beamlet matrices are also delta-coded.
+            csrBeamlets : bool (default: False)
+                If True, the doses are computed with a CSR copy of the beamlet matrices (see
+                SparseBeamlets.toCSRMatrix), cached on the beamlets and reused by the next optimizations of the same
+                plan. This doubles the memory of the matrices (bounded by SparseBeamlets.csrMemoryBudget) and pays off
+                with a multithreaded product backend ('NATIVE' or 'MKL'). Not available with GPU acceleration or
+                quantized beamlets.
+            multiResolution : list of float (default: None)
+                Coarse-to-fine optimization: before the optimization on all the voxels, the plan is optimized on
+                stratified random samples of the voxels of each objective ROI (see VoxelSampling), one level per
+                sampling fraction, e.g. [0.02, 0.1, 0.3]. The solution of each level initializes the next one.
+            multiResolutionIterations : int or list of int (default: 50)
+                Maximum number of iterations of each sampled level
+            multiResolutionMinVoxels : int (default: 100)
+                Minimum number of sampled voxels per ROI
+            multiResolutionSeed : int (default: None)
+                Seed of the voxel sampling
+            batchedScenarios : bool (default: False)
+                If True, the nominal and scenario beamlet matrices of a robust optimization are stacked in one block
+                operator (see ScenarioBatch) so that the doses of all the scenarios are computed with a single sparse
+                product per iteration. This requires memory for a copy of all the matrices and pays off with a
+                multithreaded product backend ('NATIVE' or 'MKL'). Not available with GPU acceleration or quantized
+                beamlets.
+            trace : bool (default: False)
+                If True, the iterations are recorded in an OptimizationTrace (see enableTrace)
+            traceSpans : bool (default: False)
+                If True, the trace also keeps each timed block, for a detailed Chrome trace
+    trace : OptimizationTrace or None
+        Per-iteration log of the last optimization (time split into sparse products, objective evaluations, gradients
+        and line searches, worst-case scenario, active voxels, memory). None if the tracing is disabled.
 
     """
     def __init__(self, plan:RTPlan, **kwargs):
@@ -94,11 +145,26 @@ class PlanOptimizer:
         self.MKL_acceleration = False
         self.Multithread_acceleration = False
         self.Nthreads = None
-        self.croppedMultiplication = kwargs.get('croppedMultiplication', False)
+        self.Native_acceleration = False
+        self.nativeThreads = None
+        self._executor = None
+        self._scenarioExecutor = None
+        self.quantizedBeamlets = kwargs.get('quantizedBeamlets', False)
+        self.deltaCodedIndices = kwargs.get('deltaCodedIndices', False)
+        self.batchedScenarios = kwargs.get('batchedScenarios', False)
+        self.csrBeamlets = kwargs.get('csrBeamlets', False)
+        self.multiResolution = kwargs.get('multiResolution', None)
+        self.multiResolutionIterations = kwargs.get('multiResolutionIterations', 50)
+        self.multiResolutionMinVoxels = kwargs.get('multiResolutionMinVoxels', 100)
+        self.multiResolutionSeed = kwargs.get('multiResolutionSeed', None)
+        self.trace = None
+        if kwargs.get('trace', False):
+            self.enableTrace(keepSpans=kwargs.get('traceSpans', False))
         hardwareAcceleration = kwargs.get('hardwareAcceleration', None)
 
-        if self.croppedMultiplication:
-            logger.info('Cropped multiplication activated for dose fidelity objective function')
+        if 'croppedMultiplication' in kwargs:
+            warnings.warn('croppedMultiplication is deprecated and ignored: the gradient with respect to the dose is '
+                          'always multiplied once by the transposed beamlet matrix', DeprecationWarning, stacklevel=2)
 
         if hardwareAcceleration is not None:
             if hardwareAcceleration == 'GPU':
@@ -125,7 +191,14 @@ class PlanOptimizer:
                         self.use_MKL_acceleration(n_threads)
                     elif args[1] == 'DEBUG':
                         self.use_MKL_acceleration(debug=True)
-            if hardwareAcceleration!='GPU' and hardwareAcceleration[:2]!='MT' and hardwareAcceleration[:3]!='MKL' and hardwareAcceleration != 'MGPU':
+
+            if hardwareAcceleration[:6] == 'NATIVE':
+                args = hardwareAcceleration.split('-')
+                if len(args) < 2 or not args[1].isdigit():
+                    self.use_native_acceleration()
+                else:
+                    self.use_native_acceleration(int(args[1]))
+            if hardwareAcceleration!='GPU' and hardwareAcceleration[:2]!='MT' and hardwareAcceleration[:3]!='MKL' and hardwareAcceleration[:6]!='NATIVE' and hardwareAcceleration != 'MGPU':
                 logger.warning('Unknown hardware acceleration method. No hardware acceleration will be used')
 
 
@@ -197,15 +270,130 @@ class PlanOptimizer:
         self.MKL_acceleration = False
         logger.info('MKL acceleration deactivated')
 
+    def use_native_acceleration(self, n_threads=None):
+        """
+        Enable the multithreaded sparse products of the native library libSparseDot (OpenMP) for the dose and gradient
+        computations. Only available on Linux, once the library is built with make in C_libraries.
+
+        Parameters
+        ----------
+        n_threads : int (default: None)
+            The number of threads to use. If None, all the CPUs are used.
+        """
+        if not libSparseDot_wrapper.isAvailable():
+            logger.warning('Unable to load libSparseDot. Native acceleration is only available on Linux: build it with make in opentps/core/processing/C_libraries to enable it')
+            logger.info('Regular optimization will be used instead')
+            self.Native_acceleration = False
+            return
+        self.Native_acceleration = True
+        self.nativeThreads = n_threads
+        logger.info('Native sparse products activated with {} threads'.format(n_threads if not (n_threads is None) else 'all'))
+
+    def stop_native_acceleration(self):
+        """
+        stop the use of the native sparse products
+        """
+        self.Native_acceleration = False
+        logger.info('Native acceleration deactivated')
+
     def use_multithread_acceleration(self,n_threads):
+        if n_threads != self.Nthreads:
+            self._shutdownExecutor()
         self.Multithread_acceleration = True
         self.Nthreads = n_threads
         logger.info('Multithreading activated with {} threads'.format(n_threads))
 
     def stop_multithread_acceleration(self):
         self.Multithread_acceleration = False
+        self._shutdownExecutor()
         logger.info('Multithreading deactivated')
 
+    def enableTrace(self, keepSpans=False, trackMemory=True) -> OptimizationTrace:
+        """
+        Records the iterations of the next optimizations in an OptimizationTrace. When the tracing is disabled, the
+        objective functions and solvers only check that their trace is None.
+
+        Parameters
+        ----------
+        keepSpans : bool (default: False)
+            If True, each timed block is kept for a detailed Chrome trace (see OptimizationTrace.toChromeTrace)
+        trackMemory : bool (default: True)
+            If True, the resident memory of the process is recorded at each iteration
+
+        Returns
+        -------
+        OptimizationTrace
+            The trace, also available as the trace attribute
+        """
+        self.trace = OptimizationTrace(keepSpans=keepSpans, trackMemory=trackMemory)
+        logger.info('Optimization tracing activated')
+        return self.trace
+
+    def disableTrace(self):
+        """
+        Stops recording the iterations. The objective functions already built stop reporting to the trace.
+        """
+        for function in self.functions:
+            setTrace(function, None)
+        self.solver.trace = None
+        self.trace = None
+        logger.info('Optimization tracing deactivated')
+
+    def _startTrace(self, reset=True):
+        # The solver reports the iterations to the trace (None if the tracing is disabled)
+        self.solver.trace = self.trace
+        if self.trace is None:
+            return
+        for function in self.functions:
+            setTrace(function, self.trace)
+        if not reset:
+            return
+        beamlets = self.plan.planDesign.beamlets
+        self.trace.start(optimizer=self.__class__.__name__, solver=self.solver.__class__.__name__,
+                         method=getattr(self, 'method', None), numberOfSpots=beamlets.shape[1],
+                         numberOfRows=beamlets.shape[0], robust=getattr(self, '_robust', None),
+                         GPU_acceleration=self.GPU_acceleration, MKL_acceleration=self.MKL_acceleration,
+                         Native_acceleration=self.Native_acceleration, nativeThreads=self.nativeThreads,
+                         Multithread_acceleration=self.Multithread_acceleration, Nthreads=self.Nthreads,
+                         quantizedBeamlets=self.quantizedBeamlets, batchedScenarios=self.batchedScenarios,
+                         csrBeamlets=self.csrBeamlets, multiResolution=self.multiResolution)
+
+    def _logTraceSummary(self):
+        if self.trace is None:
+            return
+        summary = self.trace.summary()
+        logger.info('Optimization trace: {} iterations in {:.3f} s (SpMV {:.3f} s, objectives {:.3f} s, gradients {:.3f} s, line search {:.3f} s)'.format(
+            summary['iterations'], summary['duration'], summary['spmvTime'], summary['evalTime'],
+            summary['gradTime'], summary['lineSearchTime']))
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """
+        Thread pool of the multithreaded objectives, created on first use and reused by all the evaluations of this
+        optimizer
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.Nthreads, thread_name_prefix='PlanOptimizer')
+        return self._executor
+
+    @property
+    def scenarioExecutor(self) -> ThreadPoolExecutor:
+        """
+        Thread pool on which the robust scenarios are evaluated concurrently. Separate from executor since each scenario
+        evaluation submits its objectives to executor.
+        """
+        if self._scenarioExecutor is None:
+            self._scenarioExecutor = ThreadPoolExecutor(max_workers=self.Nthreads, thread_name_prefix='PlanOptimizerScenario')
+        return self._scenarioExecutor
+
+    def _shutdownExecutor(self):
+        if not (self._executor is None):
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if not (self._scenarioExecutor is None):
+            self._scenarioExecutor.shutdown(wait=True)
+            self._scenarioExecutor = None
+
 
 
     def initializeWeights(self):
@@ -251,73 +439,81 @@ class PlanOptimizer:
             else:
                 objectivesUnionROI = np.logical_or(objectivesUnionROI, objective.maskVec)
 
-            if self.GPU_acceleration:
-                objective._loadMaskVecToGPU()
-
         objectivesUnionROITotal = np.logical_or(objectivesUnionROI, objectivesRobustUnionROI)
 
-        if self.plan.planDesign.ROI_cropping == True:
+        beamlets = self.plan.planDesign.beamlets
+        if self.plan.planDesign.ROI_cropping == True or beamlets.hasCompactRows:
+            # Restrict the beamlet rows to the union of the objective ROIs. Doses, masks and gradients then only span
+            # these voxels. Scenarios share the same row space but only keep their entries in the robust ROIs.
             logger.info('Cropping beamlet matrix on ROIs for sparsity')
-            if self.MKL_acceleration :
-                beamletMatrix = sparse_dot_mkl.dot_product_mkl(
-                    sp.diags(objectivesUnionROITotal.astype(np.float32), format='csc'), self.plan.planDesign.beamlets.toSparseMatrix())
-            else:
-                beamletMatrix = sp.csc_matrix.dot(sp.diags(objectivesUnionROITotal.astype(np.float32), format='csc'),
-                                                  self.plan.planDesign.beamlets.toSparseMatrix())
-            self.plan.planDesign.beamlets.setUnitaryBeamlets(beamletMatrix)
+            beamlets.compactRows(objectivesUnionROITotal)
             if robust:
-                for s in range(len(self.plan.planDesign.robustness.scenarios)):
-                    if self.MKL_acceleration:
-                        beamletMatrix = sparse_dot_mkl.dot_product_mkl(
-                            sp.diags(objectivesRobustUnionROI.astype(np.float32), format='csc'),
-                            self.plan.planDesign.robustness.scenarios[s].toSparseMatrix())
-                    else:
-                        beamletMatrix = sp.csc_matrix.dot(
-                            sp.diags(objectivesRobustUnionROI.astype(np.float32), format='csc'),
-                            self.plan.planDesign.robustness.scenarios[s].toSparseMatrix())
-                    self.plan.planDesign.robustness.scenarios[s].setUnitaryBeamlets(beamletMatrix)
+                for scenario in self.plan.planDesign.robustness.scenarios:
+                    scenario.compactRows(objectivesUnionROITotal, nonZeroMask=objectivesRobustUnionROI)
+
+            for objective in self.plan.planDesign.objectives.objectivesList:
+                objective.maskVec = beamlets.voxelsToRows(objective.maskVec)
+                objective._clearRowIndices()
+            logger.info('Beamlet matrix rows reduced to {} voxels out of {}'.format(beamlets.shape[0], beamlets.numberOfVoxels))
+
+        # Row index lists of the objective ROIs, used to scatter the objective gradients in the dose space
+        for objective in self.plan.planDesign.objectives.objectivesList:
+            objective._updateRowIndices()
+
+        if self.GPU_acceleration:
+            for objective in self.plan.planDesign.objectives.objectivesList:
+                objective._loadMaskVecToGPU()
+
+        if self.quantizedBeamlets and self.GPU_acceleration:
+            logger.warning('Quantized beamlets are not supported with GPU acceleration. Float32 beamlets will be used instead')
+
+        self._robust = robust
+        scenarios = self.plan.planDesign.robustness.scenarios if robust else []
+        objectiveFunction = self._buildObjectiveFunction(beamlets, scenarios, robust)
+
+        self.functions.append(objectiveFunction)
+
 
+    def _buildObjectiveFunction(self, beamlets, scenarios, robust):
+        # Dose fidelity function of the objectives, for the nominal and scenario beamlets given as SparseBeamlets or as
+        # sparse matrices whose rows are the rows of the objective masks
         if robust:
             # New cost function for robust optimization
             if self.Multithread_acceleration:
-                robustSum = WeightedSumMultiThread()
-                robustSum.Nthreads = self.Nthreads
+                robustSum = WeightedSumMultiThread(Nthreads=self.Nthreads, executor=self.executor)
             else:
                 robustSum = WeightedSum()
             robustSum.GPU_acceleration = self.GPU_acceleration
             robustSum.functionList = self.plan.planDesign.objectives.robustObjList
 
             if self.Multithread_acceleration:
-                nonRobustSum = WeightedSumMultiThread()
-                nonRobustSum.Nthreads = self.Nthreads
+                nonRobustSum = WeightedSumMultiThread(Nthreads=self.Nthreads, executor=self.executor)
             else:
                 nonRobustSum = WeightedSum()
             nonRobustSum.GPU_acceleration = self.GPU_acceleration
             nonRobustSum.functionList = self.plan.planDesign.objectives.nonRobustObjList
 
+            # The nominal dose is computed once per iteration for both the robust and non-robust objectives
+            nominalDose = self._doseEvaluator(beamlets)
+
             doseFidList = []
-            nomDoseFid = DoseFidelity(beamlets=self.plan.planDesign.beamlets.toSparseMatrix(), xSquared=self.xSquared, GPU_acceleration=self.GPU_acceleration,MKL_acceleration=self.MKL_acceleration)
+            nomDoseFid = DoseFidelity(doseEvaluator=nominalDose)
             nomDoseFid.function = robustSum
-            if self.croppedMultiplication:
-                nomDoseFid.croppedMultiplication = True
-                nomDoseFid.unionMaskVec = objectivesRobustUnionROI
 
             doseFidList.append(nomDoseFid)
-            for bl in self.plan.planDesign.robustness.scenarios:
-                DoseFid = DoseFidelity(beamlets=bl.toSparseMatrix(), xSquared=self.xSquared, GPU_acceleration=self.GPU_acceleration,MKL_acceleration=self.MKL_acceleration)
+            for bl in scenarios:
+                DoseFid = DoseFidelity(doseEvaluator=self._doseEvaluator(bl))
                 DoseFid.function = robustSum
-                if self.croppedMultiplication:
-                    DoseFid.croppedMultiplication = True
-                    DoseFid.unionMaskVec = objectivesRobustUnionROI
                 doseFidList.append(DoseFid)
 
-            nonRobustDoseFid = DoseFidelity(beamlets=self.plan.planDesign.beamlets.toSparseMatrix(), xSquared=self.xSquared, GPU_acceleration=self.GPU_acceleration,MKL_acceleration=self.MKL_acceleration)
+            nonRobustDoseFid = DoseFidelity(doseEvaluator=nominalDose)
             nonRobustDoseFid.function = nonRobustSum
-            if self.croppedMultiplication:
-                nonRobustDoseFid.croppedMultiplication = True
-                nonRobustDoseFid.unionMaskVec = objectivesUnionROI
 
-            robustWC = RobustWorstCase(nScenarios=len(self.plan.planDesign.robustness.scenarios)+1,GPU_acceleration=self.GPU_acceleration)
+            if self.batchedScenarios:
+                self._batchScenarios(doseFidList)
+
+            robustWC = RobustWorstCase(nScenarios=len(scenarios)+1,GPU_acceleration=self.GPU_acceleration,
+                                       executor=self.scenarioExecutor if self.Multithread_acceleration else None)
             robustWC.robustFunctions = doseFidList
             robustWC.nonRobustFunction = nonRobustDoseFid
 
@@ -329,15 +525,10 @@ class PlanOptimizer:
                 objectiveFunction = robustWC
 
         else:
-            doseFid = DoseFidelity(beamlets=self.plan.planDesign.beamlets.toSparseMatrix(), xSquared=self.xSquared, GPU_acceleration=self.GPU_acceleration,MKL_acceleration=self.MKL_acceleration)
-
-            if self.croppedMultiplication:
-                doseFid.croppedMultiplication = True
-                doseFid.unionMaskVec = objectivesUnionROI
+            doseFid = DoseFidelity(doseEvaluator=self._doseEvaluator(beamlets))
 
             if self.Multithread_acceleration:
-                sum = WeightedSumMultiThread()
-                sum.Nthreads = self.Nthreads
+                sum = WeightedSumMultiThread(Nthreads=self.Nthreads, executor=self.executor)
                 sum.functionList = self.plan.planDesign.objectives.objectivesList
                 doseFid.function = sum
                 objectiveFunction = doseFid
@@ -354,14 +545,49 @@ class PlanOptimizer:
                 doseFid.function = sum
                 objectiveFunction = doseFid
 
-
-        self.functions.append(objectiveFunction)
-
+        if not (self.trace is None):
+            setTrace(objectiveFunction, self.trace)
+        return objectiveFunction
+
+    def _doseEvaluator(self, beamlets):
+        if self.quantizedBeamlets and not self.GPU_acceleration:
+            operator = beamlets.toBeamletOperator() if isinstance(beamlets, SparseBeamlets) else beamlets
+            if not isinstance(operator, QuantizedSparseMatrix):
+                # Encoded copy owned by the evaluator: the beamlets of the plan keep their float32 matrix
+                operator = QuantizedSparseMatrix(operator, deltaCodedIndices=self.deltaCodedIndices)
+            rowBeamlets = None
+        elif isinstance(beamlets, SparseBeamlets):
+            operator = beamlets.toBeamletOperator()
+            rowBeamlets = self._rowBeamlets(beamlets)
+        else:
+            operator = beamlets
+            rowBeamlets = None
+        return DoseEvaluator(operator, xSquared=self.xSquared, GPU_acceleration=self.GPU_acceleration,
+                             MKL_acceleration=self.MKL_acceleration, Native_acceleration=self.Native_acceleration,
+                             nativeThreads=self.nativeThreads, rowBeamlets=rowBeamlets)
+
+    def _rowBeamlets(self, beamlets):
+        # CSR twin of the beamlets, cached on the SparseBeamlets across optimizations
+        if not self.csrBeamlets or self.GPU_acceleration or beamlets.isQuantized:
+            return None
+        return beamlets.toCSRMatrix()
+
+    def _batchScenarios(self, doseFidList):
+        if self.GPU_acceleration or self.quantizedBeamlets:
+            logger.warning('Batched scenarios are not supported with GPU acceleration or quantized beamlets. Scenarios will be evaluated one by one')
+            return
+        doseEvaluators = [doseFid.doseEvaluator for doseFid in doseFidList]
+        batch = ScenarioBatch([doseEvaluator.beamlets for doseEvaluator in doseEvaluators], xSquared=self.xSquared,
+                              MKL_acceleration=self.MKL_acceleration, Native_acceleration=self.Native_acceleration,
+                              nativeThreads=self.nativeThreads)
+        for scenarioIndex, doseEvaluator in enumerate(doseEvaluators):
+            doseEvaluator.scenarioBatch = batch
+            doseEvaluator.scenarioIndex = scenarioIndex
 
     def computeDose(self):
         assert hasattr(self.plan, 'planDesign')
         assert hasattr(self.plan.planDesign.beamlets, '_sparseBeamlets')
-        assert self.plan.planDesign.beamlets._sparseBeamlets is not None
+        assert self.plan.planDesign.beamlets.toSparseMatrix() is not None
 
         beamlets = self.plan.planDesign.beamlets
         if isinstance(self.plan, ProtonPlan):
@@ -370,11 +596,14 @@ class PlanOptimizer:
             weights = np.array(self.plan.beamletMUs, dtype=np.float32)
 
 
-        if  self.MKL_acceleration:
-            totalDose = sparse_dot_mkl.dot_product_mkl(beamlets._sparseBeamlets, weights) * self.plan.numberOfFractionsPlanned
+        if self.Native_acceleration:
+            totalDose = libSparseDot_wrapper.sparseDot(beamlets.toSparseMatrix(), weights, nThreads=self.nativeThreads) * self.plan.numberOfFractionsPlanned
+        elif  self.MKL_acceleration:
+            totalDose = sparse_dot_mkl.dot_product_mkl(beamlets.toSparseMatrix(), weights) * self.plan.numberOfFractionsPlanned
         else:
-            totalDose = csc_matrix.dot(beamlets._sparseBeamlets, weights) * self.plan.numberOfFractionsPlanned
+            totalDose = csc_matrix.dot(beamlets.toSparseMatrix(), weights) * self.plan.numberOfFractionsPlanned
 
+        totalDose = beamlets.rowsToVoxels(totalDose)
         totalDose = np.reshape(totalDose, beamlets._gridSize, order='F')
         totalDose = np.flip(totalDose, 0)
         totalDose = np.flip(totalDose, 1)
@@ -409,15 +638,75 @@ class PlanOptimizer:
         except:
             bounds = None
 
+        self._startTrace()
+        if self.multiResolution:
+            x0 = self._optimizeOnVoxelSamples(x0, bounds)
+
         # Optimization
         if bounds is not None:
             result = self.solver.solve(self.functions, x0, bounds=bounds)
         else:
             result = self.solver.solve(self.functions, x0)
-
+        self._logTraceSummary()
 
         return self.postProcess(result)
 
+    def _optimizeOnVoxelSamples(self, x0, bounds=None):
+        """
+        Coarse-to-fine levels of the multi-resolution mode: optimizes on increasing samples of the voxels (see
+        VoxelSampling) and returns the solution of the last level, used as initial weights on all the voxels.
+        """
+        if self.quantizedBeamlets and not self.GPU_acceleration:
+            logger.warning('Multi-resolution optimization is not supported with quantized beamlets. All the voxels are used from the start')
+            return x0
+
+        objectives = self.plan.planDesign.objectives.objectivesList
+        scenarios = self.plan.planDesign.robustness.scenarios if self._robust else []
+        iterations = self.multiResolutionIterations
+        if not isinstance(iterations, Iterable):
+            iterations = [iterations] * len(self.multiResolution)
+        rng = np.random.default_rng(self.multiResolutionSeed)
+
+        hasMaxIter = 'maxiter' in self.solver.params
+        maxIter = self.solver.params.get('maxiter', None)
+        try:
+            for fraction, nIterations in zip(self.multiResolution, iterations):
+                if fraction >= 1:
+                    break
+                sampling = VoxelSampling(objectives, fraction, rng=rng, minVoxels=self.multiResolutionMinVoxels)
+                beamlets = sampling.sampleMatrix(self.plan.planDesign.beamlets.toSparseMatrix())
+                sampledScenarios = [sampling.sampleMatrix(scenario.toSparseMatrix()) for scenario in scenarios]
+                sampling.apply()
+                try:
+                    if self.GPU_acceleration:
+                        for objective in objectives:
+                            objective._loadMaskVecToGPU()
+                    function = self._buildObjectiveFunction(beamlets, sampledScenarios, self._robust)
+                    self.solver.params['maxiter'] = nIterations
+                    if not (self.trace is None):
+                        self.trace.stage = 'voxelSampling {}'.format(fraction)
+                    logger.info('Multi-resolution level: {} voxels ({:.1%}), {} iterations max'.format(len(sampling.rows), fraction, nIterations))
+                    functions = [function] + self.functions[1:]
+                    if bounds is not None:
+                        result = self.solver.solve(functions, x0, bounds=bounds)
+                    else:
+                        result = self.solver.solve(functions, x0)
+                    x0 = np.array(result['sol'], dtype=np.float32)
+                finally:
+                    sampling.restore()
+                    if self.GPU_acceleration:
+                        for objective in objectives:
+                            objective._loadMaskVecToGPU()
+        finally:
+            if hasMaxIter:
+                self.solver.params['maxiter'] = maxIter
+            else:
+                self.solver.params.pop('maxiter', None)
+            if not (self.trace is None):
+                self.trace.stage = None
+
+        return x0
+
     def postProcess(self, result):
         """
         Post-process the optimization result. !! The spots and the according weight bellow the thresholdSpotRemoval are removed from the plan and beamlet matrix !!
@@ -480,7 +769,7 @@ class PlanOptimizer:
                 # Beamlet matrix has not removed zero weight column
                 ind_to_keep = MU_before_simplify > self.thresholdSpotRemoval
                 assert np.sum(ind_to_keep) == len(self.plan.spotMUs)
-                self.plan.planDesign.beamlets.setUnitaryBeamlets(self.plan.planDesign.beamlets._sparseBeamlets[:, ind_to_keep])
+                self.plan.planDesign.beamlets.setUnitaryBeamlets(self.plan.planDesign.beamlets.toSparseMatrix()[:, ind_to_keep])
                 self.plan.planDesign.beamlets._weights = self.plan.spotMUs
             else:
                 self.plan.planDesign.beamlets._weights = self.plan.spotMUs
@@ -489,7 +778,7 @@ class PlanOptimizer:
                 # Beamlet matrix has not removed zero weight column
                 ind_to_keep = MU_before_simplify > self.thresholdSpotRemoval
                 assert np.sum(ind_to_keep) == len(self.plan.beamletMUs)
-                self.plan.planDesign.beamlets.setUnitaryBeamlets(self.plan.planDesign.beamlets._sparseBeamlets[:, ind_to_keep])
+                self.plan.planDesign.beamlets.setUnitaryBeamlets(self.plan.planDesign.beamlets.toSparseMatrix()[:, ind_to_keep])
                 self.plan.planDesign.beamlets._weights = self.plan.beamletMUs
             else:
                 self.plan.planDesign.beamlets._weights = self.plan.beamletMUs
@@ -647,6 +936,7 @@ class BoundConstraintsOptimizer(PlanOptimizer):
         """
         self.initializeFidObjectiveFunction()
         x0 = self.initializeWeights()
+        self._startTrace()
 
         if self.bounds[0] == 0:
             result = self.solver.solve(self.functions, x0, bounds=self.formatBoundsForSolver(self.bounds), maxit=self.opti_params.get('maxiter', 1000))
@@ -668,8 +958,10 @@ class BoundConstraintsOptimizer(PlanOptimizer):
             x0 = x0[ind_to_keep]
 
             self.functions = [] # to avoid a beamlet copy with different size
-            self.plan.planDesign.beamlets.setUnitaryBeamlets(self.plan.planDesign.beamlets._sparseBeamlets[:, ind_to_keep])
+            self.plan.planDesign.beamlets.setUnitaryBeamlets(self.plan.planDesign.beamlets.toSparseMatrix()[:, ind_to_keep])
             objectiveFunction = DoseFidelity(self.plan.planDesign.beamlets, self.xSquared)
+            if not (self.trace is None):
+                setTrace(objectiveFunction, self.trace)
             self.functions.append(objectiveFunction)
 
             # second optimization with lower bound = self.bounds[0]
@@ -681,6 +973,7 @@ class BoundConstraintsOptimizer(PlanOptimizer):
 
             self.thresholdSpotRemoval = 1e-6 # zero spot MUs are removed in the postProcess with plan.simplify(self.thresholdSpotRemoval)
 
+        self._logTraceSummary()
         return self.postProcess(result)
 
     def getConvergenceData(self):
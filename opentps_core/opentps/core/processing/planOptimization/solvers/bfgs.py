@@ -13,16 +13,25 @@ class BFGS(GradientDescent):
     The BFGS method belongs to quasi-Newton methods, a class of hill-climbing
     planOptimization techniques that seek a stationary point of a (preferably twice
     continuously differentiable) function.
+
+    Attributes
+    ----------
+    keepMemory : bool (default: False)
+        If true, the inverse Hessian estimate of the previous solve is kept as initial estimate of the next one (warm
+        start of a re-optimization with the same variables)
     """
 
-    def __init__(self, accel=LineSearch(), **kwargs):
+    def __init__(self, accel=LineSearch(), keepMemory=False, **kwargs):
         super(BFGS, self).__init__(accel=accel, **kwargs)
+        self.keepMemory = keepMemory
+        self.hessiank = None
 
     def _pre(self, functions, x0):
         super(BFGS, self)._pre(functions, x0)
         self.f = functions[0]
         self.indentity = np.identity(x0.size)
-        self.hessiank = self.indentity
+        if not self.keepMemory or self.hessiank is None or self.hessiank.shape[0] != x0.size:
+            self.hessiank = self.indentity
         self.pk = -self.hessiank.dot(self.f.grad(x0))
 
     def _algo(self):
@@ -55,17 +64,21 @@ class LBFGS(BFGS):
     Like the original BFGS, L-BFGS uses an estimate of the inverse Hessian matrix
     to steer its search through variable space, but where BFGS stores a dense n × n
     approximation to the inverse Hessian (n being the number of variables in the problem),
-    L-BFGS stores only a few vectors that represent the approximation implicitly
+    L-BFGS stores only a few vectors that represent the approximation implicitly.
+    With keepMemory, the m last update pairs of the previous solve are kept for the next one.
     """
 
     def __init__(self, m=10, accel=LineSearch(), **kwargs):
         super(LBFGS, self).__init__(accel=accel, **kwargs)
         self.m = m
+        self.sks = []
+        self.yks = []
 
     def _pre(self, functions, x0):
         super(LBFGS, self)._pre(functions, x0)
-        self.sks = []
-        self.yks = []
+        if not self.keepMemory or (len(self.sks) and self.sks[0].size != x0.size):
+            self.sks = []
+            self.yks = []
 
     def _algo(self):
         # current
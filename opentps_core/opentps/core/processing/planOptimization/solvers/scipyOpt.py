@@ -30,6 +30,12 @@ class ScipyOpt:
                 The name of the output file.
     name : str
         The name of the solver.
+    hessInv : numpy.ndarray or None
+        Inverse Hessian estimate at the solution of the last solve with the BFGS method. It can be given as option
+        hess_inv0 of the next solve to warm-start a re-optimization.
+    trace : OptimizationTrace or None (default: None)
+        If set, a record is added to the trace at each iteration. The line searches are internal to scipy: their
+        evaluations are counted in the iterations.
     """
     def __init__(self, meth='L-BFGS-B', **kwargs):
         self.meth = meth
@@ -37,6 +43,8 @@ class ScipyOpt:
         self.params = kwargs # go to https://docs.scipy.org/doc/scipy/reference/optimize.html to see options for each solver
         self.params['output'] = self.params.get('output', None)
         self.name = meth
+        self.hessInv = None
+        self.trace = None
 
         # Define the method-specific supported options
         self.method_options = {
@@ -79,14 +87,22 @@ class ScipyOpt:
         """
 
         def callbackF(Xi,state=None): # trust-constr method expects 2 positional arguments
+            # Xi was just evaluated by the solver: the value is taken from the cache of the objective function
+            f = func[0].eval(Xi)
             logger.info('Iteration {} of Scipy-{}'.format(self.Nfeval, self.meth))
-            logger.info('objective = {0:.6e}  '.format(func[0].eval(Xi)))
-            cost.append(func[0].eval(Xi))
+            logger.info('objective = {0:.6e}  '.format(f))
+            cost.append(f)
             self.Nfeval += 1
+            if not (self.trace is None):
+                self.trace.endIteration(len(cost) - 1, cost=f)
 
 
         startTime = time.time()
+        if not (self.trace is None):
+            self.trace.beginSolve('Scipy-{}'.format(self.meth))
         cost = [func[0].eval(x0)]
+        if not (self.trace is None):
+            self.trace.endIteration(0, cost=cost[0])
         if 'GRAD' not in func[0].cap(x0):
             logger.error('{} requires the function to implement grad().'.format(self.__class__.__name__))
         else :
@@ -102,8 +118,14 @@ class ScipyOpt:
 
         options = {key: self.params[key] for key in self.method_options.get(self.meth, []) if key in self.params}
         bounds = scipy.optimize.Bounds(bounds[0], bounds[1]) if bounds is not None else None
-        res = scipy.optimize.minimize(func[0].eval, x0, method=self.meth, jac=func[0].grad, callback=callbackF,
-                                      options=options, bounds=bounds)
+        if self.meth == 'COBYLA':
+            # Gradient-free method
+            res = scipy.optimize.minimize(func[0].eval, x0, method=self.meth, callback=callbackF,
+                                          options=options, bounds=bounds)
+        else:
+            res = scipy.optimize.minimize(func[0].valueAndGrad, x0, method=self.meth, jac=True, callback=callbackF,
+                                          options=options, bounds=bounds)
+        self.hessInv = res.hess_inv if self.meth == 'BFGS' and hasattr(res, 'hess_inv') else None
         result = {'sol': res.x.tolist(), 'crit': res.message, 'niter': res.nit if hasattr(res, "nit") else 0, 'time': time.time() - startTime,
                   'objective': np.array(cost).tolist()}
         if self.params['output'] is not None:
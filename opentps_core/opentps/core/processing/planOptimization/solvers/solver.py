@@ -41,6 +41,8 @@ class ConvexSolver(object):
         The list of the cost function values.
     sol : ndarray
         The solution.
+    trace : OptimizationTrace or None (default: None)
+        If set, a record is added to the trace at each iteration.
     """
 
     def __init__(self, step=0.1, accel=None, **kwargs):
@@ -52,6 +54,7 @@ class ConvexSolver(object):
             logger.error('Step should be a positive number.')
         self.step = step
         self.accel = baseAccel.Dummy() if accel is None else accel
+        self.trace = None
         self.params = kwargs
         self.params['dtol'] = self.params.get('dtol', None)
         self.params['xtol'] = self.params.get('xtol', None)
@@ -99,6 +102,8 @@ class ConvexSolver(object):
             logger.info('Dummy objective function added')
 
         startTime = time.time()
+        if not (self.trace is None):
+            self.trace.beginSolve(self.__class__.__name__)
         crit = None
         niter = 0
         objective = [[f.eval(x0) for f in functions]]
@@ -112,6 +117,8 @@ class ConvexSolver(object):
 
         # Solver specific initialization.
         self.pre(functions, x0)
+        if not (self.trace is None):
+            self.trace.endIteration(0, cost=np.sum(objective[0]))
 
         while not crit:
 
@@ -129,6 +136,8 @@ class ConvexSolver(object):
             weights.append(self.sol.tolist())
             current = np.sum(objective[-1])
             last = np.sum(objective[-2])
+            if not (self.trace is None):
+                self.trace.endIteration(niter, cost=current)
 
             # Record best iteration
             if objective[niter][0] < bestCost:
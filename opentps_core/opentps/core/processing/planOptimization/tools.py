@@ -57,6 +57,22 @@ class WeightStructure:
         The list of layers after grouping
     spotNewID : list
         The list of new spot IDs after grouping
+    layerOffsets : numpy.ndarray
+        Index of the first spot of each layer, followed by nSpots (size=nLayers+1): the spots of layer l are
+        x[layerOffsets[l]:layerOffsets[l+1]]
+    beamLayerOffsets : numpy.ndarray
+        Index of the first layer of each beam, followed by nLayers (size=nBeams+1)
+    spotLayers : numpy.ndarray
+        Layer index of each spot (size=nSpots)
+    spotBeams : numpy.ndarray
+        Beam index of each spot (size=nSpots)
+    layerBeams : numpy.ndarray
+        Beam index of each layer (size=nLayers)
+    layerEnergies : numpy.ndarray
+        Energy of each layer (size=nLayers)
+
+    The integer index (offsets, spot -> layer and layer -> beam) is computed once, so that sums and norms per layer or
+    per beam are single bincount calls over the spots.
     """
 
     def __init__(self, plan:RTPlan):
@@ -75,6 +91,13 @@ class WeightStructure:
         # Number of spots in each layer, number of spots in each beam, number of layers in each beam, energy of each
         # layer
         self.nSpotsInLayer, self.nSpotsInBeam, self.nLayersInBeam, self.energyLayers = self.getWeightsStruct()
+        # Spot, layer and beam index
+        self.layerOffsets = np.concatenate(([0], np.cumsum(self.nSpotsInLayer))).astype(np.int64)
+        self.beamLayerOffsets = np.concatenate(([0], np.cumsum(self.nLayersInBeam))).astype(np.int64)
+        self.layerBeams = np.repeat(np.arange(self.nBeams), self.nLayersInBeam)
+        self.spotLayers = np.repeat(np.arange(self.nLayers), self.nSpotsInLayer)
+        self.spotBeams = self.layerBeams[self.spotLayers]
+        self.layerEnergies = np.array([energy for energies in self.energyLayers for energy in energies], dtype=float)
         # Spot grouping
         self.nSpotsGrouped = 0
         self.sparseMatrixGrouped = None
@@ -100,11 +123,55 @@ class WeightStructure:
         int
             The total number of energy layers in the plan
         """
-        res = 0
-        for i in range(len(self.plan.beams)):
-            for j in range(len(self.plan.beams[i].layers)):
-                res += 1
-        return res
+        return sum(len(beam.layers) for beam in self.plan.beams)
+
+    def sumPerLayer(self, x):
+        """
+        return the sum of x over the spots of each layer (size=nLayers)
+
+        Parameters
+        ----------
+        x : numpy.ndarray
+            Vector over the spots
+
+        Returns
+        -------
+        numpy.ndarray
+            Sum of x in each layer
+        """
+        return np.bincount(self.spotLayers, weights=x, minlength=self.nLayers)
+
+    def sumPerBeam(self, x):
+        """
+        return the sum of x over the spots of each beam (size=nBeams)
+
+        Parameters
+        ----------
+        x : numpy.ndarray
+            Vector over the spots
+
+        Returns
+        -------
+        numpy.ndarray
+            Sum of x in each beam
+        """
+        return np.bincount(self.spotBeams, weights=x, minlength=self.nBeams)
+
+    def layerNorms(self, x):
+        """
+        return the Euclidean norm of x over the spots of each layer (size=nLayers)
+
+        Parameters
+        ----------
+        x : numpy.ndarray
+            Vector over the spots
+
+        Returns
+        -------
+        numpy.ndarray
+            Norm of x in each layer
+        """
+        return np.sqrt(self.sumPerLayer(np.square(x)))
 
     def getSpotIndex(self):
         """
@@ -122,19 +189,7 @@ class WeightStructure:
         list
             The list of energies of each spot
         """
-        spotsBeams = []
-        spotsLayers = []
-        spotsEnergies = []
-        accumulateLayers = 0
-        for beam in range(self.nBeams):
-            for layer in range(self.nLayersInBeam[beam]):
-                for spot in range(self.nSpotsInLayer[accumulateLayers]):
-                    spotsBeams.append(beam)
-                    spotsLayers.append(accumulateLayers)
-                    # spotsLayers.append(layer)
-                    spotsEnergies.append(self.energyLayers[beam][layer])
-                accumulateLayers += 1
-        return spotsBeams, spotsLayers, spotsEnergies
+        return self.spotBeams.tolist(), self.spotLayers.tolist(), self.layerEnergies[self.spotLayers].tolist()
 
     def getWeightsStruct(self):
         """
@@ -186,15 +241,7 @@ class WeightStructure:
         list
             The list of weights vectors ordered by energy layer and beam
         """
-        energyStruct = []
-        accumulateWeights = 0
-        for el in range(self.nLayers):
-            if el == 0:
-                energyStruct.append(x[:self.nSpotsInLayer[el]])
-            else:
-                accumulateWeights += self.nSpotsInLayer[el - 1]
-                energyStruct.append(x[accumulateWeights:self.nSpotsInLayer[el] + accumulateWeights])
-        return energyStruct
+        return [x[self.layerOffsets[el]:self.layerOffsets[el + 1]] for el in range(self.nLayers)]
 
     def getBeamStructure(self, x):
         """
@@ -212,18 +259,7 @@ class WeightStructure:
             The list of layers vectors ordered by beam
         """
         energyStruct = self.getEnergyStructure(x)
-        beamLayerStruct = []
-        accumulateLayers = 0
-        for nOfLayers in self.nLayersInBeam:
-            LayersInbeam = []
-            for el in range(len(energyStruct)):
-                LayersInbeam.append(energyStruct[accumulateLayers])
-                accumulateLayers += 1
-                if len(LayersInbeam) == nOfLayers:
-                    # reached number of Layers defined in beam, now next beam
-                    break
-            beamLayerStruct.append(LayersInbeam)
-        return beamLayerStruct
+        return [energyStruct[self.beamLayerOffsets[i]:self.beamLayerOffsets[i + 1]] for i in range(self.nBeams)]
 
     def getMUPerBeam(self, x):
         """
@@ -239,21 +275,7 @@ class WeightStructure:
         list
             The list of MUs in each beam
         """
-        nOfMUinbeams = []
-        energyStruct = self.getEnergyStructure(x)
-        beamStruct = self.nLayersInBeam
-        accumulateLayers = 0
-        for nOfLayers in beamStruct:
-            nOfMUInbeam = 0
-            LayersInbeam = []
-            for el in range(len(energyStruct)):
-                nOfMUInbeam += np.sum(energyStruct[accumulateLayers])
-                LayersInbeam.append(energyStruct[accumulateLayers])
-                accumulateLayers += 1
-                if len(LayersInbeam) == nOfLayers:
-                    break
-            nOfMUinbeams.append(nOfMUInbeam)
-        return nOfMUinbeams
+        return self.sumPerBeam(x).tolist()
 
     def getMUPerLayer(self, x):
         """
@@ -269,19 +291,7 @@ class WeightStructure:
         list
             The list of MUs in each layer
         """
-        nOfMUinLayers = []
-        energyStruct = self.getEnergyStructure(x)
-        beamStruct = self.nLayersInBeam
-        accumulateLayers = 0
-        for nOfLayers in beamStruct:
-            LayersInbeam = []
-            for el in range(len(energyStruct)):
-                nOfMUinLayers.append(np.sum(energyStruct[accumulateLayers]))
-                LayersInbeam.append(energyStruct[accumulateLayers])
-                accumulateLayers += 1
-                if len(LayersInbeam) == nOfLayers:
-                    break
-        return nOfMUinLayers
+        return self.sumPerLayer(x).tolist()
 
     def computeELSparsity(self, x, nLayers):
         """
@@ -302,24 +312,7 @@ class WeightStructure:
         float
             The percentage of active energy layers in the plan (non-null weight) = Sparsity
         """
-        energyStruct = self.getEnergyStructure(x)
-        layersActiveInBeams = np.zeros(len(self.nLayersInBeam))
-        accumulateLayers = 0
-        i = 0
-        for nOfLayers in self.nLayersInBeam:
-            layersActiveInBeam = 0
-            LayersInbeam = []
-            for el in range(len(energyStruct)):
-                nOfMUInLayer = np.sum(energyStruct[accumulateLayers])
-                if nOfMUInLayer > 0.0:
-                    layersActiveInBeam += 1
-                LayersInbeam.append(energyStruct[accumulateLayers])
-                accumulateLayers += 1
-                if len(LayersInbeam) == nOfLayers:
-                    # reached number of Layers defined in beam, now next beam
-                    break
-            layersActiveInBeams[i] = layersActiveInBeam
-            i += 1
+        layersActiveInBeams = self._activeLayersPerBeam(x)
         idealCase = np.count_nonzero(layersActiveInBeams < nLayers + 1)
         percentageOfActiveLayers = idealCase / self.nBeams
         return percentageOfActiveLayers * 100
@@ -341,36 +334,10 @@ class WeightStructure:
         list
             The list of energies of the active layers
         """
-        energyStruct = self.getEnergyStructure(x)
-        activeEnergyList = []
-        accumulateLayers = 0
-        i = 0
-
-        for nOfLayers in self.nLayersInBeam:
-            layersActiveInBeam = 0
-            LayersInbeam = []
-            for el in range(len(energyStruct)):
-                nOfMUInLayer = np.sum(energyStruct[accumulateLayers])
-
-                if regCalc:
-                    if nOfMUInLayer > 0.0:
-                        layersActiveInBeam += 1
-                        activeEnergyList.append(self.energyLayers[i][el])
-                    else:
-                        activeEnergyList.append(0.)
-                else:
-                    if nOfMUInLayer > 0.0:
-                        layersActiveInBeam += 1
-                        activeEnergyList.append(self.energyLayers[i][el])
-
-                LayersInbeam.append(energyStruct[accumulateLayers])
-                accumulateLayers += 1
-                if len(LayersInbeam) == nOfLayers:
-                    # reached number of Layers defined in beam, now next beam
-                    break
-
-            i += 1
-        return activeEnergyList
+        activeLayers = self.sumPerLayer(x) > 0.0
+        if regCalc:
+            return np.where(activeLayers, self.layerEnergies, 0.).tolist()
+        return self.layerEnergies[activeLayers].tolist()
 
     def computeIrradiationTime(self, x):
         """
@@ -445,33 +412,11 @@ class WeightStructure:
         list
             The list of number of active energy layers in each beam
         """
-        beamStruct = self.nLayersInBeam
-        energyStruct = self.getEnergyStructure(x)
+        return self._activeLayersPerBeam(x).tolist()
 
-        layersActiveInBeams = []
-        totalActiveLayers = 0
-        accumulateLayers = 0
-        j = 0
-        meanMUinbeams = []
-        for nOfLayers in beamStruct:
-            nOfMUinbeam = 0
-            layersActiveInBeam = 0
-            LayersInBeam = []
-            for el in range(nOfLayers):
-                nOfMUInLayer = np.sum(energyStruct[accumulateLayers])
-                nOfMUinbeam += nOfMUInLayer
-                if nOfMUInLayer > 0.0:
-                    layersActiveInBeam += 1
-                    totalActiveLayers += 1
-                LayersInBeam.append(energyStruct[accumulateLayers])
-                accumulateLayers += 1
-                if len(LayersInBeam) == nOfLayers:
-                    break
-            layersActiveInBeams.append(layersActiveInBeam)
-            meanOfMUinbeam = nOfMUinbeam / nOfLayers
-            meanMUinbeams.append(meanOfMUinbeam)
-            j += 1
-        return layersActiveInBeams
+    def _activeLayersPerBeam(self, x):
+        activeLayers = self.sumPerLayer(x) > 0.0
+        return np.bincount(self.layerBeams, weights=activeLayers, minlength=self.nBeams).astype(int)
 
     def groupSpots(self, groupSpotsby=10):
         """
@@ -609,18 +554,18 @@ def getEnergyWeights(energyList):
     list
         The list of energy layer weights
     """
-    energyWeights = energyList.copy()
-    for i, nonZeroIndex in enumerate(np.nonzero(energyList)[0]):
-        if i == 0:
-            energyWeights[nonZeroIndex] = 0.1
-        elif energyList[nonZeroIndex] == energyList[np.nonzero(energyList)[0][i - 1]]:
-            energyWeights[nonZeroIndex] = 0.1
-        else:
-            if energyList[nonZeroIndex] < energyList[np.nonzero(energyList)[0][i - 1]]:
-                energyWeights[nonZeroIndex] = 0.6
-            else:
-                energyWeights[nonZeroIndex] = 5.5
-    finalEnergyWeights = np.where(energyWeights == 0, 1., energyWeights)
+    energies = np.asarray(energyList, dtype=float)
+    # The inactive layers (zero energy) get a weight of 1 for an array of energies, but keep a zero weight for a list
+    # (as returned by WeightStructure.getListOfActiveEnergies), which the 'energy' scaling of NormL21 relies on
+    finalEnergyWeights = np.ones(len(energies)) if isinstance(energyList, np.ndarray) else np.zeros(len(energies))
+    nonZeroIndices = np.flatnonzero(energies)
+    if len(nonZeroIndices):
+        # each active layer is compared with the previous active layer
+        activeEnergies = energies[nonZeroIndices]
+        previousEnergies = np.concatenate((activeEnergies[:1], activeEnergies[:-1]))
+        weights = np.where(activeEnergies < previousEnergies, 0.6, 5.5)
+        weights[activeEnergies == previousEnergies] = 0.1
+        finalEnergyWeights[nonZeroIndices] = weights
     return finalEnergyWeights
 
 
@@ -0,0 +1,267 @@
+import hashlib
+import logging
+import time
+import unittest
+from typing import Callable, Sequence, Optional
+
+import numpy as np
+import scipy.sparse as sp
+
+logger = logging.getLogger(__name__)
+
+
+def stratifiedRowSample(rowIndices:np.ndarray, fraction:float, rng:np.random.Generator, minSamples:int=1) -> np.ndarray:
+    """
+    Stratified random sample of a list of rows: the rows are split in strata of consecutive rows (neighbouring voxels
+    in the flattened dose grid) and one row is drawn in each stratum, so that the sample covers the whole ROI.
+
+    Parameters
+    ----------
+    rowIndices : np.ndarray
+        Sorted row indices of the ROI
+    fraction : float
+        Fraction of the rows to draw
+    rng : np.random.Generator
+        Random generator
+    minSamples : int (default: 1)
+        Minimum number of rows drawn (all the rows if the ROI is smaller)
+
+    Returns
+    -------
+    np.ndarray
+        Positions of the drawn rows in rowIndices, in increasing order
+    """
+    n = len(rowIndices)
+    nSamples = min(n, max(minSamples, int(np.ceil(fraction * n))))
+    if nSamples >= n:
+        return np.arange(n)
+
+    edges = np.floor(np.arange(nSamples + 1) * (n / nSamples)).astype(np.int64)
+    return edges[:-1] + (rng.random(nSamples) * (edges[1:] - edges[:-1])).astype(np.int64)
+
+
+class VoxelSampling:
+    """
+    Optimization on a subset of the dose voxels: a stratified random subset of the rows of the beamlet matrix is drawn
+    per objective ROI (objectives defined on the same ROI share it). While the sampling is applied, the masks of the
+    objectives span the sampled rows only and each objective only sees the rows drawn for its own ROI. No weighting is
+    applied to the sampled voxels: the objectives average over their (reduced) mask, so the value computed on a sample
+    estimates the value on the full ROI.
+
+    Attributes
+    ----------
+    fraction : float
+        Fraction of the voxels of each ROI in the sample
+    rows : np.ndarray
+        Sorted rows of the beamlet matrix in the sample (union of the samples of all the ROIs)
+    """
+    def __init__(self, objectives:Sequence, fraction:float, rng:Optional[np.random.Generator]=None, minVoxels:int=100):
+        self.fraction = fraction
+        self._objectives = list(objectives)
+        rng = np.random.default_rng() if rng is None else rng
+
+        roiSamples = {}
+        self._picks = []
+        for objective in self._objectives:
+            rowIndices = np.flatnonzero(objective.maskVec) if objective.rowIndices is None else objective.rowIndices
+            key = hashlib.blake2b(np.ascontiguousarray(rowIndices).tobytes(), digest_size=16).digest()
+            if key not in roiSamples:
+                roiSamples[key] = stratifiedRowSample(rowIndices, fraction, rng, minSamples=minVoxels)
+            picks = roiSamples[key]
+            self._picks.append((rowIndices, picks))
+
+        self.rows = np.unique(np.concatenate([rowIndices[picks] for rowIndices, picks in self._picks])) \
+            if len(self._picks) else np.zeros(0, dtype=np.int64)
+        self._saved = None
+        logger.info('Voxel sampling: {} rows ({:.1%} of the ROI voxels)'.format(len(self.rows), fraction))
+
+    def sampleMatrix(self, matrix) -> sp.csc_matrix:
+        """
+        Rows of a beamlet matrix in the sample
+
+        Parameters
+        ----------
+        matrix : sparse matrix
+            Beamlet matrix with the row space of the objective masks
+
+        Returns
+        -------
+        csc_matrix
+            Matrix of the sampled rows
+        """
+        return sp.csc_matrix(matrix)[self.rows, :]
+
+    def apply(self):
+        """
+        Restricts the masks (and voxel-wise limits) of the objectives to the sample
+        """
+        if not (self._saved is None):
+            return
+        self._saved = []
+        for objective, (rowIndices, picks) in zip(self._objectives, self._picks):
+            voxelwiseLimitValue = getattr(objective, 'voxelwiseLimitValue', None)
+            self._saved.append((objective.maskVec, objective.rowIndices, objective.rowIndices_GPU, voxelwiseLimitValue))
+
+            maskVec = np.zeros(len(self.rows), dtype=bool)
+            maskVec[np.searchsorted(self.rows, rowIndices[picks])] = True
+            objective.maskVec = maskVec
+            objective._updateRowIndices()
+            if not (voxelwiseLimitValue is None):
+                objective.voxelwiseLimitValue = voxelwiseLimitValue[picks]
+
+    def restore(self):
+        """
+        Restores the masks of the objectives on all the rows
+        """
+        if self._saved is None:
+            return
+        for objective, (maskVec, rowIndices, rowIndices_GPU, voxelwiseLimitValue) in zip(self._objectives, self._saved):
+            objective.maskVec = maskVec
+            objective.rowIndices = rowIndices
+            objective.rowIndices_GPU = rowIndices_GPU
+            if not (voxelwiseLimitValue is None):
+                objective.voxelwiseLimitValue = voxelwiseLimitValue
+        self._saved = None
+
+
+def _tracedOptimization(optimizer) -> dict:
+    # Costs of the solves on all the voxels from the optimization trace: the sampled levels only give estimates
+    trace = optimizer.trace if not (optimizer.trace is None) else optimizer.enableTrace(trackMemory=False)
+    startTime = time.perf_counter()
+    optimizer.optimize()
+    costs = [(record['time'], record['cost']) for record in trace.records
+             if record['stage'] is None and not (record['cost'] is None)]
+    return {'time': time.perf_counter() - startTime, 'trace': costs}
+
+
+def _timeToTarget(trace, target) -> Optional[float]:
+    for t, f in trace:
+        if f <= target:
+            return t
+    return None
+
+
+def benchmarkMultiResolution(createOptimizer:Callable, multiResolution:Sequence[float]=(0.02, 0.1, 0.3),
+                             multiResolutionIterations=50, targetRelativeGap:float=0.01, seed:int=0) -> dict:
+    """
+    Compares the time needed to reach a target cost with the optimization on all the voxels and with the
+    multi-resolution mode. The target is the final cost of the optimization on all the voxels, increased by
+    targetRelativeGap. Only the costs on all the voxels are considered: those of the sampled levels are estimates.
+    The costs and times to target are taken from the optimization trace of each optimizer (see
+    PlanOptimizer.enableTrace), whose times start after the objective function is built.
+
+    Parameters
+    ----------
+    createOptimizer : Callable
+        Called with the multi-resolution options as keyword arguments (none for the reference), it returns a new
+        optimizer (e.g. IntensityModulationOptimizer('Scipy_L-BFGS-B', plan, maxiter=..., **kwargs)) on a fresh copy
+        of the reference case
+    multiResolution : Sequence[float] (default: (0.02, 0.1, 0.3))
+        Sampling fractions of the levels
+    multiResolutionIterations : int or list of int (default: 50)
+        Maximum number of iterations of each sampled level
+    targetRelativeGap : float (default: 0.01)
+        Relative gap to the final reference cost defining the target cost
+    seed : int (default: 0)
+        Seed of the voxel sampling
+
+    Returns
+    -------
+    dict
+        Total time (seconds), final cost and time to target of each run, the target cost and the speedup of the time
+        to target
+    """
+    reference = _tracedOptimization(createOptimizer())
+    multi = _tracedOptimization(createOptimizer(multiResolution=list(multiResolution),
+                                                multiResolutionIterations=multiResolutionIterations,
+                                                multiResolutionSeed=seed))
+
+    referenceCost = min(f for _, f in reference['trace'])
+    target = referenceCost * (1 + targetRelativeGap)
+    referenceTimeToTarget = _timeToTarget(reference['trace'], target)
+    multiTimeToTarget = _timeToTarget(multi['trace'], target)
+
+    result = {'targetCost': target,
+              'referenceTime': reference['time'], 'referenceCost': referenceCost,
+              'referenceTimeToTarget': referenceTimeToTarget,
+              'multiResolutionTime': multi['time'], 'multiResolutionCost': min(f for _, f in multi['trace']),
+              'multiResolutionTimeToTarget': multiTimeToTarget,
+              'speedup': referenceTimeToTarget / multiTimeToTarget if not (multiTimeToTarget is None) and multiTimeToTarget > 0 else None}
+    logger.info('Time to target cost {:.6e}: {} s on all voxels, {} s with multi-resolution'.format(
+        target, referenceTimeToTarget, multiTimeToTarget))
+    return result
+
+
+class VoxelSamplingTestCase(unittest.TestCase):
+    class _Objective:
+        # Mask attributes of a DosimetricObjective
+        def __init__(self, maskVec, voxelwiseLimitValue=None):
+            self.maskVec = maskVec
+            self.rowIndices = None
+            self.rowIndices_GPU = None
+            if not (voxelwiseLimitValue is None):
+                self.voxelwiseLimitValue = voxelwiseLimitValue
+
+        def _updateRowIndices(self):
+            self.rowIndices = np.flatnonzero(self.maskVec)
+            self.rowIndices_GPU = None
+
+    def testStratifiedRowSample(self):
+        rowIndices = np.arange(3, 303, 3)
+        rng = np.random.default_rng(0)
+
+        picks = stratifiedRowSample(rowIndices, 0.1, rng)
+        self.assertEqual(len(picks), 10)
+        np.testing.assert_array_equal(picks // 10, np.arange(10))
+
+        picks = stratifiedRowSample(rowIndices, 0.1, rng, minSamples=30)
+        self.assertEqual(len(picks), 30)
+        edges = np.floor(np.arange(31) * (100 / 30)).astype(np.int64)
+        np.testing.assert_array_equal(np.searchsorted(edges, picks, side='right') - 1, np.arange(30))
+        self.assertTrue(np.all(np.diff(picks) > 0))
+
+        np.testing.assert_array_equal(stratifiedRowSample(rowIndices, 0.1, rng, minSamples=200), np.arange(100))
+        np.testing.assert_array_equal(stratifiedRowSample(rowIndices, 1., rng), np.arange(100))
+
+    def testApplyRestore(self):
+        nRows = 1000
+        maskA = np.zeros(nRows, dtype=bool)
+        maskA[100:500] = True
+        maskB = np.zeros(nRows, dtype=bool)
+        maskB[600:1000:2] = True
+        limit = np.arange(maskB.sum(), dtype=float)
+
+        objectives = [self._Objective(maskA), self._Objective(maskA.copy()), self._Objective(maskB, limit)]
+        objectives[0]._updateRowIndices()
+        objectives[0].rowIndices_GPU = objectives[0].rowIndices
+        saved = [(objective.maskVec, objective.rowIndices, objective.rowIndices_GPU) for objective in objectives]
+
+        sampling = VoxelSampling(objectives, 0.1, rng=np.random.default_rng(0), minVoxels=10)
+        self.assertEqual(len(sampling.rows), 40 + 20)
+
+        sampling.apply()
+        sampling.apply()
+        rowsA = sampling.rows[objectives[0].rowIndices]
+        self.assertEqual(len(rowsA), 40)
+        self.assertTrue(np.all(maskA[rowsA]))
+        # Objectives on the same ROI share its sample
+        np.testing.assert_array_equal(sampling.rows[objectives[1].rowIndices], rowsA)
+        for objective in objectives:
+            self.assertEqual(len(objective.maskVec), len(sampling.rows))
+            self.assertIsNone(objective.rowIndices_GPU)
+        rowsB = sampling.rows[objectives[2].rowIndices]
+        self.assertEqual(len(rowsB), 20)
+        np.testing.assert_array_equal(objectives[2].voxelwiseLimitValue,
+                                      limit[np.searchsorted(np.flatnonzero(maskB), rowsB)])
+
+        sampling.restore()
+        for objective, (maskVec, rowIndices, rowIndices_GPU) in zip(objectives, saved):
+            self.assertIs(objective.maskVec, maskVec)
+            self.assertIs(objective.rowIndices, rowIndices)
+            self.assertIs(objective.rowIndices_GPU, rowIndices_GPU)
+        self.assertIs(objectives[2].voxelwiseLimitValue, limit)
+        self.assertFalse(hasattr(objectives[0], 'voxelwiseLimitValue'))
+
+
+if __name__ == '__main__':
+    unittest.main()
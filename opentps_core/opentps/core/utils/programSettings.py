@@ -43,6 +43,8 @@ class ProgramSettings(metaclass=Singleton):
         The folder where the logs are located.
     exampleFolder : str
         The folder where the examples are located.
+    beamletCacheFolder : str
+        The folder where computed beamlets are cached.
     """
     def __init__(self):
         self._config_dir = Path(appdirs.user_config_dir("openTPS"))
@@ -82,6 +84,7 @@ class ProgramSettings(metaclass=Singleton):
         self._config["dir"]["logFolder"] = str(path / "Logs")
         self._config["dir"]["loggingConfigFile"] = str(self._loggingConfigFilePath)
         self._config["dir"]["exampleFolder"] = str(path / "examples")
+        self._config["dir"]["beamletCacheFolder"] = str(path / "BeamletCache")
 
         self.writeConfig()
 
@@ -119,6 +122,13 @@ class ProgramSettings(metaclass=Singleton):
         self._createFolderIfNotExists(folder)
         return folder
 
+    @property
+    def beamletCacheFolder(self):
+        # Config files written by older versions have no entry for the cache
+        folder = self._config["dir"].get("beamletCacheFolder", str(Path(self.workspace) / "BeamletCache"))
+        self._createFolderIfNotExists(folder)
+        return folder
+
     def writeConfig(self):
         """
         Write the config to the config file.
@@ -16,6 +16,7 @@ from opentps.core.processing.doseCalculation.doseCalculationConfig import DoseCa
 from opentps.core.processing.doseCalculation.photons.cccDoseCalculator import CCCDoseCalculator
 from opentps.core.processing.doseCalculation.protons.mcsquareDoseCalculator import MCsquareDoseCalculator
 from opentps.core.processing.planOptimization.planOptimization import BoundConstraintsOptimizer, IntensityModulationOptimizer
+from opentps.core.processing.planOptimization.optimizationSession import OptimizationSession
 from opentps.gui.panels.doseComputationPanel import DoseComputationPanel
 from opentps.gui.panels.patientDataWidgets import PatientDataComboBox
 from opentps.gui.panels.planOptimizationPanel.objectivesWindow import ObjectivesWindow
@@ -127,6 +128,8 @@ class PlanOptiPanel(QWidget):
         self._patient: Patient = None
         self._radiationType = "PROTON" # default
         self._optiConfig = {"method": "Scipy-LBFGS", "maxIter": 1000, "step": 0.02, "bounds": None}
+        self._optimizationSession = None
+        self._sessionConfig = None
 
         self._viewController = viewController
 
@@ -258,6 +261,10 @@ class PlanOptiPanel(QWidget):
 
         self._setObjectives()
 
+        if self._reoptimize():
+            return
+        self._closeOptimizationSession()
+
         # create list of contours
         objROINames = []
         contours = []
@@ -291,6 +298,34 @@ class PlanOptiPanel(QWidget):
 
         self._optimize(contours)
 
+    def _reoptimize(self) -> bool:
+        # Objectives changed by their parameters only, on the last optimized plan: the optimization session keeps the
+        # cropped beamlets and the dose fidelity functions and starts from the last solution
+        session = self._optimizationSession
+        if session is None or self._spotPlacementBox.isChecked() or \
+                (self._beamletBox.isChecked() and self._beamletBox.isEnabled()):
+            return False
+        if session.plan.planDesign is not self.selectedPlanStructure or self._sessionConfig != self._currentSessionConfig() \
+                or not session.isCompatible(self.selectedPlanStructure.objectives.objectivesList):
+            return False
+
+        session.updateObjectives(self.selectedPlanStructure.objectives.objectivesList)
+        self._plan.name = self._planNameEdit.text()
+        self._plan.numberOfFractionsPlanned = self._fractionsSpin.value()
+        doseImage, _ = session.solve()
+        doseImage.patient = self.selectedPlanStructure.ct.patient
+        logger.info("Re-optimization is done. Check new generated dose image in patient data")
+        return True
+
+    def _closeOptimizationSession(self):
+        # The spots with a low weight of the re-optimized plan are removed when the session is closed
+        if not (self._optimizationSession is None):
+            self._optimizationSession.close()
+            self._optimizationSession = None
+
+    def _currentSessionConfig(self):
+        return (self._selectedAlgo, self._optiConfig['maxIter'], self._optiConfig['bounds'])
+
     def _setObjectives(self):
         objectiveList = ObjectivesList()
         for obj in self._objectivesWidget.objectives:
@@ -374,6 +409,11 @@ class PlanOptiPanel(QWidget):
                 solver = IntensityModulationOptimizer(method=method, plan=self._plan, maxiter=self._optiConfig['maxIter'])
             # Optimize treatment plan
             doseImage, _ = solver.optimize()
+            # Unless spots are removed during the optimization (minimum spot weight), the optimizer is kept in a
+            # session for a fast re-optimization after changes of the objective parameters, starting from this result
+            if method != 'LP' and not (self._optiConfig['bounds'] and self._optiConfig['bounds'][0] > 0):
+                self._optimizationSession = OptimizationSession(solver, warmStart=True)
+                self._sessionConfig = self._currentSessionConfig()
             doseImage.patient = self._doseCalculationWindow._doseComputationPanel.selectedCT.patient
             logger.info("Optimization is done. Check new generated dose image in patient data")
 